@@ -1,149 +1,590 @@
 import json
+import time
+import boto3
 import urllib3
 from pvwa_integration import PvwaIntegration
 import aws_services
 import instance_processing
 import pvwa_api_calls
+import session_slots
+import pvwa_routing
 from log_mechanism import LogMechanism
+from metrics_mechanism import metrics, DIMENSION_PLATFORM, DIMENSION_STATE, DIMENSION_ACCOUNT
+from profiling_mechanism import profiler
+from deadline_mechanism import Deadline, DeadlineExceeded
+from event_queue import parse_state_change_message, get_message_id, get_queue_url, SqsEventQueue
+from event_coalescing import coalesce_events, is_ended, get_event_time
+from event_pipeline import EventPipeline, CONTINUE, lazy_property, is_loaded
+from credential_rotation import RotationScheduler, get_rotation_config, ROTATION_RUN_SECONDS
+from bulk_onboarding import BulkOnboarding, get_bulk_onboarding_enabled
+from circuit_breaker import pvwa_circuit, get_event_id, build_redrive_event
+from adaptive_concurrency import pvwa_concurrency
+from fair_scheduling import fair_scheduler, DEFER_SECONDS
+from onboarding_rules import onboarding_rules, EXCLUDE
 
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+BATCH_EVENT_SECONDS = 60  # Time kept for processing one more queued event, the rest of the batch is returned to the queue
+BULK_SUBMIT_SECONDS = 120  # Time kept for the bulk upload jobs of the batch after its events were prepared
+HANDLED_STATES = ('running', 'terminated')
+BULK_PENDING = 'bulk pending'  # Result of an event whose account is created by the bulk upload of the batch
+PARKED = 'parked'  # Result of an event kept for a re-drive while PVWA is unavailable
+DEFERRED = 'deferred'  # State dimension of the events sent back to the queue by the fair scheduler
+CHECKPOINTED = 'checkpointed'  # Result of an event handed off at a checkpoint and enqueued again
 logger = LogMechanism()
 pvwa_integration_class = PvwaIntegration()
 
+@profiler.profiled('aws_ec2_auto_onboarding')
 def lambda_handler(event, context):
     logger.trace(context, caller_name='lambda_handler')
+    metrics.start_invocation()
     logger.info('Parsing event')
     try:
         message = event["Records"][0]["Sns"]["Message"]
         data = json.loads(message)
     except Exception as e:
         logger.error(f"Error on retrieving Message Data from Event Message. Error: {e}")
+        return
+    solution_account_id = context.invoked_function_arn.split(':')[4]
+    log_name = context.log_stream_name if context.log_stream_name else "None"
+    deadline = Deadline.from_context(context)
+    try:
+        with metrics.span('invocation'):
+            result = run_event(InstanceEvent(data, solution_account_id, log_name, deadline=deadline))
+    finally:
+        metrics.flush()
+    if result == CHECKPOINTED:
+        requeue_event(context.invoked_function_arn, data)
+    redrive_parked_events(context, deadline)
 
+
+# Queue-backed mode: SNS delivers the state-change notifications to an SQS queue and this handler receives them in
+# batches. The batch logs on to PVWA once, with a single session slot, and processes its events with that session.
+# The events are processed in event time order, running and terminated events of an instance that was never onboarded
+# cancel each other.
+# The terminated instances of the batch are offboarded together before the running instances are onboarded.
+# With AOB_Bulk_Onboarding enabled the accounts of the running instances are created by bulk upload jobs.
+# The events of the accounts and regions are scheduled fairly by their AOB_Account_Weights, the events of a flow ahead of
+# its share are sent back to the queue, as are the events handed off at a checkpoint.
+# Events that failed and may succeed on a retry are reported in batchItemFailures and are received again
+@profiler.profiled('aws_ec2_auto_onboarding_batch')
+def batch_handler(event, context):
+    logger.trace(context, caller_name='batch_handler')
+    deadline = Deadline.from_context(context)
+    solution_account_id = context.invoked_function_arn.split(':')[4]
+    log_name = context.log_stream_name if context.log_stream_name else "None"
+    records = event.get("Records", [])
+    logger.info(f'Received a batch of {len(records)} events')
+    failed_message_ids = []
+    events = []
+    bodies = dict()
+    for record in records:
+        try:
+            data = parse_state_change_message(record)
+            if not data["detail"].get("instance-id") or not data["detail"].get("state"):
+                raise Exception("The message has no instance id or state")
+            events.append((get_message_id(record), data))
+            bodies[get_message_id(record)] = record.get('body')
+        except Exception as e:
+            # A malformed message never succeeds, it is dropped instead of being retried
+            logger.error(f"Error on parsing queued event {record.get('messageId')}. Error: {e}")
+    events, cancelled = coalesce_events(events)
+    if cancelled:
+        logger.info(f'{len(cancelled)} events cancelled by coalescing')
+    # Re-driven parked events come without a queue and are not scheduled
+    queue_arn = records[0].get('eventSourceARN') if records else None
+    if queue_arn:
+        events, deferred = fair_scheduler.schedule(events)
+        if deferred:
+            failed_message_ids += defer_events(deferred, bodies, queue_arn)
+    shared_session = VaultSession()
     try:
-        instance_id = data["detail"]["instance-id"]
-    except Exception as e:
-        logger.error(f"Error on retrieving Instance Id from Event Message. Error: {e}")
+        terminated_events = [(message_id, data) for message_id, data in events if data["detail"]["state"] == 'terminated']
+        if terminated_events:
+            events = [(message_id, data) for message_id, data in events if data["detail"]["state"] != 'terminated']
+            failed_message_ids += offboard_events(terminated_events, shared_session)
+        bulk_onboarding = BulkOnboarding(shared_session, deadline, log_name) if events and get_bulk_onboarding_enabled() \
+            else None
+        reserved_seconds = BATCH_EVENT_SECONDS + (BULK_SUBMIT_SECONDS if bulk_onboarding is not None else 0)
+        bulk_message_ids = dict()
+        checkpointed = []
+        for index, (message_id, data) in enumerate(events):
+            if not deadline.has_time_for(reserved_seconds):
+                logger.info(f'Returning {len(events) - index} events to the queue, not enough time left')
+                failed_message_ids += [remaining[0] for remaining in events[index:]]
+                break
+            metrics.start_invocation()
+            record_queue_wait(data)
+            try:
+                with metrics.span('invocation'):
+                    succeeded = run_event(InstanceEvent(data, solution_account_id, log_name, shared_session,
+                                                        bulk_onboarding, deadline))
+            finally:
+                metrics.flush()
+            if succeeded is False:
+                failed_message_ids.append(message_id)
+            elif succeeded == BULK_PENDING:
+                bulk_message_ids.setdefault(data["detail"]["instance-id"], []).append(message_id)
+            elif succeeded == CHECKPOINTED:
+                checkpointed.append((message_id, data))
+        if checkpointed:
+            failed_message_ids += requeue_events(checkpointed, bodies, queue_arn, context.invoked_function_arn)
+        if bulk_message_ids:
+            failed_message_ids += onboard_bulk(bulk_onboarding, bulk_message_ids)
+    finally:
+        shared_session.close()
+    logger.info(f'Batch processed, {len(failed_message_ids)} of {len(records)} events returned to the queue')
+    redrive_parked_events(context, deadline)
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_message_ids]}
+
+
+# Time the event waited between its state change and its processing, by account through the Account dimension
+def record_queue_wait(data):
+    event_time = get_event_time(data)
+    if event_time is not None:
+        metrics.record('queue_wait', max(0, time.time() - event_time) * 1000)
+
+
+# Sends the events deferred by the fair scheduler or handed off at a checkpoint back to the queue, returns the message ids
+# of the events that could not be sent, they are retried instead
+def defer_events(deferred, bodies, queue_arn, state=DEFERRED):
+    logger.info(f'Sending {len(deferred)} {state} events back to the queue')
+    queue = SqsEventQueue(get_queue_url(queue_arn))
+    failed_message_ids = []
+    for message_id, data in deferred:
+        metrics.start_invocation()
+        metrics.set_dimension(DIMENSION_STATE, state)
+        metrics.set_dimension(DIMENSION_ACCOUNT, data.get('account'))
+        record_queue_wait(data)
+        try:
+            queue.send(bodies[message_id], DEFER_SECONDS)
+        except Exception as e:
+            logger.error(f'Failed to defer event {message_id}: {e}')
+            failed_message_ids.append(message_id)
+        finally:
+            metrics.flush()
+    return failed_message_ids
 
+
+# Enqueues the events of a batch handed off at a checkpoint again, on their queue or, for re-driven events, as an
+# asynchronous invocation. Returns the message ids of the events to retry
+def requeue_events(checkpointed, bodies, queue_arn, function_arn):
+    if queue_arn:
+        return defer_events(checkpointed, bodies, queue_arn, CHECKPOINTED)
+    failed_message_ids = []
+    for message_id, data in checkpointed:
+        try:
+            requeue_event(function_arn, data)
+        except Exception as e:
+            logger.error(f'Failed to enqueue event {message_id} again: {e}')
+            failed_message_ids.append(message_id)
+    return failed_message_ids
+
+
+# Enqueues an event handed off at a checkpoint again by invoking this function asynchronously with it
+def requeue_event(function_arn, data):
+    logger.info(f'Enqueuing the onboarding of {data["detail"]["instance-id"]} again')
+    boto3.client('lambda').invoke(FunctionName=function_arn, InvocationType='Event',
+                                  Payload=json.dumps(build_redrive_event(get_event_id(data), json.dumps(data))))
+
+
+# Offboards the terminated events of a batch together, returns the message ids of the events to retry
+def offboard_events(terminated_events, shared_session):
+    logger.info(f'Offboarding {len(terminated_events)} terminated instances')
+    message_ids = dict()
+    for message_id, data in terminated_events:
+        message_ids.setdefault(data["detail"]["instance-id"], []).append(message_id)
+    metrics.start_invocation()
+    metrics.set_dimension(DIMENSION_STATE, 'terminated')
     try:
-        action_type = data["detail"]["state"]
+        session_token = shared_session.get_token()
+        if not session_token:
+            if shared_session.pvwa_unavailable:
+                return [message_id for message_id, data in terminated_events
+                        if not pvwa_circuit.park(get_event_id(data), data)]
+            return [message_id for message_id, data in terminated_events]
+        results = instance_processing.offboard_instances(list(message_ids), session_token,
+                                                         shared_session.store_parameters_class)
     except Exception as e:
-        logger.error(f"Error on retrieving Action Type from Event Message. Error: {e}")
+        logger.error(f"Bulk offboarding failed: {e}")
+        return [message_id for message_id, data in terminated_events]
+    finally:
+        metrics.flush()
+    failed_message_ids = []
+    for instance_id, (result, error) in results.items():
+        logger.info(f'{instance_id}: {result}' + (f', {error}' if error else ''))
+        if result == instance_processing.OffBoardResult.failed:
+            failed_message_ids += message_ids[instance_id]
+    return failed_message_ids
 
+
+# Creates the accounts collected by the vault stage of the batch, returns the message ids of the events to retry
+def onboard_bulk(bulk_onboarding, bulk_message_ids):
+    metrics.start_invocation()
+    metrics.set_dimension(DIMENSION_STATE, 'running')
     try:
-        event_account_id = data["account"]
+        results = bulk_onboarding.submit()
     except Exception as e:
-        logger.error(f"Error on retrieving Event Account Id from Event Message. Error: {e}")
+        logger.error(f"Bulk onboarding failed: {e}")
+        results = dict()
+    finally:
+        metrics.flush()
+    return [message_id for instance_id, message_ids in bulk_message_ids.items() if not results.get(instance_id)
+            for message_id in message_ids]
+
 
+# Once PVWA is available again, the invocation winning the re-drive lease invokes this function with the parked events.
+# A re-driven event that fails is not retried, unless it is parked again
+def redrive_parked_events(context, deadline):
+    if not pvwa_circuit.claim_redrive():
+        return
     try:
-        event_region = data["region"]
-        solution_account_id = context.invoked_function_arn.split(':')[4]
-        log_name = context.log_stream_name if context.log_stream_name else "None"
+        pvwa_circuit.redrive(context.invoked_function_arn, deadline)
     except Exception as e:
-        logger.error(f"Error on retrieving Event Region from Event Message. Error: {e}")
-    elasticity_function(instance_id, action_type, event_account_id, event_region, solution_account_id, log_name)
+        logger.error(f"Failed to re-drive the parked events: {e}")
 
 
-def elasticity_function(instance_id, action_type, event_account_id, event_region, solution_account_id, log_name):
+# Scheduled every minute with a single concurrent execution: follows up the credential changes in progress and requests
+# the due ones at the configured rate. The onboarding only records the rotation on the Instances row.
+# Each run also reclaims the session slots left by stopped containers and logs the slot occupancy and limit
+def rotation_handler(event, context):
+    logger.trace(context, caller_name='rotation_handler')
+    deadline = Deadline(min(context.get_remaining_time_in_millis(), ROTATION_RUN_SECONDS * 1000))
+    vault_session = VaultSession()
+    metrics.start_invocation()
+    try:
+        session_slots.sweep_expired_slots()
+        logger.info(f'Session slot occupancy: {session_slots.get_slot_occupancy()}, '
+                    f'session limit: {pvwa_concurrency.read()}')
+    except Exception as e:
+        logger.error(f"Failed to sweep the session slots: {e}")
     try:
-        ec2_object = aws_services.get_account_details(solution_account_id, event_account_id, event_region)
-        instance_details = aws_services.get_ec2_details(instance_id, ec2_object, event_account_id)
-        instance_data = aws_services.get_instance_data_from_dynamo_table(instance_id)
-        if action_type == 'terminated':
-            if not instance_data:
-                logger.info(f"Item {instance_id} does not exist on DB")
-                return None
-            instance_status = instance_data["Status"]["S"]
-            if instance_status == OnBoardStatus.on_boarded_failed:
-                logger.error(f"Item {instance_id} is in status OnBoard failed, removing from DynamoDB table")
-                aws_services.remove_instance_from_dynamo_table(instance_id)
-                return None
-        elif action_type == 'running':
-            if not instance_details["address"]:  # In case querying AWS return empty address
-                logger.error("Retrieving Instance Address from AWS failed.")
-                return None
-            if instance_data:
-                instance_status = instance_data["Status"]["S"]
-                if instance_status == OnBoardStatus.on_boarded:
-                    logger.info(f"Item {instance_id} already exists on DB, no need to add it to Vault")
-                    return None
-                elif instance_status == OnBoardStatus.on_boarded_failed:
-                    logger.error(f"Item {instance_id} exists with status 'OnBoard failed', adding to Vault")
-                else:
-                    logger.info(f"Item {instance_id} does not exist on DB, adding to Vault")
-        else:
-            logger.info('Unknown instance state')
-            return
-
-        store_parameters_class = aws_services.get_params_from_param_store()
-        if not store_parameters_class:
-            return
-        if store_parameters_class.aob_mode == 'Production':
+        with metrics.span('rotation_run'):
+            return RotationScheduler(vault_session, get_rotation_config(), deadline).run()
+    except Exception as e:
+        logger.error(f"Credential rotation run failed: {e}")
+    finally:
+        vault_session.close()
+        metrics.flush()
+
+
+# Holds a PVWA session and the lease of its Dynamo session slot, the parameters are read and the logon happens on first use.
+# The queue-backed mode shares one session between the events of a batch, the direct mode opens one per event.
+# No slot is taken while the PVWA circuit is open, pvwa_unavailable tells the caller to park its events.
+# The logon pins store_parameters_class to the PVWA node of the session. With a deadline the wait for a slot stops with
+# DeadlineExceeded when the session could not be used in the time left
+class VaultSession:
+    def __init__(self, store_parameters_class=None, deadline=None):
+        if store_parameters_class:
+            self.store_parameters_class = store_parameters_class
+        self.deadline = deadline
+        self.slot_lease = None
+        self.session_token = None
+        self.logon_failed = False
+        self.pvwa_unavailable = False
+
+
+    @lazy_property
+    def store_parameters_class(self):
+        return aws_services.get_params_from_param_store()
+
+
+    def get_token(self):
+        if self.session_token:
+            return self.session_token
+        # A batch does not wait again for a session slot after a failed logon, its events are returned to the queue
+        if self.logon_failed or not self.store_parameters_class:
+            return False
+        self.logon_failed = True
+        if not pvwa_circuit.allow_request():
+            self.pvwa_unavailable = True
+            return False
+        PvwaIntegration.set_environment(self.store_parameters_class.aob_mode)
+        if self.store_parameters_class.aob_mode == 'Production':
             # Save PVWA Verification key in /tmp folder
             logger.info('Saving verification key')
-            crt = open("/tmp/server.crt", "w+")
-            crt.write(store_parameters_class.pvwa_verification_key)
-            crt.close()
-        pvwa_connection_number, session_guid = aws_services.get_session_from_dynamo()
-        if not pvwa_connection_number:
-            return
-        session_token = pvwa_integration_class.logon_pvwa(store_parameters_class.vault_username,
-                                                          store_parameters_class.vault_password,
-                                                          store_parameters_class.pvwa_url,
-                                                          pvwa_connection_number)
+            with open("/tmp/server.crt", "w+") as crt:
+                crt.write(self.store_parameters_class.pvwa_verification_key)
+        self.slot_lease, self.store_parameters_class = pvwa_routing.acquire_node_slot(self.store_parameters_class,
+                                                                                      self.deadline)
+        if not self.slot_lease:
+            return False
+        try:
+            self.session_token = pvwa_integration_class.logon_pvwa(self.store_parameters_class.vault_username,
+                                                                   self.store_parameters_class.vault_password,
+                                                                   self.store_parameters_class.pvwa_url,
+                                                                   self.slot_lease.slot)
+        except Exception as e:
+            logger.error(f"Logon to PVWA failed: {e}")
+            self.session_token = None
+        if not self.session_token:
+            pvwa_circuit.record_failure()
+            self.pvwa_unavailable = True
+            self.release_slot()
+            return False
+        pvwa_circuit.record_success()
+        self.logon_failed = False
+        return self.session_token
+
+
+    def release_slot(self):
+        if self.slot_lease:
+            self.slot_lease.release()
+            self.slot_lease = None
+
+
+    # The slot is released even when the logoff fails
+    def close(self):
+        try:
+            if self.session_token:
+                pvwa_integration_class.logoff_pvwa(self.store_parameters_class.pvwa_url, self.session_token)
+        finally:
+            self.session_token = None
+            self.release_slot()
+
+
+# An EC2 state-change event and its inputs. Each input is fetched on first use, so a stage that ends the pipeline
+# early saves the calls of the later stages. The deadline of the invocation bounds the waits of the onboarding.
+# started_at is the processing start of the latency ledger
+class InstanceEvent:
+    def __init__(self, data, solution_account_id, log_name, shared_session=None, bulk_onboarding=None, deadline=None):
+        self.data = data
+        self.solution_account_id = solution_account_id
+        self.log_name = log_name
+        self.shared_session = shared_session
+        self.bulk_onboarding = bulk_onboarding
+        self.deadline = deadline
+        self.started_at = int(time.time())
+        self.instance_id = None
+        self.action_type = None
+        self.event_account_id = None
+        self.event_region = None
+        self.key_pair_account_id = None
+
+
+    @lazy_property
+    def instance_data(self):
+        return aws_services.get_instance_data_from_dynamo_table(self.instance_id)
+
+
+    @lazy_property
+    def instance_details(self):
+        ec2_object = aws_services.get_account_details(self.solution_account_id, self.event_account_id, self.event_region)
+        return aws_services.get_ec2_details(self.instance_id, ec2_object, self.event_account_id)
+
+
+    @property
+    def instance_status(self):
+        return self.instance_data["Status"]["S"] if self.instance_data else None
+
+
+    # Checkpoint left by a run that handed the onboarding off, None when it starts from the beginning
+    @lazy_property
+    def checkpoint(self):
+        return instance_processing.get_checkpoint(self.instance_data)
+
+
+def parse_stage(event):
+    try:
+        event.instance_id = event.data["detail"]["instance-id"]
+        event.action_type = event.data["detail"]["state"]
+        event.event_account_id = event.data["account"]
+        event.event_region = event.data["region"]
+    except Exception as e:
+        logger.error(f"Error on retrieving the event details from Event Message. Error: {e}")
+        return None
+    metrics.set_dimension(DIMENSION_STATE, event.action_type)
+    metrics.set_dimension(DIMENSION_ACCOUNT, event.event_account_id)
+    return CONTINUE
+
+
+# Only the state of the event is needed, no call is made for the states that are not handled
+def filter_stage(event):
+    if event.action_type not in HANDLED_STATES:
+        logger.info('Unknown instance state')
+        return None
+    return CONTINUE
+
+
+# One Dynamo read tells whether the event was already handled
+def dedupe_stage(event):
+    instance_id = event.instance_id
+    if event.action_type == 'terminated':
+        if not event.instance_data:
+            logger.info(f"Item {instance_id} does not exist on DB")
+            return None
+        if event.instance_status == OnBoardStatus.on_boarded_failed:
+            logger.error(f"Item {instance_id} is in status OnBoard failed, removing from DynamoDB table")
+            aws_services.remove_instance_from_dynamo_table(instance_id)
+            return None
+        if event.instance_status in (OnBoardStatus.on_board_pending, OnBoardStatus.skipped):
+            # Handed off before the vault account was created, or excluded by the onboarding rules
+            logger.info(f"Item {instance_id} has no vault account, removing from DynamoDB table")
+            aws_services.remove_instance_from_dynamo_table(instance_id)
+            return None
+    elif event.instance_status == OnBoardStatus.on_boarded:
+        logger.info(f"Item {instance_id} already exists on DB, no need to add it to Vault")
+        return None
+    elif event.instance_status == OnBoardStatus.on_boarded_failed:
+        logger.error(f"Item {instance_id} exists with status 'OnBoard failed', adding to Vault")
+    elif event.instance_status == OnBoardStatus.on_board_pending:
+        logger.info(f"Resuming the onboarding of {instance_id} handed off before the {event.checkpoint['step']} step")
+    elif event.instance_status == OnBoardStatus.skipped:
+        logger.info(f"Item {instance_id} was skipped, evaluating the onboarding rules again")
+    else:
+        logger.info(f"Item {instance_id} does not exist on DB, adding to Vault")
+    return CONTINUE
+
+
+# Describes the instance, unless the Instances row already locates the vault account of a terminated instance.
+# A running instance excluded by the onboarding rules is recorded as skipped, before any vault call
+def enrich_stage(event):
+    if event.action_type == 'terminated' and instance_processing.VAULT_ACCOUNT_ID in event.instance_data:
+        event.instance_details = None
+        metrics.set_dimension(DIMENSION_PLATFORM, 'Windows' if event.instance_data['Platform']['S'] == \
+                              instance_processing.WINDOWS_PLATFORM else 'Linux')
+        return CONTINUE
+    instance_details = event.instance_details
+    metrics.set_dimension(DIMENSION_PLATFORM, 'Windows' if instance_details['platform'] == "windows" else 'Linux')
+    if event.action_type == 'running':
+        if is_ended(instance_details):  # Held or delivered late, the terminated event has nothing to remove
+            logger.info(f"{event.instance_id} is {instance_details['state']}, skipping its onboarding")
+            return None
+        action, rule_name = onboarding_rules.evaluate(instance_details, event.event_region)
+        if action == EXCLUDE:
+            logger.info(f"{event.instance_id} is excluded by the onboarding rule {rule_name}")
+            aws_services.put_instance_to_dynamo_table(event.instance_id, instance_details["address"], OnBoardStatus.skipped,
+                                                      f"Excluded by rule {rule_name}", event.log_name)
+            return None
+        if not instance_details["address"]:  # In case querying AWS return empty address
+            logger.error("Retrieving Instance Address from AWS failed.")
+            return None
+        # Latency ledger of the onboarding, a resumed onboarding keeps the time its event was first processed
+        processing_started_at = event.checkpoint['processing_started_at'] if event.checkpoint else None
+        instance_details.update(event_time=get_event_time(event.data), region=event.event_region,
+                                processing_started_at=processing_started_at or event.started_at)
+    return CONTINUE
+
+
+def vault_stage(event):
+    session = event.shared_session or VaultSession(deadline=event.deadline)
+    try:
+        session_token = session.get_token()
         if not session_token:
-            return
-        disconnect = False
-        if action_type == 'terminated':
+            if session.pvwa_unavailable:
+                return PARKED if pvwa_circuit.park(get_event_id(event.data), event.data) else False
+            return False
+        store_parameters_class = session.store_parameters_class
+        instance_id = event.instance_id
+        if event.action_type == 'terminated':
             logger.info(f'Detected termination of {instance_id}')
-            instance_processing.delete_instance(instance_id, session_token, store_parameters_class, instance_data,
-                                                instance_details)
-        elif action_type == 'running':
-            # get key pair
-            logger.info('Retrieving account id where the key-pair is stored')
-            # Retrieving the account id of the account where the instance keyPair is stored
-            # AWS.<AWS Account>.<Event Region name>.<key pair name>
-            key_pair_value_on_safe = f'AWS.{instance_details["aws_account_id"]}.{event_region}.{instance_details["key_name"]}'
-            key_pair_account_id = pvwa_api_calls.check_if_kp_exists(session_token, key_pair_value_on_safe,
-                                                                    store_parameters_class.key_pair_safe_name,
-                                                                    instance_id,
-                                                                    store_parameters_class.pvwa_url)
-            if not key_pair_account_id:
-                logger.error(f"Key Pair {key_pair_value_on_safe} does not exist in Safe " \
-                             f"{store_parameters_class.key_pair_safe_name}")
-                return
-            instance_account_password = pvwa_api_calls.get_account_value(session_token, key_pair_account_id, instance_id,
-                                                                         store_parameters_class.pvwa_url)
-            if instance_account_password is False:
-                return
-            pvwa_integration_class.logoff_pvwa(store_parameters_class.pvwa_url, session_token)
-            aws_services.release_session_on_dynamo(pvwa_connection_number, session_guid)
-            disconnect = True
-            instance_processing.create_instance(instance_id, instance_details, store_parameters_class, log_name,
-                                                solution_account_id, event_region, event_account_id, instance_account_password)
-        else:
-            logger.error('Unknown instance state')
-            return
-
-        if not disconnect:
-            pvwa_integration_class.logoff_pvwa(store_parameters_class.pvwa_url, session_token)
-            aws_services.release_session_on_dynamo(pvwa_connection_number, session_guid)
+            instance_processing.delete_instance(instance_id, session_token, store_parameters_class, event.instance_data,
+                                                event.instance_details)
+            return True
+        instance_details = event.instance_details
+        instance_account_password = get_key_pair_value(event, session_token, store_parameters_class)
+        if instance_account_password is None:
+            return None
+        if instance_account_password is False:
+            return False
+        if event.bulk_onboarding is not None:
+            instance_account = instance_processing.get_instance_account(instance_id, instance_details,
+                                                                        store_parameters_class, event.solution_account_id,
+                                                                        event.event_region, event.event_account_id,
+                                                                        instance_account_password, event.deadline)
+            event.bulk_onboarding.add(instance_id, instance_details, instance_account)
+            return BULK_PENDING
+        if not event.shared_session:
+            # The session slot is not held while the key is converted, create_instance opens its own session
+            session.close()
+            session_token = None
+        instance_processing.create_instance(instance_id, instance_details, store_parameters_class, event.log_name,
+                                            event.solution_account_id, event.event_region, event.event_account_id,
+                                            instance_account_password, session_token, event.deadline)
+        return True
+    except DeadlineExceeded as e:
+        return checkpoint_event(event, e.step)
+    finally:
+        if not event.shared_session:
+            session.close()
+
+
+# Reads the key pair of the instance from the Key Pair safe, once per batch in bulk mode. Returns None when the key
+# pair is not in the safe and False when it could not be read
+def get_key_pair_value(event, session_token, store_parameters_class):
+    # Retrieving the account id of the account where the instance keyPair is stored
+    # AWS.<AWS Account>.<Event Region name>.<key pair name>
+    instance_details = event.instance_details
+    key_pair_value_on_safe = f'AWS.{instance_details["aws_account_id"]}.{event.event_region}.{instance_details["key_name"]}'
+    key_pair_values = event.bulk_onboarding.key_pair_values if event.bulk_onboarding is not None else dict()
+    if key_pair_value_on_safe in key_pair_values:
+        return key_pair_values[key_pair_value_on_safe]
+    # A resumed onboarding already located the key pair
+    if event.checkpoint and event.checkpoint['key_pair_account_id']:
+        key_pair_account_id = event.checkpoint['key_pair_account_id']
+    else:
+        key_pair_account_id = pvwa_api_calls.check_if_kp_exists(session_token, key_pair_value_on_safe,
+                                                                store_parameters_class.key_pair_safe_name,
+                                                                event.instance_id,
+                                                                store_parameters_class.pvwa_url)
+    event.key_pair_account_id = key_pair_account_id
+    if not key_pair_account_id:
+        logger.error(f"Key Pair {key_pair_value_on_safe} does not exist in Safe " \
+                     f"{store_parameters_class.key_pair_safe_name}")
+        return None
+    instance_account_password = pvwa_api_calls.get_account_value(session_token, key_pair_account_id, event.instance_id,
+                                                                 store_parameters_class.pvwa_url)
+    if instance_account_password is not False:
+        key_pair_values[key_pair_value_on_safe] = instance_account_password
+    return instance_account_password
 
+
+# Hands off an onboarding that cannot complete in the time left: the step it stopped before is recorded on its
+# Instances row and the caller enqueues the event again, the next run resumes from the checkpoint. An onboarding handed
+# off RESUME_LIMIT times is marked failed. A terminated event is retried instead
+def checkpoint_event(event, step):
+    if event.action_type != 'running':
+        logger.error(f'Not enough time left for the {step} step of {event.instance_id}')
+        return False
+    resume_count = (event.checkpoint['resume_count'] if event.checkpoint else 0) + 1
+    if resume_count > instance_processing.RESUME_LIMIT:
+        logger.error(f'{event.instance_id} was handed off {instance_processing.RESUME_LIMIT} times, giving up')
+        aws_services.put_instance_to_dynamo_table(event.instance_id, event.instance_details['address'],
+                                                  OnBoardStatus.on_boarded_failed,
+                                                  f'Not enough time left for the {step} step', event.log_name)
+        return None
+    if not instance_processing.save_checkpoint(event.instance_id, event.instance_details, step, event.log_name,
+                                               resume_count, event.key_pair_account_id):
+        return False
+    return CHECKPOINTED
+
+
+EVENT_PIPELINE = EventPipeline([('parse', parse_stage),
+                                ('filter', filter_stage),
+                                ('dedupe', dedupe_stage),
+                                ('enrich', enrich_stage),
+                                ('vault', vault_stage)])
+
+
+# Returns False when the event failed and may succeed on a retry, None when the event needed no action
+def run_event(event):
+    try:
+        return EVENT_PIPELINE.run(event)
     except Exception as e:
         logger.error(f"Unknown error occurred: {e}")
-        if action_type == 'terminated':
-            # put_instance_to_dynamo_table(instance_id, instance_details["address"]\
-            # , OnBoardStatus.delete_failed, str(e), log_name)
-            aws_services.update_instances_table_status(instance_id, OnBoardStatus.delete_failed, str(e))
-        elif action_type == 'running':
-            aws_services.put_instance_to_dynamo_table(instance_id, instance_details["address"], OnBoardStatus.on_boarded_failed,
-                                                      str(e), log_name)
+        if event.action_type == 'terminated':
+            aws_services.update_instances_table_status(event.instance_id, OnBoardStatus.delete_failed, str(e))
+        elif event.action_type == 'running':
+            address = event.instance_details["address"] if is_loaded(event, 'instance_details') else None
+            aws_services.put_instance_to_dynamo_table(event.instance_id, address, OnBoardStatus.on_boarded_failed, str(e),
+                                                      event.log_name)
 # TODO: Retry mechanism?
-        aws_services.release_session_on_dynamo(pvwa_connection_number, session_guid)
-        return
+        return False
 
 
 class OnBoardStatus:
     on_boarded = "on boarded"
     on_boarded_failed = "on board failed"
     delete_failed = "delete failed"
+    on_board_pending = "on board pending"
+    skipped = "skipped"
@@ -1,23 +1,36 @@
+import json
 import uuid
-import time
 import requests
 import urllib3
 import boto3
 import cfnresponse
 from log_mechanism import LogMechanism
 from pvwa_integration import PvwaIntegration
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dynamo_lock import LockerClient
+import aws_services
+import pvwa_api_calls
+from deadline_mechanism import Deadline
+from task_graph import TaskGraph
+from profiling_mechanism import profiler
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
 DEFAULT_HEADER = {"content-type": "application/json"}
 IS_SAFE_HANDLER = True
+KEY_PAIR_IMPORT_REQUEST = 'ImportKeyPairs'
+KEY_PAIR_IMPORT_REPORT = 'key_pair_import_report.json'
+KEY_PAIR_IMPORT_WORKERS = 10
 logger = LogMechanism()
 
 
+@profiler.profiled('aws_environment_setup')
 def lambda_handler(event, context):
     logger.trace(event, context, caller_name='lambda_handler')
+    # Bulk key pair import is invoked directly and not by CloudFormation, the summary is returned to the caller
+    if event.get('RequestType') == KEY_PAIR_IMPORT_REQUEST:
+        return import_key_pairs(event, context)
     try:
         physical_resource_id = str(uuid.uuid4())
         if 'PhysicalResourceId' in event:
@@ -41,7 +54,8 @@ def lambda_handler(event, context):
             request_username = event['ResourceProperties']['Username']
             request_unix_safe_name = event['ResourceProperties']['UnixSafeName']
             request_windows_safe_name = event['ResourceProperties']['WindowsSafeName']
-            request_pvwa_ip = event['ResourceProperties']['PVWAIP']
+            # The vault environment is set up through the first node when PVWAIP lists the nodes of a PVWA farm
+            request_pvwa_ip = event['ResourceProperties']['PVWAIP'].split(',')[0].strip()
             request_password = event['ResourceProperties']['Password']
             request_key_pair_safe = event['ResourceProperties']['KeyPairSafe']
             request_key_pair_name = event['ResourceProperties']['KeyPairName']
@@ -52,90 +66,84 @@ def lambda_handler(event, context):
             aob_mode = event['ResourceProperties']['Environment']
 
 
-            logger.info('Adding AOB_Vault_Pass to parameter store', DEBUG_LEVEL_DEBUG)
-            is_password_saved = add_param_to_parameter_store(request_password, "AOB_Vault_Pass", "Vault Password")
-            if not is_password_saved:  # if password failed to be saved
-                return cfnresponse.send(event, context, cfnresponse.FAILED,
-                                        "Failed to create Vault user's password in Parameter Store", {}, physical_resource_id)
             if request_s3_bucket_name == '' and request_verification_key_name != '':
                 raise Exception('Verification Key cannot be empty if S3 Bucket is provided')
             elif request_s3_bucket_name != '' and request_verification_key_name == '':
                 raise Exception('S3 Bucket cannot be empty if Verification Key is provided')
-            else:
-                logger.info('Adding AOB_mode to parameter store', DEBUG_LEVEL_DEBUG)
-                is_aob_mode_saved = add_param_to_parameter_store(aob_mode, 'AOB_mode',
-                                                                 'Dictates if the solution will work in POC(no SSL) or ' \
-                                                                 'Production(with SSL) mode')
-                if not is_aob_mode_saved:  # if password failed to be saved
-                    return cfnresponse.send(event, context, cfnresponse.FAILED,
-                                            "Failed to create AOB_mode parameter in Parameter Store", {}, physical_resource_id)
-                if aob_mode == 'Production':
-                    logger.info('Adding verification key to Parameter Store', DEBUG_LEVEL_DEBUG)
-                    is_verification_key_saved = save_verification_key_to_param_store(request_s3_bucket_name,
-                                                                                     request_verification_key_name)
-                    if not is_verification_key_saved:  # if password failed to be saved
-                        return cfnresponse.send(event, context, cfnresponse.FAILED,
-                                                "Failed to create PVWA Verification Key in Parameter Store",
-                                                {}, physical_resource_id)
 
             pvwa_integration_class = PvwaIntegration(IS_SAFE_HANDLER, aob_mode)
             pvwa_url = f"https://{request_pvwa_ip}/PasswordVault"
-            pvwa_session_id = pvwa_integration_class.logon_pvwa(request_username, request_password, pvwa_url, "1")
-            if not pvwa_session_id:
-                return cfnresponse.send(event, context, cfnresponse.FAILED,
-                                        "Failed to connect to PVWA, see detailed error in logs", {}, physical_resource_id)
-
-            is_safe_created = create_safe(pvwa_integration_class, request_unix_safe_name, request_unix_cpm_name, request_pvwa_ip,
-                                          pvwa_session_id, 1)
-            if not is_safe_created:
-                return cfnresponse.send(event, context, cfnresponse.FAILED,
-                                        f"Failed to create the Safe {request_unix_safe_name}, see detailed error in logs",
-                                        {}, physical_resource_id)
-
-            is_safe_created = create_safe(pvwa_integration_class, request_windows_safe_name, request_windows_cpm_name,
-                                          request_pvwa_ip, pvwa_session_id, 1)
-
-            if not is_safe_created:
-                return cfnresponse.send(event, context, cfnresponse.FAILED,
-                                        f"Failed to create the Safe {request_windows_safe_name}, see detailed error in logs",
-                                        {}, physical_resource_id)
-
-            if not create_session_table():
-                return cfnresponse.send(event, context, cfnresponse.FAILED,
-                                        "Failed to create 'Sessions' table in DynamoDB, see detailed error in logs",
-                                        {}, physical_resource_id)
-
-            #  Creating KeyPair Safe
-            is_safe_created = create_safe(pvwa_integration_class, request_key_pair_safe, "", request_pvwa_ip, pvwa_session_id)
-            if not is_safe_created:
-                return cfnresponse.send(event, context, cfnresponse.FAILED,
-                                        f"Failed to create the Key Pairs safe: {request_key_pair_safe}, " \
-                                        "see detailed error in logs",
-                                        {}, physical_resource_id)
+            deadline = Deadline.from_context(context)
+            provisioning_graph = TaskGraph(deadline)
+            logon_dependencies = []
 
+            logger.info('Adding AOB_Vault_Pass to parameter store', DEBUG_LEVEL_DEBUG)
+            provisioning_graph.add_task('vault_password', lambda: add_param_to_parameter_store(request_password, "AOB_Vault_Pass",
+                                                                                               "Vault Password"))
+            logger.info('Adding AOB_mode to parameter store', DEBUG_LEVEL_DEBUG)
+            aob_mode_description = 'Dictates if the solution will work in POC(no SSL) or Production(with SSL) mode'
+            provisioning_graph.add_task('aob_mode', lambda: add_param_to_parameter_store(aob_mode, 'AOB_mode',
+                                                                                         aob_mode_description))
+            if aob_mode == 'Production':
+                # The verification key is downloaded to /tmp/server.crt, the logon to PVWA has to wait for it
+                logger.info('Adding verification key to Parameter Store', DEBUG_LEVEL_DEBUG)
+                provisioning_graph.add_task('verification_key', lambda: save_verification_key_to_param_store(
+                    request_s3_bucket_name, request_verification_key_name))
+                logon_dependencies.append('verification_key')
+            provisioning_graph.add_task('sessions_table', create_session_table)
+            # Not retried, each retry with wrong credentials counts towards the lockout of the vault user.
+            # A logon completing after the graph was abandoned at the deadline is logged off when it completes
+            provisioning_graph.add_task('pvwa_logon', lambda: pvwa_integration_class.logon_pvwa(request_username,
+                                                                                                 request_password, pvwa_url, "1"),
+                                        depends_on=logon_dependencies, attempts=1,
+                                        on_abandoned=lambda session_id: pvwa_integration_class.logoff_pvwa(pvwa_url,
+                                                                                                           session_id))
+            provisioning_graph.add_task('unix_safe', lambda: create_safe(pvwa_integration_class, request_unix_safe_name,
+                                                                         request_unix_cpm_name, request_pvwa_ip,
+                                                                         provisioning_graph.results['pvwa_logon'].value, 1),
+                                        depends_on=['pvwa_logon'])
+            provisioning_graph.add_task('windows_safe', lambda: create_safe(pvwa_integration_class, request_windows_safe_name,
+                                                                            request_windows_cpm_name, request_pvwa_ip,
+                                                                            provisioning_graph.results['pvwa_logon'].value, 1),
+                                        depends_on=['pvwa_logon'])
+            provisioning_graph.add_task('key_pair_safe', lambda: create_safe(pvwa_integration_class, request_key_pair_safe, "",
+                                                                             request_pvwa_ip,
+                                                                             provisioning_graph.results['pvwa_logon'].value),
+                                        depends_on=['pvwa_logon'])
             #  key pair is optional parameter
-            if not request_key_pair_name:
+            if request_key_pair_name:
+                # Not retried, a retry after a lost response would find the key pair it just created
+                provisioning_graph.add_task('aws_key_pair', lambda: create_key_pair_step(request_key_pair_name), attempts=1)
+                provisioning_graph.add_task('vault_key_pair', lambda: create_key_pair_in_vault(
+                    pvwa_integration_class, provisioning_graph.results['pvwa_logon'].value, request_key_pair_name,
+                    provisioning_graph.results['aws_key_pair'].value, request_pvwa_ip, request_key_pair_safe,
+                    request_aws_account_id, request_aws_region_name),
+                                            depends_on=['aws_key_pair', 'key_pair_safe'])
+            else:
                 logger.info("Key Pair name parameter is empty, the solution will not create a new Key Pair")
-                return cfnresponse.send(event, context, cfnresponse.SUCCESS, None, {}, physical_resource_id)
-            aws_key_pair = create_new_key_pair_on_aws(request_key_pair_name)
 
-            if aws_key_pair is False:
-                # Account already exist, no need to create it, can't insert it to the vault
-                return cfnresponse.send(event, context, cfnresponse.FAILED,
-                                        f"Failed to create Key Pair {request_key_pair_name} in AWS",
-                                        {}, physical_resource_id)
-            if aws_key_pair is True:
-                return cfnresponse.send(event, context, cfnresponse.FAILED,
-                                        f"Key Pair {request_key_pair_name} already exists in AWS",
-                                        {}, physical_resource_id)
-            # Create the key pair account on KeyPairs vault
-            is_aws_account_created = create_key_pair_in_vault(pvwa_integration_class, pvwa_session_id, request_key_pair_name,
-                                                              aws_key_pair, request_pvwa_ip, request_key_pair_safe,
-                                                              request_aws_account_id, request_aws_region_name)
-            if not is_aws_account_created:
-                return cfnresponse.send(event, context, cfnresponse.FAILED,
-                                        f"Failed to create Key Pair {request_key_pair_name} in safe " \
-                                        f"{request_key_pair_safe}. see detailed error in logs", {}, physical_resource_id)
+            # boto3 builds its default session lazily and not in a thread safe way, initialize it before the steps run
+            boto3.client('ssm')
+            results = provisioning_graph.run()
+            pvwa_session_id = results['pvwa_logon'].value
+            failure_messages = [
+                ('vault_password', "Failed to create Vault user's password in Parameter Store"),
+                ('aob_mode', "Failed to create AOB_mode parameter in Parameter Store"),
+                ('verification_key', "Failed to create PVWA Verification Key in Parameter Store"),
+                ('pvwa_logon', "Failed to connect to PVWA, see detailed error in logs"),
+                ('unix_safe', f"Failed to create the Safe {request_unix_safe_name}, see detailed error in logs"),
+                ('windows_safe', f"Failed to create the Safe {request_windows_safe_name}, see detailed error in logs"),
+                ('sessions_table', "Failed to create 'Sessions' table in DynamoDB, see detailed error in logs"),
+                ('key_pair_safe', f"Failed to create the Key Pairs safe: {request_key_pair_safe}, see detailed error in logs"),
+                ('aws_key_pair', f"Failed to create Key Pair {request_key_pair_name} in AWS"),
+                ('vault_key_pair', f"Failed to create Key Pair {request_key_pair_name} in safe " \
+                                   f"{request_key_pair_safe}. see detailed error in logs")]
+            for step_name, failure_message in failure_messages:
+                if step_name in results and not results[step_name].succeeded:
+                    logger.error(f"Step {step_name} failed: {results[step_name].error}")
+                    if results[step_name].error == key_pair_exists_message(request_key_pair_name):
+                        failure_message = results[step_name].error
+                    return cfnresponse.send(event, context, cfnresponse.FAILED, failure_message, {}, physical_resource_id)
 
             return cfnresponse.send(event, context, cfnresponse.SUCCESS, None, {}, physical_resource_id)
 
@@ -149,44 +157,10 @@ def lambda_handler(event, context):
                 pvwa_integration_class.logoff_pvwa(pvwa_url, pvwa_session_id)
 
 
-# Creating a safe, if a failure occur, retry 3 time, wait 10 sec. between retries
+# Creating a safe, a single attempt, failures are retried with jitter by the provisioning graph
 def create_safe(pvwa_integration_class, safe_name, cpm_name, pvwa_ip, session_id, number_of_days_retention=7):
-    logger.trace(pvwa_integration_class, safe_name, cpm_name, pvwa_ip, session_id, number_of_days_retention,
-                 caller_name='create_safe')
-    header = DEFAULT_HEADER
-    header.update({"Authorization": session_id})
-    create_safe_url = f"https://{pvwa_ip}/PasswordVault/WebServices/PIMServices.svc/Safes"
-    # Create new safe, default number of days retention is 7, unless specified otherwise
-    data = f"""
-            {{
-            "safe":{{
-                "SafeName":"{safe_name}",
-                "Description":"",
-                "OLACEnabled":false,
-                "ManagingCPM":"{cpm_name}",
-                "NumberOfDaysRetention":"{number_of_days_retention}"
-              }}
-            }}
-            """
-
-    for i in range(0, 3):
-        create_safe_rest_response = pvwa_integration_class.call_rest_api_post(create_safe_url, data, header)
-
-        if create_safe_rest_response.status_code == requests.codes.conflict:
-            logger.info(f"The Safe {safe_name} already exists")
-            return True
-        elif create_safe_rest_response.status_code == requests.codes.bad_request:
-            logger.error(f"Failed to create Safe {safe_name}, error 400: bad request")
-            return False
-        elif create_safe_rest_response.status_code == requests.codes.created:  # safe created
-            logger.info(f"Safe {safe_name} was successfully created")
-            return True
-        else:  # Error creating safe, retry for 3 times, with 10 seconds between retries
-            logger.error(f"Error creating Safe, status code:{create_safe_rest_response.status_code}, will retry in 10 seconds")
-            if i == 3:
-                logger.error(f"Failed to create safe after several retries, status code:{create_safe_rest_response.status_code}")
-                return False
-        time.sleep(10)
+    return pvwa_api_calls.create_safe(session_id, safe_name, cpm_name, f"https://{pvwa_ip}/PasswordVault",
+                                      number_of_days_retention, pvwa_integration_class)
 
 
 # Search if Key pair exist, if not - create it, return the pem key, False for error
@@ -211,6 +185,18 @@ def create_new_key_pair_on_aws(key_pair_name):
     return key_pair_response["KeyMaterial"]
 
 
+# Key pair step of the provisioning graph, an existing key pair can't be inserted to the vault and fails the step
+def create_key_pair_step(key_pair_name):
+    aws_key_pair = create_new_key_pair_on_aws(key_pair_name)
+    if aws_key_pair is True:
+        raise Exception(key_pair_exists_message(key_pair_name))
+    return aws_key_pair
+
+
+def key_pair_exists_message(key_pair_name):
+    return f"Key Pair {key_pair_name} already exists in AWS"
+
+
 def create_key_pair_in_vault(pvwa_integration_class, session, aws_key_name, private_key_value, pvwa_ip, safe_name,
                              aws_account_id, aws_region_name):
     logger.trace(pvwa_integration_class, session, aws_key_name, pvwa_ip, safe_name, aws_account_id,
@@ -341,3 +327,172 @@ def get_aob_mode():
     )
     aob_mode = ssm_parameter['Parameter']['Value']
     return aob_mode
+
+
+# Bulk import of existing key pairs into the Key Pair safe. AWS does not return the private key of an existing key pair,
+# the PEM files are read from S3 at <S3Prefix><account>/<region>/<key pair name>.pem.
+# Invocation payload: {"RequestType": "ImportKeyPairs", "Regions": [...], "Accounts": [...], "S3BucketName": "...",
+#                      "S3Prefix": "...", "Resume": false}
+# The vault is the source of truth, an interrupted import is resumed by invoking it again. With "Resume" the key pairs
+# left over by the previous report (pending, failed or without key material) are retried, only the accounts and regions
+# that could not be listed are listed again. The report is saved even when the import stops on an error
+def import_key_pairs(event, context):
+    logger.trace(event, context, caller_name='import_key_pairs')
+    logger.info('Key pairs import request received')
+    deadline = Deadline.from_context(context)
+    solution_account_id = context.invoked_function_arn.split(':')[4]
+    bucket_name = event['S3BucketName']
+    prefix = event.get('S3Prefix', '')
+    report = {'listed': 0, 'already_vaulted': 0, 'vaulted': [], 'missing_key_material': [], 'failed': [], 'pending': [],
+              'list_errors': [], 'complete': False}
+    # Read before anything else, the report of an import that cannot be resumed is left as it is
+    previous_report = load_key_pair_import_report(bucket_name, prefix) if event.get('Resume') else None
+    parameters = get_vault_parameters()
+    pvwa_ip = parameters['AOB_PVWA_IP'].split(',')[0].strip()
+    pvwa_url = f"https://{pvwa_ip}/PasswordVault"
+    key_pair_safe = parameters['AOB_KeyPair_Safe']
+    pvwa_integration_class = PvwaIntegration(IS_SAFE_HANDLER, parameters['AOB_mode'])
+    pvwa_session_id = pvwa_integration_class.logon_pvwa(parameters['AOB_Vault_User'], parameters['AOB_Vault_Pass'], pvwa_url, "1")
+    candidates = []
+    try:
+        if previous_report:
+            candidates = [tuple(key_pair) for key_pair in
+                          previous_report['pending'] + previous_report['failed'] + previous_report['missing_key_material']]
+            # The accounts and regions the previous run could not list are listed now
+            unlisted = sorted({(account_id, region) for account_id, region, _ in previous_report['list_errors']})
+            candidates += list_key_pairs_in_accounts(solution_account_id, unlisted, report)
+        else:
+            accounts = event.get('Accounts') or [solution_account_id]
+            candidates = list_key_pairs_in_accounts(solution_account_id,
+                                                    [(account_id, region) for account_id in accounts
+                                                     for region in event['Regions']], report)
+        report['listed'] = len(candidates)
+        vaulted_user_names = list_accounts_in_safe(pvwa_integration_class, pvwa_session_id, pvwa_url, key_pair_safe)
+        missing = [key_pair for key_pair in candidates if key_pair_user_name(*key_pair) not in vaulted_user_names]
+        report['already_vaulted'] = len(candidates) - len(missing)
+        logger.info(f'{len(missing)} of {len(candidates)} key pairs are missing in safe {key_pair_safe}')
+        vault_missing_key_pairs(missing, pvwa_integration_class, pvwa_session_id, pvwa_ip, key_pair_safe,
+                                bucket_name, prefix, deadline, report)
+    except Exception:
+        # The key pairs listed but not reached are left pending for a resumed run
+        reached = {tuple(key_pair) for name in ('vaulted', 'missing_key_material', 'failed', 'pending')
+                   for key_pair in report[name]}
+        report['pending'] += [list(key_pair) for key_pair in candidates if key_pair not in reached]
+        raise
+    finally:
+        pvwa_integration_class.logoff_pvwa(pvwa_url, pvwa_session_id)
+        report['complete'] = not any(report[name] for name in ('pending', 'failed', 'missing_key_material', 'list_errors'))
+        save_key_pair_import_report(bucket_name, prefix, report)
+    logger.info(f"Key pairs import summary: listed {report['listed']}, already vaulted {report['already_vaulted']}, "
+                f"vaulted {len(report['vaulted'])}, no key material {len(report['missing_key_material'])}, "
+                f"failed {len(report['failed'])}, pending {len(report['pending'])}")
+    return report
+
+
+def key_pair_user_name(account_id, region, key_pair_name):
+    # AWS.<AWS Account>.<Region name>.<key pair name>
+    return f"AWS.{account_id}.{region}.{key_pair_name}"
+
+
+# Lists the key pairs of the (account id, region) pairs, the pairs that could not be listed are added to the list_errors
+# of the report
+def list_key_pairs_in_accounts(solution_account_id, account_regions, report):
+    logger.trace(solution_account_id, account_regions, caller_name='list_key_pairs_in_accounts')
+    key_pairs = []
+    with ThreadPoolExecutor(max_workers=KEY_PAIR_IMPORT_WORKERS) as executor:
+        futures = {executor.submit(list_key_pairs, solution_account_id, account_id, region): (account_id, region)
+                   for account_id, region in account_regions}
+        for future in as_completed(futures):
+            account_id, region = futures[future]
+            try:
+                key_pairs += [(account_id, region, key_pair_name) for key_pair_name in future.result()]
+            except Exception as e:
+                logger.error(f'Failed to list key pairs of account {account_id} in {region}: {str(e)}')
+                report['list_errors'].append([account_id, region, str(e)])
+    return sorted(key_pairs)
+
+
+def list_key_pairs(solution_account_id, account_id, region):
+    logger.info(f'Listing key pairs of account {account_id} in {region}')
+    ec2_resource = aws_services.get_account_details(solution_account_id, account_id, region)
+    response = ec2_resource.meta.client.describe_key_pairs()
+    return [key_pair['KeyName'] for key_pair in response['KeyPairs']]
+
+
+# Returns the user names of all the accounts in the safe, reading the pages of the accounts list
+def list_accounts_in_safe(pvwa_integration_class, session, pvwa_url, safe_name, page_size=1000):
+    logger.trace(pvwa_integration_class, session, pvwa_url, safe_name, caller_name='list_accounts_in_safe')
+    header = dict(DEFAULT_HEADER, Authorization=session)
+    user_names = set()
+    offset = 0
+    while True:
+        url = f"{pvwa_url}/api/accounts?filter=safeName eq {safe_name}&limit={page_size}&offset={offset}"
+        rest_response = pvwa_integration_class.call_rest_api_get(url, header)
+        if rest_response is None or rest_response.status_code != requests.codes.ok:
+            raise Exception(f"Failed to list the accounts of safe {safe_name}")
+        page = rest_response.json()
+        user_names.update(account['userName'] for account in page['value'])
+        offset += len(page['value'])
+        if not page['value'] or offset >= page.get('count', 0):
+            return user_names
+
+
+def vault_missing_key_pairs(missing, pvwa_integration_class, session, pvwa_ip, safe_name, bucket_name, prefix, deadline,
+                            report):
+    def vault_key_pair(key_pair):
+        # Not started when the Lambda is about to time out, left for the next run
+        if not deadline.has_time_for(5):
+            return 'pending'
+        account_id, region, key_pair_name = key_pair
+        # A key pair failing is recorded in the report, it does not stop the others
+        try:
+            private_key = get_key_pair_material(bucket_name, prefix, account_id, region, key_pair_name)
+            if private_key is None:
+                return 'missing_key_material'
+            if create_key_pair_in_vault(pvwa_integration_class, session, key_pair_name, private_key, pvwa_ip, safe_name,
+                                        account_id, region):
+                return 'vaulted'
+        except Exception as e:
+            logger.error(f'Failed to vault key pair {key_pair_name} of account {account_id} in {region}: {str(e)}')
+        return 'failed'
+
+    with ThreadPoolExecutor(max_workers=KEY_PAIR_IMPORT_WORKERS) as executor:
+        for key_pair, result in zip(missing, executor.map(vault_key_pair, missing)):
+            report[result].append(list(key_pair))
+
+
+def get_key_pair_material(bucket_name, prefix, account_id, region, key_pair_name):
+    try:
+        s3_client = boto3.client('s3')
+        s3_object = s3_client.get_object(Bucket=bucket_name, Key=f'{prefix}{account_id}/{region}/{key_pair_name}.pem')
+        return s3_object['Body'].read().decode('utf-8')
+    except Exception as e:
+        logger.error(f'No key material for key pair {key_pair_name} of account {account_id} in {region}: {str(e)}')
+        return None
+
+
+def load_key_pair_import_report(bucket_name, prefix):
+    s3_client = boto3.client('s3')
+    s3_object = s3_client.get_object(Bucket=bucket_name, Key=f'{prefix}{KEY_PAIR_IMPORT_REPORT}')
+    return json.loads(s3_object['Body'].read().decode('utf-8'))
+
+
+def save_key_pair_import_report(bucket_name, prefix, report):
+    try:
+        s3_client = boto3.client('s3')
+        s3_client.put_object(Bucket=bucket_name, Key=f'{prefix}{KEY_PAIR_IMPORT_REPORT}', Body=json.dumps(report, indent=2))
+    except Exception as e:
+        logger.error(f'Failed to save the key pairs import report to S3: {str(e)}')
+
+
+def get_vault_parameters():
+    ssm = boto3.client('ssm')
+    response = ssm.get_parameters(
+        Names=['AOB_PVWA_IP', 'AOB_Vault_User', 'AOB_Vault_Pass', 'AOB_KeyPair_Safe', 'AOB_mode', 'AOB_PVWA_Verification_Key'],
+        WithDecryption=True
+    )
+    parameters = {parameter['Name']: parameter['Value'] for parameter in response['Parameters']}
+    if parameters.get('AOB_mode') == 'Production':
+        with open('/tmp/server.crt', 'w+') as crt:
+            crt.write(parameters['AOB_PVWA_Verification_Key'])
+    return parameters
@@ -0,0 +1,155 @@
+import time
+import threading
+import boto3
+from session_slots import SLOT_COUNT
+from dynamo_access import dynamo_access
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+CONCURRENCY_TABLE = 'Sessions'  # The limit is one item of the session slots table, next to the slot leases
+CONCURRENCY_NAME = 'pvwa_concurrency'
+TARGET_LATENCY_PARAM = 'AOB_PVWA_Target_Latency'  # Average PVWA response time in milliseconds above which the limit is lowered
+DEFAULT_TARGET_LATENCY_MS = 2000
+ERROR_RATE_THRESHOLD = 0.05  # Part of failed PVWA calls above which the limit is lowered
+MIN_LIMIT = 4
+MAX_LIMIT = SLOT_COUNT
+INCREASE_STEP = 1
+DECREASE_FACTOR = 0.5
+INCREASE_SECONDS = 5  # Time between two increases, over all the containers
+DECREASE_SECONDS = 10  # Time between two decreases, the containers seeing the same slowdown lower the limit once
+WINDOW_SECONDS = 10  # Time a container observes PVWA before it adjusts the limit
+WINDOW_MIN_CALLS = 5
+LIMIT_CACHE_SECONDS = 5
+logger = LogMechanism()
+
+
+def get_target_latency_seconds():
+    try:
+        ssm = boto3.client('ssm')
+        ssm_parameter = ssm.get_parameter(
+            Name=TARGET_LATENCY_PARAM
+        )
+        return int(ssm_parameter['Parameter']['Value']) / 1000.0
+    except Exception:
+        return DEFAULT_TARGET_LATENCY_MS / 1000.0
+
+
+# Number of session slots handed out, adjusted by every container from the PVWA calls it observed: the limit grows by
+# INCREASE_STEP while PVWA answers under the target latency and is halved when it gets slower or fails more calls.
+# The limit is shared through DynamoDB, the increases and decreases are paced with conditional updates so that all the
+# containers together step it at most once per INCREASE_SECONDS and DECREASE_SECONDS. A limit that cannot be read
+# keeps its last value
+class AdaptiveConcurrency:
+    def __init__(self, table_name=CONCURRENCY_TABLE, name=CONCURRENCY_NAME, min_limit=MIN_LIMIT, max_limit=MAX_LIMIT,
+                 clock=time.time):
+        self.table_name = table_name
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.clock = clock
+        self.dynamo_client = None
+        self.target_latency = None
+        self.lock = threading.Lock()
+        self.limit = max_limit
+        self.read_at = None
+        self.window = self.new_window()
+
+
+    def get_dynamo_client(self):
+        if not self.dynamo_client:
+            self.dynamo_client = dynamo_access.get_client()
+        return self.dynamo_client
+
+
+    def new_window(self):
+        return {'started_at': self.clock(), 'calls': 0, 'failures': 0, 'latency': 0.0}
+
+
+    # Called by PvwaIntegration for every PVWA call
+    def observe(self, seconds, failed):
+        with self.lock:
+            self.window['calls'] += 1
+            self.window['failures'] += 1 if failed else 0
+            self.window['latency'] += seconds
+
+
+    # The limit to apply to a new session, adjusted first when this container observed a full window
+    def get_limit(self):
+        with self.lock:
+            window = self.window
+            ready = window['calls'] >= WINDOW_MIN_CALLS and self.clock() - window['started_at'] >= WINDOW_SECONDS
+            if ready:
+                self.window = self.new_window()
+        if ready:
+            self.adjust(window)
+        elif self.read_at is None or self.clock() - self.read_at >= LIMIT_CACHE_SECONDS:
+            self.read()
+        return self.limit
+
+
+    def read(self):
+        try:
+            response = self.get_dynamo_client().get_item(TableName=self.table_name, Key={'name': {'S': self.name}},
+                                                         ConsistentRead=True)
+            item = response.get('Item', dict())
+            self.limit = int(item['limit']['N']) if 'limit' in item else self.max_limit
+        except Exception as e:
+            logger.error(f'Failed to read the PVWA session limit, keeping {self.limit}: {e}')
+        self.read_at = self.clock()
+        return self.limit
+
+
+    def adjust(self, window):
+        if self.target_latency is None:
+            self.target_latency = get_target_latency_seconds()
+        latency = window['latency'] / window['calls']
+        error_rate = window['failures'] / window['calls']
+        logger.trace(latency, error_rate, caller_name='AdaptiveConcurrency.adjust')
+        if error_rate > ERROR_RATE_THRESHOLD or latency > self.target_latency:
+            self.decrease(latency, error_rate)
+        else:
+            self.increase()
+
+
+    def increase(self):
+        now = self.clock()
+        # A missing limit is the maximum, there is nothing to increase until a decrease wrote it
+        self.update('SET #limit = #limit + :step, adjustedAt = :now',
+                    '#limit < :max AND adjustedAt < :increase_before',
+                    {':step': {'N': str(INCREASE_STEP)}, ':max': {'N': str(self.max_limit)}, ':now': {'N': str(now)},
+                     ':increase_before': {'N': str(now - INCREASE_SECONDS)}})
+
+
+    def decrease(self, latency, error_rate):
+        current = self.read()
+        limit = max(self.min_limit, int(current * DECREASE_FACTOR))
+        if limit == current:
+            return
+        now = self.clock()
+        if self.update('SET #limit = :limit, adjustedAt = :now, decreasedAt = :now',
+                       '(attribute_not_exists(#limit) OR #limit = :current) AND '
+                       '(attribute_not_exists(decreasedAt) OR decreasedAt < :decrease_before)',
+                       {':limit': {'N': str(limit)}, ':current': {'N': str(current)}, ':now': {'N': str(now)},
+                        ':decrease_before': {'N': str(now - DECREASE_SECONDS)}}):
+            logger.error(f'PVWA answered in {int(latency * 1000)}ms with {int(error_rate * 100)}% errors, '
+                         f'lowering the session limit from {current} to {limit}')
+
+
+    # Applies a conditional update of the limit, a failed condition means another container changed it first
+    def update(self, update_expression, condition, values):
+        try:
+            response = self.get_dynamo_client().update_item(
+                TableName=self.table_name, Key={'name': {'S': self.name}}, UpdateExpression=update_expression,
+                ConditionExpression=condition, ExpressionAttributeNames={'#limit': 'limit'},
+                ExpressionAttributeValues=values, ReturnValues='ALL_NEW')
+            self.limit = int(response['Attributes']['limit']['N'])
+            self.read_at = self.clock()
+            return True
+        except Exception as e:
+            if 'ConditionalCheckFailed' not in str(e):
+                logger.error(f'Failed to update the PVWA session limit: {e}')
+            self.read()
+            return False
+
+
+pvwa_concurrency = AdaptiveConcurrency()
@@ -1,16 +1,25 @@
 import json
+import copy
 import time
 import random
 import boto3
+from boto3.dynamodb.conditions import Key
 from log_mechanism import LogMechanism
-from dynamo_lock import LockerClient
+from metrics_mechanism import metrics
+from dynamo_access import dynamo_access
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+DYNAMO_BATCH_GET_LIMIT = 100  # Maximum number of keys in a single BatchGetItem call
+DYNAMO_BATCH_WRITE_LIMIT = 25  # Maximum number of requests in a single BatchWriteItem call
+DYNAMO_BATCH_ATTEMPTS = 5
+ROTATION_QUEUE_INDEX = 'RotationQueueIndex'  # Sparse index of the Instances rows waiting for a credential rotation
+UPDATED_AT = 'UpdatedAt'  # Epoch seconds of the last write of an Instances row, read by the incremental exports
 logger = LogMechanism()
 
 
 # return ec2 instance relevant data:
 # keyPair_name, instance_address, platform
+@metrics.timed('ec2_session')
 def get_account_details(solution_account_id, event_account_id, event_region):
     logger.trace(solution_account_id, event_region, event_account_id, caller_name='get_account_details')
     if event_account_id == solution_account_id:
@@ -46,6 +55,7 @@ def get_account_details(solution_account_id, event_account_id, event_region):
     return ec2_resource
 
 
+@metrics.timed('ec2_describe')
 def get_ec2_details(instance_id, ec2_object, event_account_id):
     logger.trace(instance_id, ec2_object, event_account_id, caller_name='get_ec2_details')
     logger.info(f'Gathering details about EC2 - {instance_id}')
@@ -73,15 +83,21 @@ def get_ec2_details(instance_id, ec2_object, event_account_id):
     details['platform'] = instance_resource.platform
     details['image_description'] = image_description
     details['aws_account_id'] = event_account_id
+    details['state'] = instance_resource.state['Name'] if instance_resource.state else None
+    details['image_id'] = instance_resource.image_id
+    details['vpc_id'] = instance_resource.vpc_id
+    details['subnet_id'] = instance_resource.subnet_id
+    details['tags'] = {tag['Key']: tag['Value'] for tag in instance_resource.tags or []}
     return details
 
 
 # Check on DynamoDB if instance exists
 # Return False when not found, or row data from table
+@metrics.timed('dynamo_get_instance')
 def get_instance_data_from_dynamo_table(instance_id):
     logger.trace(instance_id, caller_name='get_instance_data_from_dynamo_table')
     logger.info(f'Check with DynamoDB if instance {instance_id} exists')
-    dynamo_resource = boto3.client('dynamodb')
+    dynamo_resource = dynamo_access.get_client()
 
     try:
         dynamo_response = dynamo_resource.get_item(TableName='Instances', Key={"InstanceId": {"S": instance_id}})
@@ -97,6 +113,36 @@ def get_instance_data_from_dynamo_table(instance_id):
     return False
 
 
+# Reads the Instances rows of many instances with BatchGetItem, unprocessed keys are read again with a backoff.
+# Returns a dictionary of instance id to row data, instances without a row are not in it
+@metrics.timed('dynamo_batch_get_instances')
+def get_instances_data_from_dynamo_table(instance_ids):
+    logger.trace(instance_ids, caller_name='get_instances_data_from_dynamo_table')
+    logger.info(f'Reading {len(instance_ids)} instances from DynamoDB')
+    dynamo_client = dynamo_access.get_client()
+    instance_ids = list(instance_ids)
+    rows = dict()
+    try:
+        for index in range(0, len(instance_ids), DYNAMO_BATCH_GET_LIMIT):
+            request_items = {'Instances': {'Keys': [{"InstanceId": {"S": instance_id}}
+                                                    for instance_id in instance_ids[index:index + DYNAMO_BATCH_GET_LIMIT]]}}
+            for attempt in range(DYNAMO_BATCH_ATTEMPTS):
+                dynamo_response = dynamo_client.batch_get_item(RequestItems=request_items)
+                for item in dynamo_response['Responses'].get('Instances', []):
+                    rows[item['InstanceId']['S']] = item
+                request_items = dynamo_response.get('UnprocessedKeys')
+                if not request_items:
+                    break
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+            else:
+                raise Exception('Unprocessed keys left after the last attempt')
+    except Exception as e:
+        logger.error(f"Error occurred when trying to read instances from DynamoDB: {e}")
+        raise Exception(f"Exception on get_instances_data_from_dynamo_table: {str(e)}")
+    return rows
+
+
+@metrics.timed('param_store')
 def get_params_from_param_store():
     # Parameters that will be retrieved from parameter store
     logger.info('Getting parameters from parameter store')
@@ -153,20 +199,28 @@ def get_params_from_param_store():
     return store_parameters_class
 
 
-def put_instance_to_dynamo_table(instance_id, ip_address, on_board_status, on_board_error="None", log_name="None"):
-    logger.trace(instance_id, ip_address, on_board_status, on_board_error, log_name, caller_name='put_instance_to_dynamo_table')
+# vault_details (VaultAccountId, SafeName, Platform, UserName, ImageId) is stored with onboarded instances,
+# the termination of the instance then needs no EC2 describe or vault search
+@metrics.timed('dynamo_put_instance')
+def put_instance_to_dynamo_table(instance_id, ip_address, on_board_status, on_board_error="None", log_name="None",
+                                 vault_details=None):
+    logger.trace(instance_id, ip_address, on_board_status, on_board_error, log_name, vault_details,
+                 caller_name='put_instance_to_dynamo_table')
     logger.info(f'Adding  {instance_id} to DynamoDB')
-    dynamodb_resource = boto3.resource('dynamodb')
-    instances_table = dynamodb_resource.Table("Instances")
+    instances_table = dynamo_access.get_table("Instances")
+    item = {
+        'InstanceId': instance_id,
+        'Address': ip_address,
+        'Status': on_board_status,
+        'Error': on_board_error,
+        'LogId': log_name,
+        UPDATED_AT: int(time.time())
+    }
+    if vault_details:
+        item.update({key: value for key, value in vault_details.items() if value})
     try:
         instances_table.put_item(
-            Item={
-                'InstanceId': instance_id,
-                'Address': ip_address,
-                'Status': on_board_status,
-                'Error': on_board_error,
-                'LogId': log_name
-            }
+            Item=item
         )
     except Exception:
         logger.error('Exception occurred on add item to DynamoDB')
@@ -176,27 +230,11 @@ def put_instance_to_dynamo_table(instance_id, ip_address, on_board_status, on_bo
     return True
 
 
-def release_session_on_dynamo(session_id, session_guid, sessions_table_lock_client=False):
-    logger.trace(session_id, session_guid, caller_name='release_session_on_dynamo')
-    logger.info('Releasing session lock from DynamoDB')
-    try:
-        if not sessions_table_lock_client:
-            sessions_table_lock_client = LockerClient('Sessions')
-        sessions_table_lock_client.locked = True
-        sessions_table_lock_client.guid = session_guid
-        sessions_table_lock_client.release(session_id)
-    except Exception as e:
-        logger.error(f'Failed to release session lock from DynamoDB: {str(e)}')
-        return False
-
-    return True
-
-
+@metrics.timed('dynamo_remove_instance')
 def remove_instance_from_dynamo_table(instance_id):
     logger.trace(instance_id, caller_name='remove_instance_from_dynamo_table')
     logger.info(f'Removing {instance_id} from DynamoDB')
-    dynamodb_resource = boto3.resource('dynamodb')
-    instances_table = dynamodb_resource.Table("Instances")
+    instances_table = dynamo_access.get_table("Instances")
     try:
         instances_table.delete_item(
             Key={
@@ -211,38 +249,39 @@ def remove_instance_from_dynamo_table(instance_id):
     return True
 
 
-def get_session_from_dynamo(sessions_table_lock_client=False):
-    logger.info("Getting available Session from DynamoDB")
-    if not sessions_table_lock_client:
-        sessions_table_lock_client = LockerClient('Sessions')
-
-    timeout = 20000  # Setting the timeout to 20 seconds on a row lock
-    random_session_number = str(random.randint(1, 100))  # A number between 1 and 100
-
+# Removes the Instances rows of many instances with BatchWriteItem, unprocessed items are written again with a backoff
+@metrics.timed('dynamo_batch_remove_instances')
+def remove_instances_from_dynamo_table(instance_ids):
+    logger.trace(instance_ids, caller_name='remove_instances_from_dynamo_table')
+    logger.info(f'Removing {len(instance_ids)} instances from DynamoDB')
+    dynamo_client = dynamo_access.get_client()
+    instance_ids = list(instance_ids)
     try:
-        for i in range(0, 20):
-
-            lock_response = sessions_table_lock_client.acquire(random_session_number, timeout)
-            if lock_response:  # no lock on connection number, return it
-                logger.info("Successfully retrieved session from DynamoDB")
-                return random_session_number, sessions_table_lock_client.guid
-            else:  # connection number is locked, retry in 5 seconds
-                time.sleep(5)
-                continue
-        #  if reached here, 20 retries with 5 seconds between retry - ended
-        logger.info("Connection limit has been reached")
-        return False, ""
+        for index in range(0, len(instance_ids), DYNAMO_BATCH_WRITE_LIMIT):
+            request_items = {'Instances': [{'DeleteRequest': {'Key': {"InstanceId": {"S": instance_id}}}}
+                                           for instance_id in instance_ids[index:index + DYNAMO_BATCH_WRITE_LIMIT]]}
+            for attempt in range(DYNAMO_BATCH_ATTEMPTS):
+                dynamo_response = dynamo_client.batch_write_item(RequestItems=request_items)
+                request_items = dynamo_response.get('UnprocessedItems')
+                if not request_items:
+                    break
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+            else:
+                raise Exception('Unprocessed items left after the last attempt')
     except Exception as e:
-        print(f"Failed to retrieve session from DynamoDB: {str(e)}")
-        raise Exception(f"Exception on get_session_from_dynamo:{str(e)}")
+        logger.error(f'Exception occurred on removing instances from DynamoDB:\n{str(e)}')
+        return False
+
+    logger.info(f'{len(instance_ids)} items successfully deleted from DB')
+    return True
 
 
+@metrics.timed('dynamo_update_instance')
 def update_instances_table_status(instance_id, status, error="None"):
     logger.trace(instance_id, status, error, caller_name='update_instances_table_status')
     logger.info(f'Updating DynamoDB with {instance_id} onboarding status. \nStatus: {status}')
     try:
-        dynamodb_resource = boto3.resource('dynamodb')
-        instances_table = dynamodb_resource.Table("Instances")
+        instances_table = dynamo_access.get_table("Instances")
         instances_table.update_item(
             Key={
                 'InstanceId': instance_id
@@ -255,6 +294,10 @@ def update_instances_table_status(instance_id, status, error="None"):
                 'Error': {
                     "Value": error,
                     "Action": "PUT"
+                },
+                UPDATED_AT: {
+                    "Value": int(time.time()),
+                    "Action": "PUT"
                 }
             }
         )
@@ -265,6 +308,69 @@ def update_instances_table_status(instance_id, status, error="None"):
     return True
 
 
+# Instances rows of a rotation queue ordered by RotationDueAt, only the rows due at due_before when it is given.
+# Reads the pages of the index until limit rows were read
+@metrics.timed('dynamo_query_rotations')
+def get_rotation_queue(queue, due_before=None, limit=None):
+    logger.trace(queue, due_before, limit, caller_name='get_rotation_queue')
+    instances_table = dynamo_access.get_table("Instances")
+    key_condition = Key('RotationQueue').eq(queue)
+    if due_before is not None:
+        key_condition = key_condition & Key('RotationDueAt').lte(int(due_before))
+    query_arguments = {'IndexName': ROTATION_QUEUE_INDEX, 'KeyConditionExpression': key_condition}
+    items = []
+    try:
+        while True:
+            if limit:
+                query_arguments['Limit'] = limit - len(items)
+            dynamo_response = instances_table.query(**query_arguments)
+            items += dynamo_response.get('Items', [])
+            if 'LastEvaluatedKey' not in dynamo_response or (limit and len(items) >= limit):
+                return items
+            query_arguments['ExclusiveStartKey'] = dynamo_response['LastEvaluatedKey']
+    except Exception as e:
+        logger.error(f"Error occurred when trying to read the {queue} rotations from DynamoDB: {e}")
+        raise Exception(f"Exception on get_rotation_queue: {str(e)}")
+
+
+# Sets and removes rotation attributes of an Instances row. The row of an instance offboarded in the meantime is not
+# created again, False is returned for it
+@metrics.timed('dynamo_update_rotation')
+def update_instance_rotation(instance_id, attributes, removed_attributes=()):
+    logger.trace(instance_id, attributes, removed_attributes, caller_name='update_instance_rotation')
+    attributes = dict(attributes, **{UPDATED_AT: int(time.time())})
+    names = dict()
+    values = dict()
+    set_actions = []
+    for index, (name, value) in enumerate(attributes.items()):
+        names[f'#s{index}'] = name
+        values[f':s{index}'] = value
+        set_actions.append(f'#s{index} = :s{index}')
+    remove_actions = []
+    for index, name in enumerate(removed_attributes):
+        names[f'#r{index}'] = name
+        remove_actions.append(f'#r{index}')
+    update_expression = ''
+    if set_actions:
+        update_expression = 'SET ' + ', '.join(set_actions)
+    if remove_actions:
+        update_expression += ' REMOVE ' + ', '.join(remove_actions)
+    update_arguments = {'Key': {'InstanceId': instance_id}, 'UpdateExpression': update_expression.strip(),
+                        'ExpressionAttributeNames': names, 'ConditionExpression': 'attribute_exists(InstanceId)'}
+    if values:
+        update_arguments['ExpressionAttributeValues'] = values
+    try:
+        instances_table = dynamo_access.get_table("Instances")
+        instances_table.update_item(**update_arguments)
+    except Exception as e:
+        if 'ConditionalCheckFailed' in str(e):
+            logger.info(f'{instance_id} is no longer in DynamoDB, rotation not updated')
+            return False
+        logger.error(f'Exception occurred on updating the rotation of {instance_id} on DynamoDB {e}')
+        return False
+    return True
+
+
 class StoreParameters:
     unix_safe_name = ""
     windows_safe_name = ""
@@ -282,8 +388,18 @@ class StoreParameters:
         self.windows_safe_name = windows_safe_name
         self.vault_username = username
         self.vault_password = password
-        self.pvwa_url = f"https://{ip}/PasswordVault"
+        # AOB_PVWA_IP may list the nodes of a PVWA farm separated by commas, pvwa_url is the first one until a session
+        # pins the parameters to the node it was opened on
+        self.pvwa_urls = [f"https://{address.strip()}/PasswordVault" for address in ip.split(',') if address.strip()] or \
+            [f"https://{ip}/PasswordVault"]
+        self.pvwa_url = self.pvwa_urls[0]
         self.key_pair_safe_name = key_pair_safe
         self.pvwa_verification_key = pvwa_verification_key
         self.aob_mode = mode
         self.debug_level = debug
+
+
+    def pinned_to(self, pvwa_url):
+        pinned = copy.copy(self)
+        pinned.pvwa_url = pvwa_url
+        return pinned
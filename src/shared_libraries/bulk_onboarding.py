@@ -0,0 +1,168 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import aws_services
+import pvwa_api_calls
+import instance_processing
+import credential_rotation
+from safe_sharding import safe_sharding
+from log_mechanism import LogMechanism
+from metrics_mechanism import metrics
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+BULK_ONBOARDING_PARAM = 'AOB_Bulk_Onboarding'
+BULK_ONBOARDING_ENABLED = 'Enabled'
+BULK_JOB_MAX_ACCOUNTS = 500  # Accounts submitted in a single bulk upload job
+BULK_JOB_POLL_SECONDS = 2
+BULK_RESULT_SECONDS = 30  # Time kept for writing the results of a job to the Instances table
+BULK_SEARCH_WORKERS = 10  # Account id searches running at the same time over the shared session
+BULK_JOB_DONE_STATUSES = ('completed', 'completedwitherrors', 'failed')
+BULK_ACCOUNT_EXISTS = 'exist'  # Part of the error of an account that is already in the vault
+logger = LogMechanism()
+
+
+# Bulk onboarding is off unless AOB_Bulk_Onboarding is set to 'Enabled'
+def get_bulk_onboarding_enabled():
+    try:
+        ssm = boto3.client('ssm')
+        ssm_parameter = ssm.get_parameter(
+            Name=BULK_ONBOARDING_PARAM
+        )
+        return ssm_parameter['Parameter']['Value'].lower() == BULK_ONBOARDING_ENABLED.lower()
+    except Exception:
+        return False
+
+
+# Request body entry of an account in a bulk upload job
+def build_bulk_account(instance_details, instance_account):
+    return {"name": instance_account['name'],
+            "address": instance_details['address'],
+            "userName": instance_account['username'],
+            "platformId": instance_account['platform'],
+            "safeName": instance_account['safe_name'],
+            "secretType": "key" if instance_account['platform'] == instance_processing.UNIX_PLATFORM else "password",
+            "secret": instance_account['secret'],
+            "secretManagement": {"automaticManagementEnabled": True}}
+
+
+def get_item_index(item):
+    return item.get('itemIndex', item.get('ItemIndex'))
+
+
+# Collects the accounts of the running instances of a batch and creates them with one bulk upload job per safe and
+# platform instead of one account creation per instance. The key pair accounts read from the vault are kept for the
+# batch, the instances of a fleet usually share their key pair
+class BulkOnboarding:
+    def __init__(self, vault_session, deadline, log_name):
+        self.vault_session = vault_session
+        self.deadline = deadline
+        self.log_name = log_name
+        self.groups = dict()
+        self.key_pair_values = dict()
+
+
+    def add(self, instance_id, instance_details, instance_account):
+        group = (instance_account['safe_name'], instance_account['platform'])
+        self.groups.setdefault(group, []).append((instance_id, instance_details, instance_account))
+
+
+    def __len__(self):
+        return sum(len(pending) for pending in self.groups.values())
+
+
+    # Runs the jobs of the collected accounts. Returns a dictionary of instance id to True when the instance is done
+    # (onboarded or recorded as failed) and False when its event should be retried
+    @metrics.timed('bulk_onboard')
+    def submit(self):
+        logger.info(f'Bulk onboarding {len(self)} instances in {len(self.groups)} jobs')
+        results = dict()
+        for (safe_name, platform), pending in self.groups.items():
+            for index in range(0, len(pending), BULK_JOB_MAX_ACCOUNTS):
+                chunk = pending[index:index + BULK_JOB_MAX_ACCOUNTS]
+                try:
+                    results.update(self.run_job(safe_name, platform, chunk))
+                except Exception as e:
+                    logger.error(f'Bulk upload to {safe_name} failed: {e}')
+                    results.update({instance_id: False for instance_id, _, _ in chunk})
+        self.groups = dict()
+        return results
+
+
+    def run_job(self, safe_name, platform, pending):
+        session_token = self.vault_session.get_token()
+        if not session_token:
+            return {instance_id: False for instance_id, _, _ in pending}
+        pvwa_url = self.vault_session.store_parameters_class.pvwa_url
+        if not safe_sharding.ensure_safe(session_token, safe_name, pending[0][2]['base_safe_name'], pvwa_url):
+            return {instance_id: False for instance_id, _, _ in pending}
+        job_id = pvwa_api_calls.create_bulk_accounts_job(session_token, [build_bulk_account(instance_details, account)
+                                                                         for _, instance_details, account in pending],
+                                                         pvwa_url)
+        if not job_id:
+            return {instance_id: False for instance_id, _, _ in pending}
+        job = self.wait_for_job(session_token, job_id, pvwa_url)
+        if not job:
+            logger.error(f'Bulk upload job {job_id} of {safe_name} did not complete in time, its events are retried')
+            return {instance_id: False for instance_id, _, _ in pending}
+        job_result = job.get('Result') or dict()
+        outcomes = dict()
+        for item in job_result.get('succeeded', []):
+            outcomes[get_item_index(item)] = (True, item.get('accountId') or item.get('id'))
+        for item in job_result.get('failed', []):
+            outcomes[get_item_index(item)] = (False, str(item.get('error', 'Unknown error')))
+        if not outcomes:
+            # A job failing as a whole has no per-account result, nothing is known about its accounts
+            logger.error(f"Bulk upload job {job_id} ended with status {job.get('Status')} and no results")
+            return {instance_id: False for instance_id, _, _ in pending}
+        logger.info(f"Bulk upload job {job_id} of {safe_name}: {len(job_result.get('succeeded', []))} created, "
+                    f"{len(job_result.get('failed', []))} failed")
+        results = dict()
+        to_resolve = []
+        for position, (instance_id, instance_details, account) in enumerate(pending):
+            succeeded, value = outcomes.get(position, (False, 'No result in the bulk upload job'))
+            if succeeded:
+                to_resolve.append((instance_id, instance_details, account, value, True))
+            elif BULK_ACCOUNT_EXISTS in value.lower():
+                # Created by an earlier attempt of the event or by the single account mode
+                to_resolve.append((instance_id, instance_details, account, None, False))
+            else:
+                logger.error(f'Failed to create the account of {instance_id}: {value}')
+                aws_services.put_instance_to_dynamo_table(instance_id, instance_details['address'],
+                                                          instance_processing.OnBoardStatus.on_boarded_failed, value,
+                                                          self.log_name)
+                results[instance_id] = True
+        with ThreadPoolExecutor(max_workers=BULK_SEARCH_WORKERS) as executor:
+            for instance_id, result in executor.map(lambda entry: self.record_account(session_token, pvwa_url, *entry),
+                                                    to_resolve):
+                results[instance_id] = result
+        return results
+
+
+    def wait_for_job(self, session_token, job_id, pvwa_url):
+        while True:
+            job = pvwa_api_calls.get_bulk_accounts_job(session_token, job_id, pvwa_url)
+            if job and str(job.get('Status', '')).lower() in BULK_JOB_DONE_STATUSES:
+                return job
+            if not self.deadline.has_time_for(BULK_JOB_POLL_SECONDS + BULK_RESULT_SECONDS):
+                return None
+            time.sleep(BULK_JOB_POLL_SECONDS)
+
+
+    # Writes the Instances row of an account of the job, the account id is searched when the job result has none
+    def record_account(self, session_token, pvwa_url, instance_id, instance_details, account, account_id, created):
+        if not account_id:
+            try:
+                account_id = pvwa_api_calls.retrieve_account_id_from_account_name(
+                    session_token, f"{instance_details['address']},{account['username']}", account['safe_name'], instance_id,
+                    pvwa_url)
+            except Exception as e:
+                logger.error(f'Failed to find the account of {instance_id}: {e}')
+                return instance_id, False
+        vault_details = instance_processing.get_vault_details(account_id, account['safe_name'], account['platform'],
+                                                              account['username'], instance_details)
+        if created and account_id:
+            vault_details.update(credential_rotation.get_pending_rotation())
+        aws_services.put_instance_to_dynamo_table(instance_id, instance_details['address'],
+                                                  instance_processing.OnBoardStatus.on_boarded, "None", self.log_name,
+                                                  vault_details)
+        return instance_id, True
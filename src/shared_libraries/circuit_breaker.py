@@ -0,0 +1,192 @@
+import json
+import time
+import boto3
+from dynamo_access import dynamo_access
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+CIRCUIT_TABLE = 'Sessions'  # The breaker is one item of the session slots table, next to the slot locks
+CIRCUIT_NAME = 'pvwa_circuit'
+PARKED_EVENTS_TABLE = 'ParkedEvents'
+FAILURE_THRESHOLD = 5  # Consecutive PVWA failures, over all the containers, that open the circuit
+OPEN_SECONDS = 60  # Time the circuit stays open before a single probe is let through
+LEASE_SECONDS = 120  # Time a probe or a re-drive holds its lease, a lease of a stopped container expires
+REDRIVE_LIMIT = 100  # Parked events re-driven by a single invocation
+logger = LogMechanism()
+
+
+class CircuitState:
+    closed = "closed"
+    open = "open"
+
+
+# Circuit breaker of the PVWA calls shared by all the containers through DynamoDB. It opens after FAILURE_THRESHOLD
+# consecutive failures, the events arriving while it is open are parked without taking a session slot or calling PVWA.
+# After OPEN_SECONDS a single caller wins the probe lease and is let through, its success closes the circuit and its
+# failure opens it again. Once closed, the parked events are re-driven by the callers winning the re-drive lease.
+# A breaker that cannot be read lets the calls through
+class CircuitBreaker:
+    def __init__(self, table_name=CIRCUIT_TABLE, name=CIRCUIT_NAME, failure_threshold=FAILURE_THRESHOLD,
+                 open_seconds=OPEN_SECONDS, clock=time.time):
+        self.table_name = table_name
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self.dynamo_client = None
+        self.lambda_client = None
+        self.item = dict()
+        self.probing = False
+
+
+    def get_dynamo_client(self):
+        if not self.dynamo_client:
+            self.dynamo_client = dynamo_access.get_client()
+        return self.dynamo_client
+
+
+    def read(self):
+        try:
+            response = self.get_dynamo_client().get_item(TableName=self.table_name, Key={'name': {'S': self.name}},
+                                                         ConsistentRead=True)
+        except Exception as e:
+            logger.error(f'Failed to read the PVWA circuit breaker, letting the call through: {e}')
+            return dict()
+        item = response.get('Item', dict())
+        self.item = {'state': item.get('circuitState', {}).get('S', CircuitState.closed),
+                     'failures': int(item.get('failures', {}).get('N', 0)),
+                     'opened_at': float(item.get('openedAt', {}).get('N', 0)),
+                     'parked': int(item.get('parked', {}).get('N', 0))}
+        return self.item
+
+
+    def allow_request(self):
+        self.probing = False
+        item = self.read()
+        if item.get('state', CircuitState.closed) == CircuitState.closed:
+            return True
+        if self.clock() < item['opened_at'] + self.open_seconds:
+            logger.info('PVWA circuit is open, failing fast')
+            return False
+        self.probing = self.acquire_lease('probeUntil', "circuitState = :open", {':open': {'S': CircuitState.open}})
+        if self.probing:
+            logger.info('PVWA circuit is open, this call is the probe')
+        return self.probing
+
+
+    # Takes a lease attribute of the breaker item with a conditional update, only one caller holds it at a time
+    def acquire_lease(self, attribute, condition, values):
+        now = self.clock()
+        values = dict(values, **{':now': {'N': str(now)}, ':until': {'N': str(now + LEASE_SECONDS)}})
+        try:
+            self.get_dynamo_client().update_item(
+                TableName=self.table_name, Key={'name': {'S': self.name}},
+                UpdateExpression=f'SET {attribute} = :until',
+                ConditionExpression=f'{condition} AND (attribute_not_exists({attribute}) OR {attribute} < :now)',
+                ExpressionAttributeValues=values)
+            return True
+        except Exception as e:
+            if 'ConditionalCheckFailed' not in str(e):
+                logger.error(f'Failed to update the PVWA circuit breaker: {e}')
+            return False
+
+
+    # Only writes when the last read saw failures or this call was the probe, a healthy PVWA costs one read per call
+    def record_success(self):
+        if not self.probing and not self.item.get('failures') and self.item.get('state') != CircuitState.open:
+            return
+        if self.probing:
+            logger.info('PVWA probe succeeded, closing the circuit')
+        try:
+            self.get_dynamo_client().update_item(
+                TableName=self.table_name, Key={'name': {'S': self.name}},
+                UpdateExpression='SET circuitState = :closed, failures = :zero REMOVE probeUntil',
+                ExpressionAttributeValues={':closed': {'S': CircuitState.closed}, ':zero': {'N': '0'}})
+            self.item.update({'state': CircuitState.closed, 'failures': 0})
+        except Exception as e:
+            logger.error(f'Failed to close the PVWA circuit breaker: {e}')
+        self.probing = False
+
+
+    def record_failure(self):
+        try:
+            response = self.get_dynamo_client().update_item(
+                TableName=self.table_name, Key={'name': {'S': self.name}},
+                UpdateExpression='ADD failures :one', ExpressionAttributeValues={':one': {'N': '1'}},
+                ReturnValues='ALL_NEW')
+            attributes = response['Attributes']
+            failures = int(attributes['failures']['N'])
+            state = attributes.get('circuitState', {}).get('S', CircuitState.closed)
+            if self.probing or (state == CircuitState.closed and failures >= self.failure_threshold):
+                logger.error(f'PVWA failed {failures} consecutive times, opening the circuit for {self.open_seconds} '
+                             f'seconds')
+                self.get_dynamo_client().update_item(
+                    TableName=self.table_name, Key={'name': {'S': self.name}},
+                    UpdateExpression='SET circuitState = :open, openedAt = :now REMOVE probeUntil',
+                    ExpressionAttributeValues={':open': {'S': CircuitState.open}, ':now': {'N': str(self.clock())}})
+        except Exception as e:
+            logger.error(f'Failed to record the PVWA failure on the circuit breaker: {e}')
+        self.probing = False
+
+
+    # Keeps an event that arrived while the circuit is open, returns False when it could not be parked
+    def park(self, event_id, message):
+        logger.info(f'Parking event {event_id} until PVWA is available')
+        try:
+            self.get_dynamo_client().put_item(TableName=PARKED_EVENTS_TABLE,
+                                              Item={'EventId': {'S': event_id}, 'Message': {'S': json.dumps(message)},
+                                                    'ParkedAt': {'N': str(int(self.clock()))}})
+            self.get_dynamo_client().update_item(TableName=self.table_name, Key={'name': {'S': self.name}},
+                                                 UpdateExpression='ADD parked :one',
+                                                 ExpressionAttributeValues={':one': {'N': '1'}})
+        except Exception as e:
+            logger.error(f'Failed to park event {event_id}: {e}')
+            return False
+        return True
+
+
+    # Whether the last read saw parked events while the circuit is closed and this call won the re-drive lease
+    def claim_redrive(self):
+        if self.item.get('state') != CircuitState.closed or not self.item.get('parked'):
+            return False
+        return self.acquire_lease('redriveUntil', "circuitState = :closed", {':closed': {'S': CircuitState.closed}})
+
+
+    # Invokes the function asynchronously with each parked event as an SNS record and removes it from the parked events
+    def redrive(self, function_arn, deadline, limit=REDRIVE_LIMIT):
+        if not self.lambda_client:
+            self.lambda_client = boto3.client('lambda')
+        response = self.get_dynamo_client().scan(TableName=PARKED_EVENTS_TABLE, Limit=limit, ConsistentRead=True)
+        redriven = 0
+        for item in response.get('Items', []):
+            if not deadline.has_time_for(1):
+                break
+            event_id = item['EventId']['S']
+            self.lambda_client.invoke(FunctionName=function_arn, InvocationType='Event',
+                                      Payload=json.dumps(build_redrive_event(event_id, item['Message']['S'])))
+            self.get_dynamo_client().delete_item(TableName=PARKED_EVENTS_TABLE, Key={'EventId': {'S': event_id}})
+            redriven += 1
+        if 'LastEvaluatedKey' in response or redriven < len(response.get('Items', [])):
+            # Events parked in the meantime keep adding to the count, it is only lowered by the re-driven ones
+            update_expression = 'ADD parked :redriven REMOVE redriveUntil'
+            values = {':redriven': {'N': str(-redriven)}}
+        else:
+            update_expression = 'SET parked = :zero REMOVE redriveUntil'
+            values = {':zero': {'N': '0'}}
+        self.get_dynamo_client().update_item(TableName=self.table_name, Key={'name': {'S': self.name}},
+                                             UpdateExpression=update_expression, ExpressionAttributeValues=values)
+        logger.info(f'{redriven} parked events re-driven')
+        return redriven
+
+
+# SNS shaped event of a parked message, accepted by both the direct and the queue-backed handlers
+def build_redrive_event(event_id, message):
+    return {'Records': [{'EventSource': 'aws:sns', 'Sns': {'MessageId': event_id, 'Message': message}}]}
+
+
+# Parked events of an instance replace each other only when they are the same event
+def get_event_id(data):
+    return f'{data["detail"]["instance-id"]}:{data["detail"]["state"]}:{data.get("time", "")}'
+
+
+pvwa_circuit = CircuitBreaker()
@@ -0,0 +1,197 @@
+import time
+import boto3
+import aws_services
+import pvwa_api_calls
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+ROTATION_RATE_PARAM = 'AOB_Rotation_Rate'  # Rotations requested per minute, over all the safes
+ROTATION_SAFE_CONCURRENCY_PARAM = 'AOB_Rotation_Safe_Concurrency'  # Rotations in progress at the same time in a safe
+ROTATION_MIN_AGE_PARAM = 'AOB_Rotation_Min_Age'  # Seconds an instance is left to finish booting before its rotation
+ROTATION_MAX_FAILURES_PARAM = 'AOB_Rotation_Max_Failures'  # Failed attempts after which a rotation is given up
+DEFAULT_ROTATION_CONFIG = {ROTATION_RATE_PARAM: 30,
+                           ROTATION_SAFE_CONCURRENCY_PARAM: 5,
+                           ROTATION_MIN_AGE_PARAM: 300,
+                           ROTATION_MAX_FAILURES_PARAM: 5}
+ROTATION_RUN_SECONDS = 55  # A run ends before the next scheduled run starts
+ROTATION_RESULT_SECONDS = 120  # Time CPM is given before a failure status is attributed to the requested change
+ROTATION_TIMEOUT_SECONDS = 1800  # A requested change that did not complete by then counts as a failed attempt
+ROTATION_RETRY_SECONDS = 300  # Backoff after the first failed attempt, doubled on each further failure
+ROTATION_MAX_RETRY_SECONDS = 3600
+CPM_SUCCESS = 'success'
+CPM_FAILURE = 'failure'
+logger = LogMechanism()
+
+
+# Instances table attributes of a rotation: RotationQueue is the hash key of the sparse RotationQueueIndex and is
+# removed once the rotation completed or was given up, RotationDueAt orders the queue
+class RotationStatus:
+    pending = "pending"
+    dispatched = "dispatched"
+    rotated = "rotated"
+    failed = "failed"
+
+
+# Attributes recorded on the Instances row of a newly onboarded account, the scheduler requests the change later
+def get_pending_rotation(now=None):
+    return {'RotationQueue': RotationStatus.pending,
+            'RotationStatus': RotationStatus.pending,
+            'RotationDueAt': int(now or time.time())}
+
+
+# Rotation settings from parameter store, a missing or invalid parameter keeps its default
+def get_rotation_config():
+    config = dict(DEFAULT_ROTATION_CONFIG)
+    try:
+        ssm = boto3.client('ssm')
+        ssm_response = ssm.get_parameters(Names=list(DEFAULT_ROTATION_CONFIG))
+        for parameter in ssm_response['Parameters']:
+            try:
+                config[parameter['Name']] = max(0, int(parameter['Value']))
+            except ValueError:
+                logger.error(f"Invalid value of {parameter['Name']}, using {config[parameter['Name']]}")
+    except Exception as e:
+        logger.error(f'Failed to read the rotation parameters, using the defaults: {e}')
+    return config
+
+
+# Token bucket limiting the rate of the change requests, acquire waits for a token as long as the deadline allows
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.updated_at = clock()
+
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+
+    def acquire(self, deadline):
+        self.refill()
+        if self.tokens < 1:
+            if not self.rate_per_second:
+                return False
+            wait_seconds = (1 - self.tokens) / self.rate_per_second
+            if not deadline.has_time_for(wait_seconds):
+                return False
+            self.sleep(wait_seconds)
+            self.refill()
+        self.tokens -= 1
+        return True
+
+
+# Requests the CPM change of the onboarded accounts outside of the onboarding. Each run first follows up the changes in
+# progress, then requests the due ones: no faster than the global rate, with at most safe_concurrency changes in progress
+# per safe and only for instances older than the minimum age. Failed attempts are counted on the Instances row and are
+# retried with a backoff until max_failures
+class RotationScheduler:
+    def __init__(self, vault_session, config, deadline, clock=time.time, sleep=time.sleep):
+        self.vault_session = vault_session
+        self.config = config
+        self.deadline = deadline
+        self.clock = clock
+        self.bucket = TokenBucket(config[ROTATION_RATE_PARAM] / 60.0, sleep=sleep)
+        self.in_progress = dict()
+        self.summary = {'rotated': 0, 'failed': 0, 'given_up': 0, 'dispatched': 0, 'deferred': 0}
+
+
+    def run(self):
+        logger.trace(self.config, caller_name='RotationScheduler.run')
+        dispatched = aws_services.get_rotation_queue(RotationStatus.dispatched)
+        due = aws_services.get_rotation_queue(RotationStatus.pending,
+                                              due_before=self.clock() - self.config[ROTATION_MIN_AGE_PARAM],
+                                              limit=self.get_run_budget() * 2)
+        if not dispatched and not due:
+            logger.info('No credential rotation to follow up or request')
+            return self.summary
+        session_token = self.vault_session.get_token()
+        if not session_token:
+            raise Exception('Failed to logon to PVWA, rotations are left for the next run')
+        pvwa_url = self.vault_session.store_parameters_class.pvwa_url
+        for item in dispatched:
+            self.follow_up(item, session_token, pvwa_url)
+        for index, item in enumerate(due):
+            safe_name = item.get('SafeName')
+            if self.in_progress.get(safe_name, 0) >= self.config[ROTATION_SAFE_CONCURRENCY_PARAM]:
+                self.summary['deferred'] += 1
+                continue
+            if not self.deadline.has_time_for(0) or not self.bucket.acquire(self.deadline):
+                self.summary['deferred'] += len(due) - index
+                break
+            self.dispatch(item, session_token, pvwa_url)
+        logger.info(f'Credential rotation run: {self.summary}')
+        return self.summary
+
+
+    # Largest number of changes a run can request at the configured rate
+    def get_run_budget(self):
+        run_seconds = min(ROTATION_RUN_SECONDS, self.deadline.remaining_seconds())
+        return max(1, int(self.config[ROTATION_RATE_PARAM] * run_seconds / 60.0) + 1)
+
+
+    def dispatch(self, item, session_token, pvwa_url):
+        instance_id = item['InstanceId']
+        if pvwa_api_calls.rotate_credentials_immediately(session_token, pvwa_url, item['VaultAccountId'], instance_id):
+            aws_services.update_instance_rotation(instance_id, {'RotationQueue': RotationStatus.dispatched,
+                                                                'RotationStatus': RotationStatus.dispatched,
+                                                                'RotationDispatchedAt': int(self.clock())})
+            self.in_progress[item.get('SafeName')] = self.in_progress.get(item.get('SafeName'), 0) + 1
+            self.summary['dispatched'] += 1
+        else:
+            self.record_failure(item, 'The change request was rejected')
+
+
+    # Completes, fails or keeps waiting for a change requested by an earlier run
+    def follow_up(self, item, session_token, pvwa_url):
+        instance_id = item['InstanceId']
+        dispatched_at = int(item.get('RotationDispatchedAt', 0))
+        secret_management = pvwa_api_calls.get_account_secret_management(session_token, item['VaultAccountId'],
+                                                                         instance_id, pvwa_url)
+        if secret_management is None:
+            logger.info(f'The account of {instance_id} was removed, its rotation is dropped')
+            aws_services.update_instance_rotation(instance_id, dict(), ('RotationQueue', 'RotationStatus'))
+            return
+        elapsed = self.clock() - dispatched_at
+        if secret_management:
+            status = secret_management.get('status')
+            if status == CPM_SUCCESS and int(secret_management.get('lastModifiedTime', 0)) >= dispatched_at:
+                aws_services.update_instance_rotation(instance_id, {'RotationStatus': RotationStatus.rotated,
+                                                                    'RotationCompletedAt': int(self.clock())},
+                                                      ('RotationQueue', 'RotationError'))
+                self.summary['rotated'] += 1
+                return
+            if status == CPM_FAILURE and elapsed >= ROTATION_RESULT_SECONDS:
+                self.record_failure(item, 'CPM failed to change the credentials')
+                return
+        if elapsed >= ROTATION_TIMEOUT_SECONDS:
+            self.record_failure(item, 'The change did not complete in time')
+            return
+        self.in_progress[item.get('SafeName')] = self.in_progress.get(item.get('SafeName'), 0) + 1
+
+
+    def record_failure(self, item, error):
+        instance_id = item['InstanceId']
+        failures = int(item.get('RotationFailures', 0)) + 1
+        if failures >= self.config[ROTATION_MAX_FAILURES_PARAM]:
+            logger.error(f'Giving up the rotation of {instance_id} after {failures} failed attempts: {error}')
+            aws_services.update_instance_rotation(instance_id, {'RotationStatus': RotationStatus.failed,
+                                                                'RotationFailures': failures, 'RotationError': error},
+                                                  ('RotationQueue',))
+            self.summary['given_up'] += 1
+            return
+        retry_seconds = min(ROTATION_MAX_RETRY_SECONDS, ROTATION_RETRY_SECONDS * 2 ** (failures - 1))
+        logger.error(f'Rotation of {instance_id} failed ({failures} attempts), retrying in {retry_seconds} seconds: {error}')
+        # The queue is read with the minimum age subtracted, the retry is due retry_seconds from now
+        aws_services.update_instance_rotation(instance_id, {
+            'RotationQueue': RotationStatus.pending,
+            'RotationStatus': RotationStatus.pending,
+            'RotationDueAt': int(self.clock() + retry_seconds - self.config[ROTATION_MIN_AGE_PARAM]),
+            'RotationFailures': failures,
+            'RotationError': error})
+        self.summary['failed'] += 1
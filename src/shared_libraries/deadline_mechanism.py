@@ -0,0 +1,65 @@
+import time
+import random
+
+DEFAULT_SAFETY_MARGIN_MS = 2000  # Time kept aside to report the result before the Lambda is stopped
+
+
+# Raised by a step that cannot complete before the deadline, the work can be handed off from that step
+class DeadlineExceeded(Exception):
+    def __init__(self, step):
+        super().__init__(f'Not enough time left for the {step} step')
+        self.step = step
+
+
+# Remaining execution time of the current invocation, built from the Lambda context
+class Deadline:
+    def __init__(self, remaining_ms, safety_margin_ms=DEFAULT_SAFETY_MARGIN_MS):
+        self.expires_at = time.monotonic() + max(0, remaining_ms - safety_margin_ms) / 1000.0
+
+
+    @classmethod
+    def from_context(cls, context, safety_margin_ms=DEFAULT_SAFETY_MARGIN_MS):
+        return cls(context.get_remaining_time_in_millis(), safety_margin_ms)
+
+
+    def remaining_seconds(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+    def has_time_for(self, seconds):
+        return self.remaining_seconds() > seconds
+
+
+    # Raises DeadlineExceeded when the step needs more time than is left
+    def require(self, seconds, step):
+        if not self.has_time_for(seconds):
+            raise DeadlineExceeded(step)
+
+
+# Calls function until it returns a truthy value, sleeping a random ("full jitter") exponential backoff between attempts.
+# Stops early when the deadline leaves no room for the backoff plus another attempt, returns the last value
+def retry_with_jitter(function, deadline, attempts=3, base_delay=0.5, max_delay=5.0, min_attempt_seconds=1.0, logger=None,
+                      name=''):
+    value = None
+    for attempt in range(attempts):
+        try:
+            value = function()
+            error = None
+        except Exception as e:
+            value = None
+            error = e
+        if value:
+            return value
+        if attempt == attempts - 1:
+            break
+        delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+        if not deadline.has_time_for(delay + min_attempt_seconds):
+            if logger:
+                logger.error(f'{name} failed and there is not enough time left for another attempt')
+            break
+        if logger:
+            logger.error(f'{name} failed (attempt {attempt + 1}/{attempts}), retrying in {delay:.1f} seconds. {error or ""}')
+        time.sleep(delay)
+    if error:
+        raise error
+    return value
@@ -0,0 +1,265 @@
+import time
+import random
+import functools
+import threading
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError, ConnectionError as BotocoreConnectionError
+from log_mechanism import LogMechanism
+from metrics_mechanism import metrics
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+READ = 'read'
+WRITE = 'write'
+# Operations going through the throttle and the capacity they use, the other client methods are called directly
+OPERATION_KINDS = {'get_item': READ, 'batch_get_item': READ, 'query': READ, 'scan': READ,
+                   'put_item': WRITE, 'update_item': WRITE, 'delete_item': WRITE, 'batch_write_item': WRITE}
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+TRANSIENT_ERRORS = ('InternalServerError', 'ServiceUnavailable')
+ATTEMPTS = 8
+BACKOFF_SECONDS = 0.05  # Longest delay before the first retry, doubled on each attempt
+MAX_BACKOFF_SECONDS = 2
+BURST_SECONDS = 5  # Capacity a container may use at once after being idle, DynamoDB keeps up to 300 seconds of it
+MAX_WAIT_SECONDS = 5  # Longest wait for capacity, the request is then sent and left to DynamoDB to throttle
+THROTTLED_RATE = 0.5  # Part of its rate a container keeps after a throttled request
+MIN_RATE = 0.1  # Lowest part of the table capacity a container is left with
+RECOVERY_REQUESTS = 20  # Requests without throttling taking a container back to the table capacity
+# The retries are made by the access layer, the botocore retries would hide the throttling from it
+CLIENT_CONFIG = Config(retries={'max_attempts': 0})
+logger = LogMechanism()
+
+
+# Capacity units per second of a table, by READ and WRITE. None for an on-demand table, or a table that could not be
+# described, they are not rate limited by the container
+def get_table_capacity(dynamo_client, table_name):
+    try:
+        table = dynamo_client.describe_table(TableName=table_name)['Table']
+    except Exception as e:
+        logger.error(f'Failed to describe the {table_name} table, its requests are not rate limited: {e}')
+        return {READ: None, WRITE: None}
+    if table.get('BillingModeSummary', {}).get('BillingMode') == 'PAY_PER_REQUEST':
+        return {READ: None, WRITE: None}
+    throughput = table.get('ProvisionedThroughput', {})
+    return {READ: throughput.get('ReadCapacityUnits') or None, WRITE: throughput.get('WriteCapacityUnits') or None}
+
+
+# Capacity units a request is expected to use, the units it did use are settled with the response
+def get_request_units(operation, arguments):
+    if operation == 'batch_get_item':
+        return sum(len(table['Keys']) for table in arguments['RequestItems'].values())
+    if operation == 'batch_write_item':
+        return sum(len(requests) for requests in arguments['RequestItems'].values())
+    return 1
+
+
+# Capacity units used by a request, None when the response does not tell
+def get_consumed_units(response):
+    consumed_capacity = response.get('ConsumedCapacity')
+    if consumed_capacity is None:
+        return None
+    if isinstance(consumed_capacity, dict):
+        consumed_capacity = [consumed_capacity]
+    return sum(consumed['CapacityUnits'] for consumed in consumed_capacity)
+
+
+def get_error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    return None
+
+
+# Token bucket of the read or write capacity of a table. A request reserves its expected units and waits for the bucket
+# to refill when it is empty, the units it used are settled afterwards, so a scan or a large item delays the next
+# requests. A throttled request halves the rate of the container, requests without throttling bring it back to the table
+# capacity: the containers sharing a table settle on their share of it
+class TokenBucket:
+    def __init__(self, capacity, now):
+        self.capacity = capacity
+        self.rate = capacity
+        self.tokens = capacity * BURST_SECONDS
+        self.updated = now
+
+
+    def refill(self, now):
+        self.tokens = min(self.capacity * BURST_SECONDS, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    # Takes the units from the bucket, returns the seconds to wait before sending the request
+    def reserve(self, units, now):
+        self.refill(now)
+        self.tokens -= units
+        return min(MAX_WAIT_SECONDS, max(0.0, -self.tokens / self.rate))
+
+
+    def settle(self, units):
+        self.tokens -= units
+
+
+    def throttled(self):
+        self.rate = max(self.capacity * MIN_RATE, self.rate * THROTTLED_RATE)
+        self.tokens = min(self.tokens, 0.0)
+
+
+    def succeeded(self):
+        self.rate = min(self.capacity, self.rate + self.capacity / RECOVERY_REQUESTS)
+
+
+# Throttle of the requests to one table, with the capacity it used and the throttled requests since the container started
+class TableThrottle:
+    def __init__(self, table_name, capacity, now):
+        self.table_name = table_name
+        self.lock = threading.Lock()
+        self.buckets = {kind: TokenBucket(units, now) if units else None for kind, units in capacity.items()}
+        self.consumed = {READ: 0.0, WRITE: 0.0}
+        self.throttled_requests = 0
+
+
+    def reserve(self, kind, units, now):
+        if not self.buckets[kind]:
+            return 0.0
+        with self.lock:
+            return self.buckets[kind].reserve(units, now)
+
+
+    def settle(self, kind, expected_units, consumed_units):
+        with self.lock:
+            self.consumed[kind] += expected_units if consumed_units is None else consumed_units
+            if self.buckets[kind] and consumed_units is not None:
+                self.buckets[kind].settle(consumed_units - expected_units)
+
+
+    def throttled(self, kind):
+        with self.lock:
+            self.throttled_requests += 1
+            if self.buckets[kind]:
+                self.buckets[kind].throttled()
+
+
+    def succeeded(self, kind):
+        if not self.buckets[kind]:
+            return
+        with self.lock:
+            self.buckets[kind].succeeded()
+
+
+# Access layer of the DynamoDB tables of the solution. Every request is rate limited by the token bucket of its table,
+# sized to the provisioned capacity read once per container, and retried with a jittered backoff when it is throttled.
+# On-demand tables are only retried. The capacity used by the requests is recorded in the metrics of the invocation
+class DynamoAccess:
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.throttles = dict()
+        self.dynamo_client = None
+
+
+    def get_dynamo_client(self):
+        if not self.dynamo_client:
+            self.dynamo_client = boto3.client('dynamodb', config=CLIENT_CONFIG)
+        return self.dynamo_client
+
+
+    # Drop-in replacement of a DynamoDB client
+    def get_client(self):
+        return ThrottledClient(self)
+
+
+    # Drop-in replacement of a DynamoDB resource table
+    def get_table(self, table_name):
+        return ThrottledTable(self, table_name)
+
+
+    # Rate limits the requests of the container to a table to the given units per second instead of the capacity of the
+    # table, None for no limit. Used by the tools sharing a table with the Lambdas
+    def limit_table(self, table_name, read_units=None, write_units=None):
+        with self.lock:
+            self.throttles[table_name] = TableThrottle(table_name, {READ: read_units, WRITE: write_units}, self.clock())
+
+
+    def get_throttle(self, table_name):
+        with self.lock:
+            throttle = self.throttles.get(table_name)
+        if throttle:
+            return throttle
+        capacity = get_table_capacity(self.get_dynamo_client(), table_name)
+        with self.lock:
+            if table_name not in self.throttles:
+                logger.info(f"Rate limiting the {table_name} table to {capacity[READ] or 'on-demand'} read and "
+                            f"{capacity[WRITE] or 'on-demand'} write units per second")
+                self.throttles[table_name] = TableThrottle(table_name, capacity, self.clock())
+            return self.throttles[table_name]
+
+
+    def call(self, operation, method, table_name, **arguments):
+        kind = OPERATION_KINDS[operation]
+        table_name = table_name or arguments.get('TableName') or next(iter(arguments['RequestItems']))
+        throttle = self.get_throttle(table_name)
+        units = get_request_units(operation, arguments)
+        for attempt in range(1, ATTEMPTS + 1):
+            wait_seconds = throttle.reserve(kind, units, self.clock())
+            if wait_seconds:
+                metrics.record('dynamo_capacity_wait', wait_seconds * 1000)
+                self.sleep(wait_seconds)
+            try:
+                response = method(ReturnConsumedCapacity='TOTAL', **arguments)
+            except (ClientError, BotocoreConnectionError, HTTPClientError) as e:
+                error_code = get_error_code(e)
+                if error_code in THROTTLING_ERRORS:
+                    throttle.throttled(kind)
+                    metrics.add('dynamo_throttled', 1)
+                elif error_code is not None and error_code not in TRANSIENT_ERRORS:
+                    raise
+                if attempt == ATTEMPTS:
+                    raise
+                logger.info(f'{operation} on {table_name} failed with {error_code or e}, attempt {attempt}/{ATTEMPTS}')
+                self.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempt - 1))))
+                continue
+            consumed_units = get_consumed_units(response)
+            throttle.settle(kind, units, consumed_units)
+            metrics.add(f'dynamo_{table_name.lower()}_{kind}_units', units if consumed_units is None else consumed_units)
+            # Unprocessed batch items are throttled items, they are left to the caller to send again
+            if response.get('UnprocessedKeys') or response.get('UnprocessedItems'):
+                throttle.throttled(kind)
+            else:
+                throttle.succeeded(kind)
+            return response
+
+
+    # Capacity used and throttled requests by table since the container started
+    def get_usage(self):
+        with self.lock:
+            throttles = list(self.throttles.values())
+        return {throttle.table_name: {'read_units': throttle.consumed[READ], 'write_units': throttle.consumed[WRITE],
+                                      'throttled_requests': throttle.throttled_requests} for throttle in throttles}
+
+
+class ThrottledClient:
+    def __init__(self, dynamo_access):
+        self.dynamo_access = dynamo_access
+
+
+    def __getattr__(self, operation):
+        method = getattr(self.dynamo_access.get_dynamo_client(), operation)
+        if operation not in OPERATION_KINDS:
+            return method
+        return functools.partial(self.dynamo_access.call, operation, method, None)
+
+
+# The resource of a table is created on each call, resources are not thread safe
+class ThrottledTable:
+    def __init__(self, dynamo_access, table_name):
+        self.dynamo_access = dynamo_access
+        self.table_name = table_name
+
+
+    def __getattr__(self, operation):
+        table = boto3.resource('dynamodb', config=CLIENT_CONFIG).Table(self.table_name)
+        method = getattr(table, operation)
+        if operation not in OPERATION_KINDS:
+            return method
+        return functools.partial(self.dynamo_access.call, operation, method, self.table_name)
+
+
+dynamo_access = DynamoAccess()
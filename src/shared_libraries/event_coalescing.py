@@ -0,0 +1,74 @@
+import calendar
+import time
+import aws_services
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+EVENT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+RUNNING = 'running'
+TERMINATED = 'terminated'
+# EC2 states of an instance that will never need to be onboarded
+ENDED_STATES = ('shutting-down', 'terminated')
+logger = LogMechanism()
+
+
+# Event time of an EC2 state-change message in epoch seconds, None when the message has no usable time
+def get_event_time(data):
+    try:
+        return calendar.timegm(time.strptime(data['time'], EVENT_TIME_FORMAT))
+    except Exception:
+        return None
+
+
+# Orders the events of a batch by their event time and cancels the running and terminated pairs of instances that were
+# terminated before they were processed. A pair is only cancelled when the instance has no Instances row, a redelivered
+# or checkpointed running event may already have onboarded it and its terminated event still has to offboard it.
+# events is a list of (key, data) tuples, returns the events to process in order and the keys of the cancelled events
+def coalesce_events(events):
+    logger.trace(events, caller_name='coalesce_events')
+    ordered = sorted(enumerate(events), key=lambda item: (get_event_time(item[1][1]) or 0, item[0]))
+    pending_running = dict()
+    paired_terminated = dict()
+    cancelled = []
+    to_process = []
+    for _, (key, data) in ordered:
+        instance_id = data["detail"]["instance-id"]
+        state = data["detail"]["state"]
+        if state == RUNNING and instance_id in pending_running:
+            logger.info(f'Duplicate running event of {instance_id} dropped', DEBUG_LEVEL_DEBUG)
+            cancelled.append(key)
+            continue
+        if state == TERMINATED and instance_id in pending_running:
+            running_key = pending_running.pop(instance_id)
+            to_process = [event for event in to_process if event[0] != running_key]
+            cancelled.append(running_key)
+            paired_terminated[key] = instance_id
+        if state == RUNNING:
+            pending_running[instance_id] = key
+        to_process.append((key, data))
+    if paired_terminated:
+        onboarded = get_onboarded_instances(set(paired_terminated.values()))
+        for key, instance_id in paired_terminated.items():
+            if instance_id in onboarded:
+                logger.info(f'{instance_id} was terminated before its running event was processed, it is offboarded')
+                continue
+            logger.info(f'{instance_id} was terminated before it was onboarded, both events are cancelled')
+            to_process = [event for event in to_process if event[0] != key]
+            cancelled.append(key)
+    return to_process, cancelled
+
+
+# Instances of instance_ids that have an Instances row, read with the batch read of the offboarding. When the read fails
+# all of them are treated as onboarded, their terminated events are processed and the offboarding reads the rows again
+def get_onboarded_instances(instance_ids):
+    try:
+        return set(aws_services.get_instances_data_from_dynamo_table(instance_ids))
+    except Exception as e:
+        logger.error(f'Failed to read the instances of the cancelled events, their terminated events are kept: {e}')
+        return set(instance_ids)
+
+
+# A running event is only worth onboarding while the instance is still alive, the event may have been held in the queue
+# or delivered after the termination
+def is_ended(instance_details):
+    return instance_details.get('state') in ENDED_STATES
@@ -0,0 +1,45 @@
+from log_mechanism import LogMechanism
+from metrics_mechanism import metrics
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+CONTINUE = 'continue'  # Returned by a stage to pass the event to the next stage
+STAGE_METRIC_PREFIX = 'stage_'
+logger = LogMechanism()
+
+
+# Property computed on first access and kept on the instance, the inputs of an event are only fetched by the stage
+# that needs them
+class lazy_property:
+    def __init__(self, function):
+        self.function = function
+        self.name = function.__name__
+        self.__doc__ = function.__doc__
+
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.function(instance)
+        instance.__dict__[self.name] = value
+        return value
+
+
+def is_loaded(instance, name):
+    return name in instance.__dict__
+
+
+# Runs the stages of an event in order. A stage returns CONTINUE to pass the event on, any other value ends the
+# pipeline and is its result. Every stage is timed under stage_<name>
+class EventPipeline:
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+
+    def run(self, event):
+        for name, stage in self.stages:
+            with metrics.span(f'{STAGE_METRIC_PREFIX}{name}'):
+                result = stage(event)
+            if result != CONTINUE:
+                logger.info(f'Pipeline ended at stage {name}', DEBUG_LEVEL_DEBUG)
+                return result
+        return True
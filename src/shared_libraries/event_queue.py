@@ -0,0 +1,70 @@
+import json
+import boto3
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+SQS_EVENT_SOURCE = 'aws:sqs'
+SQS_MAX_BATCH_SIZE = 10  # Maximum number of messages in a single SQS receive or delete call
+logger = LogMechanism()
+
+
+# Returns the EC2 state-change message carried by an SNS record, an SQS record whose body is the SNS notification
+# (raw message delivery off) or an SQS record whose body is the message itself (raw message delivery on)
+def parse_state_change_message(record):
+    if 'Sns' in record:
+        return json.loads(record['Sns']['Message'])
+    body = json.loads(record['body'])
+    if 'Message' in body and 'detail' not in body:
+        return json.loads(body['Message'])
+    return body
+
+
+# Message id of an SQS record, or of an SNS record re-driven to the batch handler
+def get_message_id(record):
+    return record['messageId'] if 'messageId' in record else record['Sns']['MessageId']
+
+
+def build_sqs_record(message_id, receipt_handle, body, queue_arn=''):
+    return {'messageId': message_id, 'receiptHandle': receipt_handle, 'body': body, 'eventSource': SQS_EVENT_SOURCE,
+            'eventSourceARN': queue_arn, 'attributes': dict()}
+
+
+# URL of the queue of an SQS record, from the queue ARN arn:aws:sqs:region:account:name
+def get_queue_url(queue_arn):
+    _, _, _, region, account_id, queue_name = queue_arn.split(':')
+    return f'https://sqs.{region}.amazonaws.com/{account_id}/{queue_name}'
+
+
+# SQS queue holding the EC2 state-change notifications between SNS and the batch consumer
+class SqsEventQueue:
+    def __init__(self, queue_url, sqs_client=None):
+        self.queue_url = queue_url
+        self.sqs_client = sqs_client or boto3.client('sqs')
+
+
+    # delay_seconds overrides the delay of the queue
+    def send(self, body, delay_seconds=None):
+        if delay_seconds is None:
+            self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=body)
+        else:
+            self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=body, DelaySeconds=delay_seconds)
+
+
+    def receive(self, max_messages=SQS_MAX_BATCH_SIZE):
+        response = self.sqs_client.receive_message(QueueUrl=self.queue_url,
+                                                   MaxNumberOfMessages=min(max_messages, SQS_MAX_BATCH_SIZE),
+                                                   WaitTimeSeconds=1)
+        return [build_sqs_record(message['MessageId'], message['ReceiptHandle'], message['Body'])
+                for message in response.get('Messages', [])]
+
+
+    def delete(self, receipt_handles):
+        for index in range(0, len(receipt_handles), SQS_MAX_BATCH_SIZE):
+            entries = [{'Id': str(position), 'ReceiptHandle': receipt_handle}
+                       for position, receipt_handle in enumerate(receipt_handles[index:index + SQS_MAX_BATCH_SIZE])]
+            self.sqs_client.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+
+
+    # Failed messages become visible again when their visibility timeout expires, as with the Lambda event source
+    def release(self, receipt_handles):
+        pass
@@ -0,0 +1,161 @@
+import time
+import boto3
+from dynamo_access import dynamo_access
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+SCHEDULER_TABLE = 'Sessions'  # The virtual times of the flows are one item of the session slots table
+SCHEDULER_NAME = 'fair_queue'
+WEIGHTS_PARAM = 'AOB_Account_Weights'  # Comma separated account=weight or account:region=weight pairs
+DEFAULT_WEIGHT = 1.0
+QUANTUM = 20  # Events of weight 1 a flow may be ahead of the slowest active flow before its events are deferred
+ACTIVE_SECONDS = 30  # Time a flow stays active after its last event, an idle flow does not hold the others back
+DEFER_SECONDS = 15  # Delay of a deferred event sent back to the queue
+UPDATE_ATTEMPTS = 3
+UNKNOWN_FLOW_PART = 'unknown'
+logger = LogMechanism()
+
+
+# Weights of the accounts from parameter store, keyed by account or by account:region. A pair that cannot be parsed is
+# logged and ignored, the flows without a weight get DEFAULT_WEIGHT
+def get_account_weights():
+    weights = dict()
+    try:
+        ssm = boto3.client('ssm')
+        ssm_parameter = ssm.get_parameter(
+            Name=WEIGHTS_PARAM
+        )
+        value = ssm_parameter['Parameter']['Value']
+    except Exception:
+        return weights
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+        try:
+            flow, weight = pair.split('=')
+            weight = float(weight)
+            if weight <= 0:
+                raise ValueError('the weight must be positive')
+            weights[flow.strip()] = weight
+        except ValueError as e:
+            logger.error(f'Invalid {WEIGHTS_PARAM} entry {pair}: {e}')
+    return weights
+
+
+# The flow of an event: the account and region it comes from
+def get_flow(data):
+    return f"{data.get('account') or UNKNOWN_FLOW_PART}:{data.get('region') or UNKNOWN_FLOW_PART}"
+
+
+def get_weight(weights, flow):
+    return weights.get(flow, weights.get(flow.split(':')[0], DEFAULT_WEIGHT))
+
+
+# Start-time fair queueing of the queued events over their flows. Every event of a flow costs 1 / weight of virtual
+# time: its start tag is the later of the virtual time and the finish tag of the flow's previous event. The admitted
+# events of a batch are processed in start tag order, which interleaves the flows by weight. The virtual time is the
+# lowest finish tag of the active flows, an event starting more than quantum after it is deferred, so a flow bursting
+# ahead of the others waits for them while a flow alone is never held back. Returns the admitted events in processing
+# order, the deferred events and the new virtual time. flows is updated in place
+def assign_tags(events, flows, virtual_time, weights, now, quantum=QUANTUM, active_seconds=ACTIVE_SECONDS):
+    active = [flow['finish'] for flow in flows.values() if flow['seenAt'] >= now - active_seconds]
+    if active:
+        virtual_time = max(virtual_time, min(active))
+    else:
+        # Nothing is backlogged, the debts of the idle flows are forgiven
+        virtual_time = max([virtual_time] + [flow['finish'] for flow in flows.values()])
+    tagged = []
+    deferred = []
+    for position, (key, data) in enumerate(events):
+        flow_name = get_flow(data)
+        flow = flows.setdefault(flow_name, {'finish': virtual_time, 'seenAt': now})
+        flow['seenAt'] = now
+        start = max(virtual_time, flow['finish'])
+        if start > virtual_time + quantum:
+            deferred.append((key, data))
+            continue
+        flow['finish'] = start + 1.0 / get_weight(weights, flow_name)
+        tagged.append((start, position, key, data))
+    for flow_name in [name for name, flow in flows.items()
+                      if flow['seenAt'] < now - active_seconds and flow['finish'] <= virtual_time]:
+        del flows[flow_name]
+    return [(key, data) for _, _, key, data in sorted(tagged, key=lambda item: item[:2])], deferred, virtual_time
+
+
+# Shares the flows of all the batch consumers through DynamoDB. The item is read, tagged and written back with an
+# optimistic version check, the scheduling fails open and admits the whole batch when the item cannot be updated
+class FairScheduler:
+    def __init__(self, table_name=SCHEDULER_TABLE, name=SCHEDULER_NAME, quantum=QUANTUM, active_seconds=ACTIVE_SECONDS,
+                 clock=time.time):
+        self.table_name = table_name
+        self.name = name
+        self.quantum = quantum
+        self.active_seconds = active_seconds
+        self.clock = clock
+        self.dynamo_client = None
+        self.weights = None
+
+
+    def get_dynamo_client(self):
+        if not self.dynamo_client:
+            self.dynamo_client = dynamo_access.get_client()
+        return self.dynamo_client
+
+
+    # Weights are read once per container
+    def get_weights(self):
+        if self.weights is None:
+            self.weights = get_account_weights()
+            if self.weights:
+                logger.info(f'Account weights: {self.weights}')
+        return self.weights
+
+
+    def read(self):
+        response = self.get_dynamo_client().get_item(TableName=self.table_name, Key={'name': {'S': self.name}},
+                                                     ConsistentRead=True)
+        item = response.get('Item', dict())
+        flows = {name: {'finish': float(flow['M']['finish']['N']), 'seenAt': float(flow['M']['seenAt']['N'])}
+                 for name, flow in item.get('flows', {'M': dict()})['M'].items()}
+        version = int(item['version']['N']) if 'version' in item else 0
+        virtual_time = float(item['virtualTime']['N']) if 'virtualTime' in item else 0.0
+        return version, virtual_time, flows
+
+
+    # Writes the flows back, False when another consumer updated them since they were read
+    def write(self, version, virtual_time, flows):
+        item = {'name': {'S': self.name}, 'version': {'N': str(version + 1)}, 'virtualTime': {'N': f'{virtual_time:.6f}'},
+                'flows': {'M': {name: {'M': {'finish': {'N': f"{flow['finish']:.6f}"}, 'seenAt': {'N': f"{flow['seenAt']:.6f}"}}}
+                                for name, flow in flows.items()}}}
+        try:
+            self.get_dynamo_client().put_item(TableName=self.table_name, Item=item,
+                                              ConditionExpression='attribute_not_exists(version) OR version = :version',
+                                              ExpressionAttributeValues={':version': {'N': str(version)}})
+            return True
+        except Exception as e:
+            if 'ConditionalCheckFailed' not in str(e):
+                raise
+            return False
+
+
+    # events is a list of (key, data) tuples in event time order, returns the events to process in order and the events
+    # to defer
+    def schedule(self, events):
+        logger.trace(events, caller_name='FairScheduler.schedule')
+        if not events:
+            return events, []
+        weights = self.get_weights()
+        try:
+            for _ in range(UPDATE_ATTEMPTS):
+                version, virtual_time, flows = self.read()
+                admitted, deferred, virtual_time = assign_tags(events, flows, virtual_time, weights, self.clock(),
+                                                               self.quantum, self.active_seconds)
+                if self.write(version, virtual_time, flows):
+                    return admitted, deferred
+            logger.error(f'The flows were updated by other consumers {UPDATE_ATTEMPTS} times, the batch is not scheduled')
+        except Exception as e:
+            logger.error(f'Failed to schedule the batch fairly, processing it in event time order: {e}')
+        return events, []
+
+
+fair_scheduler = FairScheduler()
@@ -1,21 +1,44 @@
+import time
 import boto3
+from concurrent.futures import ThreadPoolExecutor
 import pvwa_api_calls
 import aws_services
 import kp_processing
+import credential_rotation
+import pvwa_routing
+import session_slots
+from safe_sharding import safe_sharding
 from pvwa_integration import PvwaIntegration
 from log_mechanism import LogMechanism
+from metrics_mechanism import metrics
+from deadline_mechanism import DeadlineExceeded
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
 UNIX_PLATFORM = "UnixSSHKeys"
 WINDOWS_PLATFORM = "WinServerLocal"
 ADMINISTRATOR = "Administrator"
+VAULT_ACCOUNT_ID = "VaultAccountId"
+BULK_DELETE_WORKERS = 10  # Vault deletes running at the same time over the shared session
+PASSWORD_POLL_SECONDS = 15  # Polling period of the Windows password data, as the EC2 waiter
+PASSWORD_POLL_ATTEMPTS = 40
+VAULT_ACCOUNT_SECONDS = 15  # Time kept for creating the vault account and writing the Instances row
+RESUME_LIMIT = 5  # Hand-offs of an onboarding before it is marked failed
 pvwa_integration_class = PvwaIntegration()
 logger = LogMechanism()
 
 
+@metrics.timed('delete_instance')
 def delete_instance(instance_id, session, store_parameters_class, instance_data, instance_details):
     logger.trace(instance_id, session, store_parameters_class, instance_data, instance_details, caller_name='delete_instance')
     logger.info(f'Removing {instance_id} From AOB')
+    if VAULT_ACCOUNT_ID in instance_data:
+        # Onboarded by this version, the row holds the vault account id
+        pvwa_api_calls.delete_account_from_vault(session, instance_data[VAULT_ACCOUNT_ID]["S"], instance_id,
+                                                 store_parameters_class.pvwa_url)
+        logger.info('Removing instance from DynamoDB', DEBUG_LEVEL_DEBUG)
+        aws_services.remove_instance_from_dynamo_table(instance_id)
+        return True
+    # Rows written by older versions only hold the address, the account is searched in the vault
     instance_ip_address = instance_data["Address"]["S"]
     if instance_details['platform'] == "windows":
         safe_name = store_parameters_class.windows_safe_name
@@ -23,6 +46,8 @@ def delete_instance(instance_id, session, store_parameters_class, instance_data,
     else:
         safe_name = store_parameters_class.unix_safe_name
         instance_username = get_os_distribution_user(instance_details['image_description'])
+    # The row holds the safe of the account when it was written without the vault account id
+    safe_name = instance_data.get('SafeName', {}).get('S') or safe_name
     search_pattern = f"{instance_ip_address},{instance_username}"
 
     instance_account_id = pvwa_api_calls.retrieve_account_id_from_account_name(session, search_pattern,
@@ -37,7 +62,75 @@ def delete_instance(instance_id, session, store_parameters_class, instance_data,
     return True
 
 
-def get_instance_password_data(instance_id, solution_account_id, event_region, event_account_id):
+# Offboards many terminated instances: one BatchGetItem reads their rows, the vault accounts are deleted over the
+# caller's session with bounded parallelism and one BatchWriteItem removes the rows.
+# Returns a dictionary of instance id to (result, error)
+@metrics.timed('bulk_offboard')
+def offboard_instances(instance_ids, session, store_parameters_class, max_workers=BULK_DELETE_WORKERS):
+    logger.trace(instance_ids, session, store_parameters_class, caller_name='offboard_instances')
+    logger.info(f'Removing {len(instance_ids)} instances From AOB')
+    rows = aws_services.get_instances_data_from_dynamo_table(instance_ids)
+    results = dict()
+    to_delete = []
+    for instance_id in instance_ids:
+        row = rows.get(instance_id)
+        if not row:
+            results[instance_id] = (OffBoardResult.not_in_table, None)
+        elif row["Status"]["S"] == OnBoardStatus.on_boarded_failed:
+            results[instance_id] = (OffBoardResult.failed_onboarding_removed, None)
+        elif row["Status"]["S"] in OnBoardStatus.not_in_vault_statuses:
+            results[instance_id] = (OffBoardResult.not_onboarded_removed, None)
+        else:
+            to_delete.append((instance_id, row))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        deleted = executor.map(lambda item: delete_vault_account(item[0], item[1], session, store_parameters_class), to_delete)
+        for (instance_id, row), result in zip(to_delete, deleted):
+            results[instance_id] = result
+    removed = [instance_id for instance_id, (result, error) in results.items() if result in OffBoardResult.removed_results]
+    if removed and not aws_services.remove_instances_from_dynamo_table(removed):
+        for instance_id in removed:
+            results[instance_id] = (OffBoardResult.failed, 'Removing the instance from DynamoDB failed')
+    for instance_id, (result, error) in results.items():
+        if result == OffBoardResult.failed and instance_id in rows:
+            aws_services.update_instances_table_status(instance_id, OnBoardStatus.delete_failed, error)
+    return results
+
+
+def delete_vault_account(instance_id, instance_data, session, store_parameters_class):
+    try:
+        if VAULT_ACCOUNT_ID in instance_data:
+            account_id = instance_data[VAULT_ACCOUNT_ID]["S"]
+        else:
+            account_id = find_legacy_account_id(instance_id, instance_data, session, store_parameters_class)
+        if not account_id:
+            logger.info(f"{instance_id} does not exist in safe")
+            return OffBoardResult.not_in_vault, None
+        pvwa_api_calls.delete_account_from_vault(session, account_id, instance_id, store_parameters_class.pvwa_url)
+        return OffBoardResult.deleted, None
+    except Exception as e:
+        logger.error(f'Failed to remove {instance_id} from the vault: {str(e)}')
+        return OffBoardResult.failed, str(e)
+
+
+# Rows written by older versions only hold the address, the account names hold the instance id
+# (AWS.<instance id>.Unix or AWS.<instance id>.Windows), so the safes are searched by address without describing the instance.
+# A row holding its safe is only searched there
+def find_legacy_account_id(instance_id, instance_data, session, store_parameters_class):
+    safe_names = (store_parameters_class.unix_safe_name, store_parameters_class.windows_safe_name)
+    if 'SafeName' in instance_data:
+        safe_names = (instance_data['SafeName']['S'],)
+    for safe_name in safe_names:
+        account_id = pvwa_api_calls.retrieve_account_id_from_account_name(session, instance_data["Address"]["S"], safe_name,
+                                                                          instance_id, store_parameters_class.pvwa_url)
+        if account_id:
+            return account_id
+    return False
+
+
+# The wait for the password data is bounded by the deadline, minus the time kept for the vault account. The wait stops
+# with DeadlineExceeded when the password is not available in time
+@metrics.timed('windows_password_wait')
+def get_instance_password_data(instance_id, solution_account_id, event_region, event_account_id, deadline=None):
     logger.trace(instance_id, solution_account_id, event_region, event_account_id, caller_name='get_instance_password_data')
     logger.info(f'Getting {instance_id} password')
     if event_account_id == solution_account_id:
@@ -66,57 +159,76 @@ def get_instance_password_data(instance_id, solution_account_id, event_region, e
         except Exception as e:
             logger.error(f'Error on getting token from account {event_account_id} : {str(e)}')
 
+    max_attempts = PASSWORD_POLL_ATTEMPTS
+    if deadline:
+        max_attempts = min(max_attempts, int((deadline.remaining_seconds() - VAULT_ACCOUNT_SECONDS) // PASSWORD_POLL_SECONDS))
+        if max_attempts < 1:
+            raise DeadlineExceeded(OnboardStep.windows_password)
     try:
     	# wait until password data available when Windows instance is up
         logger.info(f"Waiting for instance - {instance_id} to become available: ")
         waiter = ec2_resource.get_waiter('password_data_available')
-        waiter.wait(InstanceId=instance_id)
+        waiter.wait(InstanceId=instance_id, WaiterConfig={'Delay': PASSWORD_POLL_SECONDS, 'MaxAttempts': max_attempts})
         instance_password_data = ec2_resource.get_password_data(InstanceId=instance_id)
         return instance_password_data['PasswordData']
     except Exception as e:
+        if max_attempts < PASSWORD_POLL_ATTEMPTS and 'Max attempts exceeded' in str(e):
+            raise DeadlineExceeded(OnboardStep.windows_password)
         logger.error(f'Error on waiting for instance password: {str(e)}')
 
 
+# Every step of a caller passing its deadline starts only when it can complete in the time left, otherwise
+# DeadlineExceeded names the step to resume from
+@metrics.timed('create_instance')
 def create_instance(instance_id, instance_details, store_parameters_class, log_name, solution_account_id, event_region,
-                    event_account_id, instance_account_password):
+                    event_account_id, instance_account_password, session_token=None, deadline=None):
     logger.trace(instance_id, instance_details, store_parameters_class, log_name, solution_account_id, event_region,
                  event_account_id, caller_name='create_instance')
     logger.info(f'Adding {instance_id} to AOB')
-    if instance_details['platform'] == "windows":  # Windows machine return 'windows' all other return 'None'
-        logger.info('Windows platform detected')
-        kp_processing.save_key_pair(instance_account_password)
-        instance_password_data = get_instance_password_data(instance_id, solution_account_id, event_region, event_account_id)
-        decrypted_password = kp_processing.decrypt_password(instance_password_data)
-        aws_account_name = f'AWS.{instance_id}.Windows'
-        instance_key = decrypted_password
-        platform = WINDOWS_PLATFORM
-        instance_username = ADMINISTRATOR
-        safe_name = store_parameters_class.windows_safe_name
-    else:
-        logger.info('Linux\\Unix platform detected')
-        ppk_key = kp_processing.convert_pem_to_ppk(instance_account_password)
-        if not ppk_key:
-            raise Exception("Error on key conversion")
+    instance_account = get_instance_account(instance_id, instance_details, store_parameters_class, solution_account_id,
+                                            event_region, event_account_id, instance_account_password, deadline)
+    instance_key = instance_account['secret']
+    if instance_account['platform'] == UNIX_PLATFORM:
         # ppk_key contains \r\n on each row end, adding escape char '\'
-        trimmed_ppk_key = str(ppk_key).replace("\n", "\\n")
+        trimmed_ppk_key = str(instance_key).replace("\n", "\\n")
         instance_key = trimmed_ppk_key.replace("\r", "\\r")
-        aws_account_name = f'AWS.{instance_id}.Unix'
-        platform = UNIX_PLATFORM
-        safe_name = store_parameters_class.unix_safe_name
-        instance_username = get_os_distribution_user(instance_details['image_description'])
 
-    # Check if account already exist - in case exist - just add it to DynamoDB
-    print('pvwa_connection_number')
-    pvwa_connection_number, session_guid = aws_services.get_session_from_dynamo()
-    if not pvwa_connection_number:
-        return False
-    session_token = pvwa_integration_class.logon_pvwa(store_parameters_class.vault_username,
-                                                      store_parameters_class.vault_password,
-                                                      store_parameters_class.pvwa_url, pvwa_connection_number)
-    print('session_token')
-    if not session_token:
+    if deadline:
+        deadline.require(VAULT_ACCOUNT_SECONDS, OnboardStep.vault_account)
+    # A session passed by the caller (queue-backed batch) is reused and stays open
+    if session_token:
+        return add_instance_account(instance_id, instance_details, instance_account, instance_key, store_parameters_class,
+                                    log_name, session_token)
+    # Otherwise the session is opened on a leased slot of a PVWA node, the slot is released however the onboarding ends
+    slot_lease, store_parameters_class = pvwa_routing.acquire_node_slot(store_parameters_class, deadline)
+    if not slot_lease:
         return False
+    with slot_lease:
+        session_token = pvwa_integration_class.logon_pvwa(store_parameters_class.vault_username,
+                                                          store_parameters_class.vault_password,
+                                                          store_parameters_class.pvwa_url, slot_lease.slot)
+        if not session_token:
+            return False
+        try:
+            return add_instance_account(instance_id, instance_details, instance_account, instance_key,
+                                        store_parameters_class, log_name, session_token)
+        finally:
+            pvwa_integration_class.logoff_pvwa(store_parameters_class.pvwa_url, session_token)
 
+
+def add_instance_account(instance_id, instance_details, instance_account, instance_key, store_parameters_class, log_name,
+                         session_token):
+    logger.trace(instance_id, instance_details, store_parameters_class, log_name, caller_name='add_instance_account')
+    aws_account_name = instance_account['name']
+    platform = instance_account['platform']
+    instance_username = instance_account['username']
+    safe_name = instance_account['safe_name']
+    if not safe_sharding.ensure_safe(session_token, safe_name, instance_account['base_safe_name'],
+                                     store_parameters_class.pvwa_url):
+        aws_services.put_instance_to_dynamo_table(instance_id, instance_details['address'], OnBoardStatus.on_boarded_failed,
+                                                  f'Failed to prepare the Safe {safe_name}', log_name)
+        return True
+    # Check if account already exist - in case exist - just add it to DynamoDB
     search_account_pattern = f"{instance_details['address']},{instance_username}"
     print('retrieve_account_id_from_account_name')
     existing_instance_account_id = pvwa_api_calls.retrieve_account_id_from_account_name(session_token, search_account_pattern,
@@ -126,31 +238,112 @@ def create_instance(instance_id, instance_details, store_parameters_class, log_n
     if existing_instance_account_id:  # account already exist and managed on vault, no need to create it again
         logger.info("Account already exists in vault")
         aws_services.put_instance_to_dynamo_table(instance_id, instance_details['address'], OnBoardStatus.on_boarded, "None",
-                                                  log_name)
+                                                  log_name, get_vault_details(existing_instance_account_id, safe_name,
+                                                                              platform, instance_username, instance_details))
         return False
-    else:
-        account_created, error_message = pvwa_api_calls.create_account_on_vault(session_token, aws_account_name, instance_key,
-                                                                                store_parameters_class,
-                                                                                platform, instance_details['address'],
-                                                                                instance_id, instance_username, safe_name)
-        if account_created:
-            # if account created, rotate the key immediately
-            instance_account_id = pvwa_api_calls.retrieve_account_id_from_account_name(session_token, search_account_pattern,
-                                                                                       safe_name,
-                                                                                       instance_id,
-                                                                                       store_parameters_class.pvwa_url)
-            pvwa_api_calls.rotate_credentials_immediately(session_token, store_parameters_class.pvwa_url, instance_account_id,
-                                                          instance_id)
-            aws_services.put_instance_to_dynamo_table(instance_id, instance_details['address'], OnBoardStatus.on_boarded, "None",
-                                                      log_name)
-        else:  # on board failed, add the error to the table
-            aws_services.put_instance_to_dynamo_table(instance_id, instance_details['address'], OnBoardStatus.on_boarded_failed,
-                                                      error_message, log_name)
-    pvwa_integration_class.logoff_pvwa(store_parameters_class.pvwa_url, session_token)
-    aws_services.release_session_on_dynamo(pvwa_connection_number, session_guid)
+    account_created, error_message = pvwa_api_calls.create_account_on_vault(session_token, aws_account_name, instance_key,
+                                                                            store_parameters_class,
+                                                                            platform, instance_details['address'],
+                                                                            instance_id, instance_username, safe_name)
+    if account_created:
+        # if account created, record the key rotation, the rotation scheduler requests it at its own rate
+        instance_account_id = pvwa_api_calls.retrieve_account_id_from_account_name(session_token, search_account_pattern,
+                                                                                   safe_name,
+                                                                                   instance_id,
+                                                                                   store_parameters_class.pvwa_url)
+        vault_details = get_vault_details(instance_account_id, safe_name, platform, instance_username, instance_details)
+        if instance_account_id:
+            vault_details.update(credential_rotation.get_pending_rotation())
+        aws_services.put_instance_to_dynamo_table(instance_id, instance_details['address'], OnBoardStatus.on_boarded, "None",
+                                                  log_name, vault_details)
+    else:  # on board failed, add the error to the table
+        aws_services.put_instance_to_dynamo_table(instance_id, instance_details['address'], OnBoardStatus.on_boarded_failed,
+                                                  error_message, log_name)
     return True
 
 
+# Records the step an onboarding stopped before on the Instances row, with what a later run needs to resume from it:
+# the number of hand-offs so far and the vault account of the key pair. Returns False when the row could not be written
+def save_checkpoint(instance_id, instance_details, step, log_name, resume_count, key_pair_account_id=None):
+    logger.trace(instance_id, step, resume_count, key_pair_account_id, caller_name='save_checkpoint')
+    logger.info(f'Not enough time left, {instance_id} is handed off before the {step} step ({resume_count}/{RESUME_LIMIT})')
+    return aws_services.put_instance_to_dynamo_table(instance_id, instance_details['address'],
+                                                     OnBoardStatus.on_board_pending, f'Handed off before the {step} step',
+                                                     log_name, dict(get_ledger_details(instance_details),
+                                                                    Checkpoint=step, CheckpointAt=int(time.time()),
+                                                                    ResumeCount=resume_count,
+                                                                    KeyPairAccountId=key_pair_account_id))
+
+
+# Checkpoint of a pending onboarding from its Instances row, None when the onboarding was not handed off
+def get_checkpoint(instance_data):
+    if not instance_data or instance_data.get('Status', {}).get('S') != OnBoardStatus.on_board_pending:
+        return None
+    return {'step': instance_data.get('Checkpoint', {}).get('S'),
+            'resume_count': int(instance_data.get('ResumeCount', {'N': '0'})['N']),
+            'key_pair_account_id': instance_data.get('KeyPairAccountId', {}).get('S'),
+            'processing_started_at': int(instance_data['ProcessingStartedAt']['N'])
+            if 'ProcessingStartedAt' in instance_data else None}
+
+
+# Name, secret, platform, user name and safe of the vault account of an instance. The secret is the decrypted
+# Administrator password of a Windows instance, the PPK conversion of the key pair of the others. The safe is the shard
+# of the configured safe of the platform the instance falls in
+def get_instance_account(instance_id, instance_details, store_parameters_class, solution_account_id, event_region,
+                         event_account_id, instance_account_password, deadline=None):
+    logger.trace(instance_id, instance_details, store_parameters_class, solution_account_id, event_region, event_account_id,
+                 caller_name='get_instance_account')
+    if instance_details['platform'] == "windows":  # Windows machine return 'windows' all other return 'None'
+        logger.info('Windows platform detected')
+        kp_processing.save_key_pair(instance_account_password)
+        instance_password_data = get_instance_password_data(instance_id, solution_account_id, event_region, event_account_id,
+                                                            deadline)
+        with metrics.span('windows_password_decrypt'):
+            decrypted_password = kp_processing.decrypt_password(instance_password_data)
+        return {'name': f'AWS.{instance_id}.Windows',
+                'secret': decrypted_password,
+                'platform': WINDOWS_PLATFORM,
+                'username': ADMINISTRATOR,
+                'safe_name': get_shard_safe_name(store_parameters_class.windows_safe_name, instance_id, instance_details),
+                'base_safe_name': store_parameters_class.windows_safe_name}
+    logger.info('Linux\\Unix platform detected')
+    with metrics.span('puttygen_conversion'):
+        ppk_key = kp_processing.convert_pem_to_ppk(instance_account_password)
+    if not ppk_key:
+        raise Exception("Error on key conversion")
+    return {'name': f'AWS.{instance_id}.Unix',
+            'secret': str(ppk_key),
+            'platform': UNIX_PLATFORM,
+            'username': get_os_distribution_user(instance_details['image_description']),
+            'safe_name': get_shard_safe_name(store_parameters_class.unix_safe_name, instance_id, instance_details),
+            'base_safe_name': store_parameters_class.unix_safe_name}
+
+
+def get_shard_safe_name(base_safe_name, instance_id, instance_details):
+    return safe_sharding.get_safe_name(base_safe_name, instance_id, instance_details.get('aws_account_id'))
+
+
+# Instances table attributes locating the vault account of an onboarded instance, with its latency ledger
+def get_vault_details(account_id, safe_name, platform, username, instance_details):
+    return dict(get_ledger_details(instance_details),
+                VaultCreatedAt=int(time.time()),
+                **{VAULT_ACCOUNT_ID: account_id,
+                   'SafeName': safe_name,
+                   'Platform': platform,
+                   'UserName': username,
+                   'ImageId': instance_details.get('image_id')})
+
+
+# Latency ledger of the onboarding on the Instances row, in epoch seconds: the time of the state change and the time the
+# event was first processed, recorded by the handler in the instance details. The row also gets VaultCreatedAt, then
+# RotationDispatchedAt and RotationCompletedAt from the rotation scheduler. The account and region break the latencies down
+def get_ledger_details(instance_details):
+    return {'EventTime': instance_details.get('event_time'),
+            'ProcessingStartedAt': instance_details.get('processing_started_at'),
+            'AccountId': instance_details.get('aws_account_id'),
+            'Region': instance_details.get('region')}
+
+
 def get_os_distribution_user(image_description):
     logger.trace(image_description, caller_name='get_os_distribution_user')
     if "centos" in image_description.lower():
@@ -169,7 +362,28 @@ def get_os_distribution_user(image_description):
     return linux_username
 
 
+class OffBoardResult:
+    deleted = "deleted"
+    not_in_vault = "not in vault"
+    not_in_table = "not in table"
+    failed_onboarding_removed = "failed onboarding removed"
+    not_onboarded_removed = "not onboarded removed"
+    failed = "failed"
+    removed_results = (deleted, not_in_vault, failed_onboarding_removed, not_onboarded_removed)
+
+
 class OnBoardStatus:
     on_boarded = "on boarded"
     on_boarded_failed = "on board failed"
     delete_failed = "delete failed"
+    on_board_pending = "on board pending"  # Handed off at a checkpoint, resumed by a later run
+    skipped = "skipped"  # Excluded by the onboarding rules
+    # The instance has no vault account, its row is removed without any vault call
+    not_in_vault_statuses = (on_board_pending, skipped)
+
+
+# Onboarding steps a run can stop before, recorded in the Checkpoint attribute of the Instances row
+class OnboardStep:
+    session_slot = session_slots.SLOT_STEP
+    windows_password = "windows password"
+    vault_account = "vault account"
@@ -1,10 +1,11 @@
-import subprocess
-import sys
-import rsa
-import base64
+# subprocess and rsa are imported by the functions that use them, a termination event never loads them
+import hashlib
+import threading
+from collections import OrderedDict
 from log_mechanism import LogMechanism
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+PPK_CACHE_SIZE = 16  # Key pairs whose conversion is kept by a container, the least recently used one is evicted first
 logger = LogMechanism()
 
 
@@ -12,17 +13,86 @@ def save_key_pair(pemKey):
     # Save pem to file
     logger.trace(caller_name='save_key_pair')
     logger.info('Saving key pair to file')
+    import subprocess
     savePemToFileCommand = 'echo {0} > /tmp/pemValue.pem'.format(pemKey)
     subprocess.call([savePemToFileCommand], shell=True)
     subprocess.call(["chmod 777 /tmp/pemValue.pem"], shell=True)
 
 
+# Conversions of the container keyed by the SHA-256 fingerprint of the key material. The PPK values are kept in memory
+# only, as bytearrays that are overwritten with zeros when they are evicted or cleared
+class ConversionCache:
+    def __init__(self, max_size=PPK_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.values = OrderedDict()
+
+
+    @staticmethod
+    def fingerprint(pem_key):
+        return hashlib.sha256(pem_key.strip().encode('utf-8')).hexdigest()
+
+
+    def get(self, fingerprint):
+        with self.lock:
+            value = self.values.get(fingerprint)
+            if value is None:
+                return None
+            self.values.move_to_end(fingerprint)
+            return value.decode('utf-8')
+
+
+    def put(self, fingerprint, ppk_key):
+        with self.lock:
+            if fingerprint in self.values:
+                self.zero(self.values.pop(fingerprint))
+            self.values[fingerprint] = bytearray(ppk_key.encode('utf-8'))
+            while len(self.values) > self.max_size:
+                self.zero(self.values.popitem(last=False)[1])
+
+
+    def clear(self):
+        with self.lock:
+            while self.values:
+                self.zero(self.values.popitem()[1])
+
+
+    @staticmethod
+    def zero(value):
+        value[:] = bytes(len(value))
+
+
+    def __len__(self):
+        with self.lock:
+            return len(self.values)
+
+
+ppk_cache = ConversionCache()
+# puttygen works on fixed files in /tmp, the conversions of a container run one at a time
+conversion_lock = threading.Lock()
+
+
+# Instances launched with the same key pair share its conversion, puttygen runs once per key pair and container
 def convert_pem_to_ppk(pemKey):
     logger.trace(caller_name='convert_pem_to_ppk')
+    fingerprint = ConversionCache.fingerprint(pemKey)
+    with conversion_lock:
+        ppkKey = ppk_cache.get(fingerprint)
+        if ppkKey is not None:
+            logger.info('Using the cached ppk conversion of the key pair')
+            return ppkKey
+        ppkKey = run_puttygen(pemKey)
+        ppk_cache.put(fingerprint, ppkKey)
+    return ppkKey
+
+
+def run_puttygen(pemKey):
+    logger.trace(caller_name='run_puttygen')
     logger.info('Converting pem to ppk')
     #  convert pem file, get ppk value
     #  Uses Puttygen sent to the lambda
     save_key_pair(pemKey=pemKey)
+    import subprocess
     subprocess.call(["cp ./puttygen /tmp/puttygen"], shell=True)
     subprocess.call(["chmod 777 /tmp/puttygen "], shell=True)
     subprocess.check_output("ls /tmp -l", shell=True)
@@ -40,6 +110,8 @@ def convert_pem_to_ppk(pemKey):
 
 def decrypt_password(instance_password_data):
     logger.trace(caller_name='decrypt_password')
+    import base64
+    import rsa
     passwd = base64.b64decode(instance_password_data)
     with open ("/tmp/pemValue.pem", 'r') as f:
         private = rsa.PrivateKey.load_pkcs1(f.read())
@@ -5,8 +5,14 @@ DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
 
 
 class LogMechanism:
-    def __init__(self):
-        self.debug_level = get_debug_level()
+    # Shared by every logger of the container, read from parameter store on first use and not on import
+    shared_debug_level = None
+
+    @property
+    def debug_level(self):
+        if LogMechanism.shared_debug_level is None:
+            LogMechanism.shared_debug_level = get_debug_level()
+        return LogMechanism.shared_debug_level
 
 
     def info(self, message, debug_level=DEBUG_LEVEL_INFO):
@@ -0,0 +1,137 @@
+import json
+import time
+import functools
+import boto3
+
+METRICS_NAMESPACE = 'CyberArk/AOB'
+METRICS_PARAM = 'AOB_Metrics'
+METRICS_ENABLED = 'Enabled'
+METRICS_DISABLED = 'Disabled'
+DIMENSION_PLATFORM = 'Platform'
+DIMENSION_STATE = 'State'
+DIMENSION_ACCOUNT = 'Account'
+UNKNOWN_DIMENSION_VALUE = 'Unknown'
+
+
+# Collects per-phase timings, and other values of a single invocation, and writes them as one
+# CloudWatch Embedded Metric Format (EMF) log line when the invocation ends
+class MetricsMechanism:
+    def __init__(self, namespace=METRICS_NAMESPACE):
+        self.namespace = namespace
+        # None until resolved from parameter store on the first flush of the container
+        self.enabled = None
+        self.dimensions = dict()
+        self.timings = dict()
+        self.units = dict()
+        self.start_invocation()
+
+
+    def start_invocation(self):
+        self.timings = dict()
+        self.units = dict()
+        self.dimensions = {DIMENSION_PLATFORM: UNKNOWN_DIMENSION_VALUE,
+                           DIMENSION_STATE: UNKNOWN_DIMENSION_VALUE,
+                           DIMENSION_ACCOUNT: UNKNOWN_DIMENSION_VALUE}
+
+
+    def set_dimension(self, name, value):
+        self.dimensions[name] = str(value) if value else UNKNOWN_DIMENSION_VALUE
+
+
+    def record(self, name, duration_ms):
+        if self.enabled is False:
+            return
+        self.timings.setdefault(name, []).append(round(duration_ms, 3))
+
+
+    # Records a value that is not a timing, unit is a CloudWatch unit (Count, None...)
+    def add(self, name, value, unit='Count'):
+        if self.enabled is False:
+            return
+        self.units[name] = unit
+        self.timings.setdefault(name, []).append(round(value, 3))
+
+
+    # Context manager timing a block of code: with metrics.span('pvwa_logon'): ...
+    def span(self, name):
+        return MetricsSpan(self, name)
+
+
+    # Decorator timing every call of the decorated function under the given metric name
+    def timed(self, name):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if self.enabled is False:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, (time.perf_counter() - start) * 1000)
+            return wrapper
+        return decorator
+
+
+    def build_emf_document(self):
+        metric_definitions = [{"Name": name, "Unit": self.units.get(name, "Milliseconds")} for name in self.timings]
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [[DIMENSION_PLATFORM, DIMENSION_STATE, DIMENSION_ACCOUNT]],
+                    "Metrics": metric_definitions
+                }]
+            }
+        }
+        document.update(self.dimensions)
+        for name, values in self.timings.items():
+            document[name] = values[0] if len(values) == 1 else values
+        return document
+
+
+    # Writes the collected timings to stdout (picked up by CloudWatch Logs) and resets the collector
+    def flush(self):
+        if self.enabled is None:
+            self.enabled = get_metrics_enabled()
+        document = None
+        if self.enabled and self.timings:
+            document = self.build_emf_document()
+            print(json.dumps(document))
+        self.start_invocation()
+        return document
+
+
+class MetricsSpan:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics_mechanism, name):
+        self.metrics = metrics_mechanism
+        self.name = name
+        self.start = 0
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+# Metrics are on unless AOB_Metrics is explicitly set to 'Disabled'
+def get_metrics_enabled():
+    try:
+        ssm = boto3.client('ssm')
+        ssm_parameter = ssm.get_parameter(
+            Name=METRICS_PARAM
+        )
+        return ssm_parameter['Parameter']['Value'].lower() != METRICS_DISABLED.lower()
+    except Exception:
+        return True
+
+
+metrics = MetricsMechanism()
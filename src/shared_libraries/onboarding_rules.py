@@ -0,0 +1,97 @@
+import re
+import json
+import fnmatch
+import boto3
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+RULES_PARAM = 'AOB_Onboarding_Rules'  # JSON list of rules, the first rule matching an instance decides
+INCLUDE = 'include'
+EXCLUDE = 'exclude'
+# Rule fields and the instance attribute they match, a field is a glob pattern or a list of patterns
+RULE_FIELDS = {'ami': 'image_id', 'key_name': 'key_name', 'vpc': 'vpc_id', 'subnet': 'subnet_id',
+               'account': 'aws_account_id', 'region': 'region'}
+logger = LogMechanism()
+
+
+def get_rules_definition():
+    try:
+        ssm = boto3.client('ssm')
+        ssm_parameter = ssm.get_parameter(
+            Name=RULES_PARAM
+        )
+        return ssm_parameter['Parameter']['Value']
+    except Exception:
+        return None
+
+
+# Compiles a glob pattern, or a list of patterns any of which may match, into one regular expression
+def compile_patterns(patterns):
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    if not patterns or not all(isinstance(pattern, str) for pattern in patterns):
+        raise ValueError(f'{patterns} is not a pattern or a list of patterns')
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns))
+
+
+# A rule compiled once: every field of the rule must match the instance, a tag matches when the instance has it with a
+# value matching the pattern
+class OnboardingRule:
+    def __init__(self, definition, position):
+        self.action = definition.get('action', EXCLUDE)
+        if self.action not in (INCLUDE, EXCLUDE):
+            raise ValueError(f'unknown action {self.action}')
+        self.name = definition.get('name', f'#{position + 1}')
+        unknown_fields = set(definition) - set(RULE_FIELDS) - {'action', 'name', 'tags'}
+        if unknown_fields:
+            raise ValueError(f'unknown fields {sorted(unknown_fields)}')
+        self.matchers = [(attribute, compile_patterns(definition[field])) for field, attribute in RULE_FIELDS.items()
+                         if field in definition]
+        self.tag_matchers = [(key, compile_patterns(patterns)) for key, patterns in definition.get('tags', dict()).items()]
+
+
+    def matches(self, attributes, tags):
+        for attribute, pattern in self.matchers:
+            if not pattern.match(attributes.get(attribute) or ''):
+                return False
+        for key, pattern in self.tag_matchers:
+            if key not in tags or not pattern.match(tags[key]):
+                return False
+        return True
+
+
+# Decides from the EC2 details of an instance whether it is onboarded, before any vault work. The rules are read from
+# parameter store and compiled once per container. Without rules, or with rules that cannot be parsed, every instance
+# is onboarded
+class RuleEngine:
+    def __init__(self):
+        self.rules = None
+
+
+    def load(self):
+        self.rules = []
+        definition = get_rules_definition()
+        if not definition:
+            return
+        try:
+            self.rules = [OnboardingRule(rule, position) for position, rule in enumerate(json.loads(definition))]
+            logger.info(f'{len(self.rules)} onboarding rules loaded')
+        except Exception as e:
+            logger.error(f'Invalid {RULES_PARAM}, every instance is onboarded: {e}')
+            self.rules = []
+
+
+    # Returns the action and the name of the rule matching the instance, (INCLUDE, None) when no rule matches
+    def evaluate(self, instance_details, event_region):
+        if self.rules is None:
+            self.load()
+        attributes = dict(instance_details, region=event_region)
+        tags = instance_details.get('tags') or dict()
+        for rule in self.rules:
+            if rule.matches(attributes, tags):
+                logger.trace(rule.name, rule.action, caller_name='RuleEngine.evaluate')
+                return rule.action, rule.name
+        return INCLUDE, None
+
+
+onboarding_rules = RuleEngine()
@@ -0,0 +1,147 @@
+import io
+import os
+import gzip
+import time
+import uuid
+import pickle
+import random
+import marshal
+import pstats
+import cProfile
+import functools
+import threading
+import tracemalloc
+import boto3
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+PROFILING_RATE_PARAM = 'AOB_Profiling_Rate'  # Part of the invocations profiled, from 0 (off) to 1
+PROFILING_BUCKET_PARAM = 'AOB_Profiling_Bucket'  # S3 bucket of the profiles, they stay in PROFILES_DIRECTORY without it
+PROFILES_DIRECTORY = '/tmp/aob-profiles'
+PROFILES_PREFIX = 'aob-profiles'
+TOP_ENTRIES = 15  # Hot functions and allocation sites written to the log
+TRACEMALLOC_FRAMES = 1
+logger = LogMechanism()
+
+
+# Profiling settings from parameter store, profiling is off unless AOB_Profiling_Rate is set to a valid rate
+def get_profiling_config():
+    config = {PROFILING_RATE_PARAM: 0.0, PROFILING_BUCKET_PARAM: None}
+    try:
+        ssm = boto3.client('ssm')
+        ssm_response = ssm.get_parameters(Names=[PROFILING_RATE_PARAM, PROFILING_BUCKET_PARAM])
+        for parameter in ssm_response['Parameters']:
+            if parameter['Name'] == PROFILING_BUCKET_PARAM:
+                config[PROFILING_BUCKET_PARAM] = parameter['Value'].strip() or None
+                continue
+            try:
+                config[PROFILING_RATE_PARAM] = min(1.0, max(0.0, float(parameter['Value'])))
+            except ValueError:
+                logger.error(f"Invalid value of {parameter['Name']}, profiling is off")
+    except Exception:
+        pass
+    return config
+
+
+def upload_profile(bucket, key, data):
+    boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=data)
+
+
+# Profiles a sample of the invocations of the Lambda handlers with cProfile and tracemalloc. The settings are read once
+# per container, an invocation that is not sampled calls the handler directly. The stats of a sampled invocation are
+# written gzip compressed to PROFILES_DIRECTORY, or to the AOB_Profiling_Bucket bucket, and the hot functions and the
+# allocation sites are logged. Only the thread of the handler is profiled, the allocations are traced in all threads
+# until the last profiled invocation of the process ends
+class ProfilingMechanism:
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tracing = 0
+        self.stops_tracing = False
+        # None until resolved from parameter store on the first invocation of the container
+        self.rate = None
+        self.bucket = None
+
+
+    def load(self):
+        config = get_profiling_config()
+        self.rate = config[PROFILING_RATE_PARAM]
+        self.bucket = config[PROFILING_BUCKET_PARAM]
+        if self.rate:
+            logger.info(f'Profiling {self.rate:.0%} of the invocations')
+
+
+    def is_sampled(self):
+        if self.rate is None:
+            self.load()
+        return bool(self.rate) and random.random() < self.rate
+
+
+    # Decorator of a Lambda handler, name tells the profiles of the handlers apart
+    def profiled(self, name):
+        def decorator(handler):
+            @functools.wraps(handler)
+            def wrapper(event, context):
+                if not self.is_sampled():
+                    return handler(event, context)
+                return self.run(name, handler, event, context)
+            return wrapper
+        return decorator
+
+
+    def run(self, name, handler, event, context):
+        with self.lock:
+            if not self.tracing:
+                # Allocations traced by the caller are left traced
+                self.stops_tracing = not tracemalloc.is_tracing()
+                if self.stops_tracing:
+                    tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.tracing += 1
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            return profile.runcall(handler, event, context)
+        finally:
+            duration = time.perf_counter() - started
+            try:
+                snapshot = tracemalloc.take_snapshot()
+                self.report(name, getattr(context, 'aws_request_id', None), duration, profile, snapshot)
+            except Exception as e:
+                logger.error(f'Failed to write the profile of {name}: {e}')
+            finally:
+                with self.lock:
+                    self.tracing -= 1
+                    if not self.tracing and self.stops_tracing:
+                        tracemalloc.stop()
+
+
+    # Logs the hot functions and the allocation sites and saves the stats, returns where they were saved
+    def report(self, name, request_id, duration, profile, snapshot):
+        stats_output = io.StringIO()
+        # The stats are moved from the profile to the Stats object
+        stats = pstats.Stats(profile, stream=stats_output)
+        stats.sort_stats('cumulative').print_stats(TOP_ENTRIES)
+        logger.info(f'Profile of {name} ({duration * 1000:.0f} ms), top {TOP_ENTRIES} functions:\n{stats_output.getvalue()}')
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        allocations = snapshot.statistics('lineno')[:TOP_ENTRIES]
+        logger.info(f'Top {TOP_ENTRIES} allocation sites of {name}:\n' + '\n'.join(str(site) for site in allocations))
+        base_name = f'{name}/{int(self.clock())}-{request_id or uuid.uuid4()}'
+        files = {f'{base_name}.prof.gz': marshal.dumps(stats.stats),
+                 f'{base_name}.tracemalloc.gz': pickle.dumps(snapshot)}
+        return [self.save(file_name, gzip.compress(data)) for file_name, data in files.items()]
+
+
+    def save(self, file_name, data):
+        if self.bucket:
+            upload_profile(self.bucket, f'{PROFILES_PREFIX}/{file_name}', data)
+            location = f's3://{self.bucket}/{PROFILES_PREFIX}/{file_name}'
+        else:
+            location = os.path.join(PROFILES_DIRECTORY, file_name)
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+            with open(location, 'wb') as profile_file:
+                profile_file.write(data)
+        logger.info(f'Profile saved to {location}')
+        return location
+
+
+profiler = ProfilingMechanism()
@@ -1,13 +1,17 @@
+import json
 import requests
 from pvwa_integration import PvwaIntegration
 from log_mechanism import LogMechanism
+from metrics_mechanism import metrics
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
 DEFAULT_HEADER = {"content-type": "application/json"}
+BULK_UPLOAD_SOURCE = "AWS Auto On-Boarding Solution"
 pvwa_integration_class = PvwaIntegration()
 logger = LogMechanism()
 
 
+@metrics.timed('vault_create_account')
 def create_account_on_vault(session, account_name, account_password, store_parameters_class, platform_id, address,
                             instance_id, username, safe_name):
     logger.trace(session, account_name, store_parameters_class, platform_id, address,
@@ -37,6 +41,7 @@ def create_account_on_vault(session, account_name, account_password, store_param
     return False, f"Error Creating Account, Status Code:{rest_response.status_code}"
 
 
+@metrics.timed('vault_rotate_credentials')
 def rotate_credentials_immediately(session, pvwa_url, account_id, instance_id):
     logger.trace(session, pvwa_url, account_id, instance_id, caller_name='rotate_credentials_immediately')
     logger.info(f'Rotating {instance_id} credentials')
@@ -52,6 +57,62 @@ def rotate_credentials_immediately(session, pvwa_url, account_id, instance_id):
     return False
 
 
+# Secret management state of an account: CPM status of the last change and the time of the last successful change.
+# Returns None when the account no longer exists and False when the state could not be read
+@metrics.timed('vault_get_secret_management')
+def get_account_secret_management(session, account_id, instance_id, pvwa_url):
+    logger.trace(session, account_id, instance_id, pvwa_url, caller_name='get_account_secret_management')
+    header = DEFAULT_HEADER
+    header.update({"Authorization": session})
+    url = f"{pvwa_url}/api/Accounts/{account_id}"
+    rest_response = pvwa_integration_class.call_rest_api_get(url, header)
+    if rest_response is None:
+        logger.error(f"Failed to get the account of {instance_id}, PVWA did not respond")
+        return False
+    if rest_response.status_code == requests.codes.ok:
+        return rest_response.json().get('secretManagement', dict())
+    if rest_response.status_code == requests.codes.not_found:
+        logger.info(f"Account {account_id} for instance {instance_id}, not found on vault")
+        return None
+    logger.error(f"Unexpected result from rest service - get account, status code: {rest_response.status_code}")
+    return False
+
+
+# Submits a bulk upload job of accounts (PVWA v2 bulk actions), returns the job id or False when it was not accepted
+@metrics.timed('vault_bulk_upload')
+def create_bulk_accounts_job(session, accounts, pvwa_url):
+    logger.trace(session, len(accounts), pvwa_url, caller_name='create_bulk_accounts_job')
+    logger.info(f'Submitting a bulk upload of {len(accounts)} accounts')
+    header = DEFAULT_HEADER
+    header.update({"Authorization": session})
+    url = f"{pvwa_url}/api/bulkactions/accounts"
+    data = json.dumps({"source": BULK_UPLOAD_SOURCE, "accountsList": accounts})
+    rest_response = pvwa_integration_class.call_rest_api_post(url, data, header)
+    if rest_response is not None and rest_response.status_code in (requests.codes.ok, requests.codes.created,
+                                                                   requests.codes.accepted):
+        job = rest_response.json()
+        return job.get('id') if isinstance(job, dict) else job
+    status_code = rest_response.status_code if rest_response is not None else None
+    logger.error(f'Failed to submit the bulk upload of {len(accounts)} accounts. status code:{status_code}')
+    return False
+
+
+# Status and per-account results of a bulk upload job, False when the job could not be read
+@metrics.timed('vault_bulk_status')
+def get_bulk_accounts_job(session, job_id, pvwa_url):
+    logger.trace(session, job_id, pvwa_url, caller_name='get_bulk_accounts_job')
+    header = DEFAULT_HEADER
+    header.update({"Authorization": session})
+    url = f"{pvwa_url}/api/bulkactions/accounts/{job_id}"
+    rest_response = pvwa_integration_class.call_rest_api_get(url, header)
+    if rest_response is not None and rest_response.status_code == requests.codes.ok:
+        return rest_response.json()
+    status_code = rest_response.status_code if rest_response is not None else None
+    logger.error(f'Failed to get the bulk upload job {job_id}. status code:{status_code}')
+    return False
+
+
+@metrics.timed('vault_retrieve_key_pair')
 def get_account_value(session, account, instance_id, rest_url):
     logger.trace(session, account, instance_id, rest_url, caller_name='get_account_value')
     logger.info(f'Getting {instance_id} account from vault')
@@ -69,6 +130,7 @@ def get_account_value(session, account, instance_id, rest_url):
     return False
 
 
+@metrics.timed('vault_delete_account')
 def delete_account_from_vault(session, account_id, instance_id, pvwa_url):
     logger.trace(session, account_id, instance_id, pvwa_url, caller_name='delete_account_from_vault')
     logger.info(f'Deleting {instance_id} from vault')
@@ -88,6 +150,7 @@ def delete_account_from_vault(session, account_id, instance_id, pvwa_url):
     return True
 
 
+@metrics.timed('vault_search_key_pair')
 def check_if_kp_exists(session, account_name, safe_name, instance_id, rest_url):
     logger.trace(session, account_name, safe_name, instance_id, rest_url, caller_name='check_if_kp_exists')
     logger.info('Checking if key pair is onboarded')
@@ -116,6 +179,7 @@ def check_if_kp_exists(session, account_name, safe_name, instance_id, rest_url):
     raise Exception(f"Status code {rest_response.status_code}, received from REST service")
 
 
+@metrics.timed('vault_search_account')
 def retrieve_account_id_from_account_name(session, account_name, safe_name, instance_id, rest_url):
     logger.trace(session, account_name, safe_name, instance_id, rest_url, caller_name='retrieve_account_id_from_account_name')
     logger.info('Retrieving account_id from account_name')
@@ -151,3 +215,103 @@ def filter_get_accounts_result(parsed_json_response, instance_id):
         if instance_id in element['name']:
             return element['id']
     return False
+
+
+# Creating a safe, a single attempt. pvwa_integration is the integration of the caller, the environment setup has its own
+@metrics.timed('vault_create_safe')
+def create_safe(session, safe_name, cpm_name, rest_url, number_of_days_retention=7, pvwa_integration=None):
+    logger.trace(session, safe_name, cpm_name, rest_url, number_of_days_retention, caller_name='create_safe')
+    header = DEFAULT_HEADER
+    header.update({"Authorization": session})
+    create_safe_url = f"{rest_url}/WebServices/PIMServices.svc/Safes"
+    # Create new safe, default number of days retention is 7, unless specified otherwise
+    data = f"""
+            {{
+            "safe":{{
+                "SafeName":"{safe_name}",
+                "Description":"",
+                "OLACEnabled":false,
+                "ManagingCPM":"{cpm_name}",
+                "NumberOfDaysRetention":"{number_of_days_retention}"
+              }}
+            }}
+            """
+
+    create_safe_rest_response = (pvwa_integration or pvwa_integration_class).call_rest_api_post(create_safe_url, data, header)
+    if create_safe_rest_response is None:
+        logger.error(f"Failed to create Safe {safe_name}, no response from PVWA")
+        return False
+    if create_safe_rest_response.status_code == requests.codes.conflict:
+        logger.info(f"The Safe {safe_name} already exists")
+        return True
+    elif create_safe_rest_response.status_code == requests.codes.bad_request:
+        logger.error(f"Failed to create Safe {safe_name}, error 400: bad request")
+        return False
+    elif create_safe_rest_response.status_code == requests.codes.created:  # safe created
+        logger.info(f"Safe {safe_name} was successfully created")
+        return True
+    logger.error(f"Error creating Safe, status code:{create_safe_rest_response.status_code}")
+    return False
+
+
+# Details of a safe (ManagingCPM, NumberOfDaysRetention...), False when the safe does not exist
+@metrics.timed('vault_get_safe')
+def get_safe(session, safe_name, rest_url):
+    logger.trace(session, safe_name, rest_url, caller_name='get_safe')
+    header = DEFAULT_HEADER
+    header.update({"Authorization": session})
+    url = f"{rest_url}/WebServices/PIMServices.svc/Safes/{safe_name}"
+    rest_response = pvwa_integration_class.call_rest_api_get(url, header)
+    if rest_response is None:
+        raise Exception(f"Unknown Error when calling rest service - get safe {safe_name}")
+    if rest_response.status_code == requests.codes.not_found:
+        return False
+    if rest_response.status_code == requests.codes.ok:
+        return rest_response.json().get('GetSafeResult', dict())
+    logger.error(f"Status code {rest_response.status_code}, received from REST service")
+    raise Exception(f"Status code {rest_response.status_code}, received from REST service")
+
+
+# Users and groups of a safe (memberName, memberType, permissions...), the predefined vault users are left out
+@metrics.timed('vault_get_safe_members')
+def get_safe_members(session, safe_name, rest_url, page_size=100):
+    logger.trace(session, safe_name, rest_url, caller_name='get_safe_members')
+    header = DEFAULT_HEADER
+    header.update({"Authorization": session})
+    members = []
+    offset = 0
+    while True:
+        url = f"{rest_url}/api/Safes/{safe_name}/Members?limit={page_size}&offset={offset}"
+        rest_response = pvwa_integration_class.call_rest_api_get(url, header)
+        if rest_response is None:
+            raise Exception(f"Unknown Error when calling rest service - get members of safe {safe_name}")
+        if rest_response.status_code != requests.codes.ok:
+            logger.error(f"Status code {rest_response.status_code}, received from REST service")
+            raise Exception(f"Status code {rest_response.status_code}, received from REST service")
+        page = rest_response.json()
+        members += [member for member in page['value'] if not member.get('isPredefinedUser')]
+        offset += len(page['value'])
+        if not page['value'] or offset >= page.get('count', 0):
+            return members
+
+
+# Adds a user or group to a safe with the given permissions, a member already in the safe keeps its permissions
+@metrics.timed('vault_add_safe_member')
+def add_safe_member(session, safe_name, member, rest_url):
+    logger.trace(session, safe_name, member['memberName'], rest_url, caller_name='add_safe_member')
+    header = DEFAULT_HEADER
+    header.update({"Authorization": session})
+    url = f"{rest_url}/api/Safes/{safe_name}/Members"
+    data = json.dumps({'memberName': member['memberName'], 'memberType': member.get('memberType', 'User'),
+                       'searchIn': 'Vault', 'permissions': member['permissions']})
+    rest_response = pvwa_integration_class.call_rest_api_post(url, data, header)
+    if rest_response is None:
+        logger.error(f"Failed to add {member['memberName']} to Safe {safe_name}, no response from PVWA")
+        return False
+    if rest_response.status_code == requests.codes.created:
+        return True
+    if rest_response.status_code == requests.codes.conflict:
+        logger.info(f"{member['memberName']} is already a member of Safe {safe_name}")
+        return True
+    logger.error(f"Failed to add {member['memberName']} to Safe {safe_name}, status code:{rest_response.status_code}")
+    return False
@@ -1,6 +1,8 @@
 import requests
 import aws_services
 from log_mechanism import LogMechanism
+from metrics_mechanism import metrics
+from pvwa_routing import pvwa_router
 
 DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
 DEFAULT_HEADER = {"content-type": "application/json"}
@@ -8,72 +10,87 @@ DEFAULT_HEADER = {"content-type": "application/json"}
 
 
 class PvwaIntegration:
+    # aob_mode of the container, shared by all the instances and read from parameter store on first REST call
+    shared_environment = None
+
     def __init__(self, is_safe_handler=False, safe_handler_environment=None):
         self.logger = LogMechanism()
-        self.logger.trace(is_safe_handler, safe_handler_environment, caller_name='__init__')
         self.is_safe_handler = is_safe_handler
         self.safe_handler_environment = safe_handler_environment
-        try:
-            self.logger.info('Getting parameters from parameter store')
-            if not is_safe_handler:
-                parameters = aws_services.get_params_from_param_store()
-                environment = parameters.aob_mode
-            else:
-                environment = self.safe_handler_environment
-            if environment == 'Production':
-                self.logger.info(f'{environment} Environment Detected', DEBUG_LEVEL_DEBUG)
-                self.certificate = "/tmp/server.crt"
-            else:
-                self.certificate = False
-                self.logger.info(f'{environment} Environment Detected', DEBUG_LEVEL_DEBUG)
-        except Exception as e:
-            self.logger.error(f'Failed to retrieve aob_mode parameter: {str(e)}')
-            raise Exception("Error occurred while retrieving aob_mode parameter")
+
+
+    @property
+    def certificate(self):
+        if self.get_environment() == 'Production':
+            return "/tmp/server.crt"
+        return False
+
+
+    def get_environment(self):
+        if self.is_safe_handler:
+            return self.safe_handler_environment
+        if PvwaIntegration.shared_environment is None:
+            try:
+                self.logger.info('Getting parameters from parameter store')
+                PvwaIntegration.shared_environment = aws_services.get_params_from_param_store().aob_mode
+                self.logger.info(f'{PvwaIntegration.shared_environment} Environment Detected', DEBUG_LEVEL_DEBUG)
+            except Exception as e:
+                self.logger.error(f'Failed to retrieve aob_mode parameter: {str(e)}')
+                raise Exception("Error occurred while retrieving aob_mode parameter")
+        return PvwaIntegration.shared_environment
+
+
+    # Parameters already retrieved by the handler, saves a parameter store round trip on the first REST call
+    @staticmethod
+    def set_environment(environment):
+        PvwaIntegration.shared_environment = environment
 
 
     def call_rest_api_get(self, url, header):
         self.logger.trace(url, header, caller_name='call_rest_api_get')
-        self.url = url
-        self.header = header
+        node_call = pvwa_router.start(url)
         try:
             self.logger.info(f'Invoking get request url:{url}, header: {header}', DEBUG_LEVEL_DEBUG)
-            rest_response = requests.get(self.url, timeout=30, verify=self.certificate, headers=self.header)
+            rest_response = requests.get(url, timeout=30, verify=self.certificate, headers=header)
         except Exception as e:
+            pvwa_router.finish(node_call, None)
             self.logger.error(f"An error occurred on calling PVWA REST service: {str(e)}")
             return None
+        pvwa_router.finish(node_call, rest_response)
         return rest_response
 
 
     def call_rest_api_delete(self, url, header):
         self.logger.trace(url, header, caller_name='call_rest_api_delete')
-        self.url = url
-        self.header = header
+        node_call = pvwa_router.start(url)
         try:
             self.logger.info(f'Invoking delete request url {url}, header: {header}', DEBUG_LEVEL_DEBUG)
-            response = requests.delete(self.url, timeout=30, verify=self.certificate, headers=self.header)
+            response = requests.delete(url, timeout=30, verify=self.certificate, headers=header)
         except Exception as e:
+            pvwa_router.finish(node_call, None)
             self.logger.error(f'Failed to Invoke delete request: {str(e)}')
             return None
+        pvwa_router.finish(node_call, response)
         return response
 
 
     def call_rest_api_post(self, url, request, header):
         self.logger.trace(url, header, caller_name='call_rest_api_post')
-        self.url = url
-        self.request = request
-        self.header = header
+        node_call = pvwa_router.start(url)
         try:
             self.logger.info(f'Invoking post request url: {url} , header: {header}', DEBUG_LEVEL_DEBUG)
-            rest_response = requests.post(self.url, data=self.request, timeout=30, verify=self.certificate, headers=self.header,
-                                          stream=True)
+            rest_response = requests.post(url, data=request, timeout=30, verify=self.certificate, headers=header, stream=True)
         except Exception as e:
+            pvwa_router.finish(node_call, None)
             self.logger.error(f"Error occurred during POST request to PVWA: {str(e)}")
             return None
+        pvwa_router.finish(node_call, rest_response)
         return rest_response
 
 
     # PvwaIntegration:
     # performs logon to PVWA and return the session token
+    @metrics.timed('pvwa_logon')
     def logon_pvwa(self, username, password, pvwa_url, connection_session_id):
         self.logger.trace(pvwa_url, connection_session_id, caller_name='logon_pvwa')
         self.username = username
@@ -105,6 +122,7 @@ class PvwaIntegration:
         raise Exception("PVWA authentication failed")
 
 
+    @metrics.timed('pvwa_logoff')
     def logoff_pvwa(self, pvwa_url, connection_session_token):
         self.logger.trace(pvwa_url, connection_session_token, caller_name='logoff_pvwa')
         self.pvwa_url = pvwa_url
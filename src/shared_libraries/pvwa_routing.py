@@ -0,0 +1,144 @@
+import time
+import random
+import threading
+import boto3
+import session_slots
+from adaptive_concurrency import pvwa_concurrency
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+ROUTING_PARAM = 'AOB_PVWA_Routing'  # LeastOutstanding or LatencyWeighted
+NODE_SLOTS_PARAM = 'AOB_PVWA_Node_Slots'  # Session slots of each PVWA node, the nodes share the vault connection numbers
+LEAST_OUTSTANDING = 'LeastOutstanding'
+LATENCY_WEIGHTED = 'LatencyWeighted'
+FAILURE_THRESHOLD = 3  # Consecutive failed calls after which a node gets no new session
+DOWN_SECONDS = 30  # Time a failing node is left alone before it is tried again
+LATENCY_SMOOTHING = 0.3  # Weight of the last call in the latency average of a node
+INITIAL_LATENCY_SECONDS = 0.1
+logger = LogMechanism()
+
+
+# Routing settings from parameter store, the slot budget defaults to an equal share of the vault connection numbers
+def get_routing_config(node_count):
+    config = {ROUTING_PARAM: LEAST_OUTSTANDING, NODE_SLOTS_PARAM: session_slots.SLOT_COUNT // node_count}
+    try:
+        ssm = boto3.client('ssm')
+        ssm_response = ssm.get_parameters(Names=[ROUTING_PARAM, NODE_SLOTS_PARAM])
+        for parameter in ssm_response['Parameters']:
+            if parameter['Name'] == ROUTING_PARAM and parameter['Value'] in (LEAST_OUTSTANDING, LATENCY_WEIGHTED):
+                config[ROUTING_PARAM] = parameter['Value']
+            elif parameter['Name'] == NODE_SLOTS_PARAM and parameter['Value'].isdigit() and int(parameter['Value']):
+                config[NODE_SLOTS_PARAM] = int(parameter['Value'])
+            else:
+                logger.error(f"Invalid value of {parameter['Name']}, using {config[parameter['Name']]}")
+    except Exception as e:
+        logger.error(f'Failed to read the PVWA routing parameters, using the defaults: {e}')
+    if config[NODE_SLOTS_PARAM] * node_count > session_slots.SLOT_COUNT:
+        config[NODE_SLOTS_PARAM] = session_slots.SLOT_COUNT // node_count
+        logger.error(f'{node_count} PVWA nodes cannot have more than {config[NODE_SLOTS_PARAM]} session slots each')
+    return config
+
+
+# A PVWA node and what this container saw of it: calls in flight, latency average and consecutive failures.
+# The node owns the session slots first_slot to last_slot
+class PvwaNode:
+    def __init__(self, url, first_slot, last_slot):
+        self.url = url
+        self.first_slot = first_slot
+        self.last_slot = last_slot
+        self.outstanding = 0
+        self.latency = INITIAL_LATENCY_SECONDS
+        self.failures = 0
+        self.down_until = 0
+
+
+    def is_healthy(self, now):
+        return self.failures < FAILURE_THRESHOLD or now >= self.down_until
+
+
+# Chooses the PVWA node of each new session. Health is passive: the calls of the sessions are timed and counted by
+# node, and a node failing FAILURE_THRESHOLD calls in a row gets no new session for DOWN_SECONDS. A session stays on the
+# node it was opened on, its token is only valid there
+class PvwaRouter:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.nodes = []
+        self.strategy = LEAST_OUTSTANDING
+
+
+    def set_nodes(self, pvwa_urls):
+        if [node.url for node in self.nodes] == list(pvwa_urls):
+            return
+        config = get_routing_config(len(pvwa_urls))
+        node_slots = config[NODE_SLOTS_PARAM]
+        self.strategy = config[ROUTING_PARAM]
+        self.nodes = [PvwaNode(url, index * node_slots + 1, (index + 1) * node_slots) for index, url in enumerate(pvwa_urls)]
+        logger.info(f'Routing to {len(self.nodes)} PVWA nodes with {node_slots} session slots each ({self.strategy})')
+
+
+    def select(self, pvwa_urls):
+        with self.lock:
+            self.set_nodes(pvwa_urls)
+            now = self.clock()
+            candidates = [node for node in self.nodes if node.is_healthy(now)]
+            if not candidates:
+                # Every node is failing, the one down the longest is tried first
+                return min(self.nodes, key=lambda node: node.down_until)
+            if self.strategy == LATENCY_WEIGHTED:
+                return random.choices(candidates, weights=[1 / max(node.latency, 0.001) for node in candidates])[0]
+            fewest = min(node.outstanding for node in candidates)
+            return random.choice([node for node in candidates if node.outstanding == fewest])
+
+
+    def get_node(self, url):
+        for node in self.nodes:
+            if url.startswith(node.url):
+                return node
+        return None
+
+
+    # Counts a call to a node as outstanding until finish is called with its response, None when it failed
+    def start(self, url):
+        with self.lock:
+            node = self.get_node(url)
+            if not node:
+                return None
+            node.outstanding += 1
+        return node, self.clock()
+
+
+    def finish(self, call, response):
+        if not call:
+            return
+        node, started = call
+        seconds = self.clock() - started
+        failed = response is None or response.status_code >= 500
+        pvwa_concurrency.observe(seconds, failed)
+        with self.lock:
+            node.outstanding -= 1
+            node.latency += LATENCY_SMOOTHING * (seconds - node.latency)
+            if not failed:
+                node.failures = 0
+                return
+            node.failures += 1
+            if node.failures >= FAILURE_THRESHOLD:
+                node.down_until = self.clock() + DOWN_SECONDS
+                if node.failures == FAILURE_THRESHOLD:
+                    logger.error(f'PVWA node {node.url} failed {node.failures} calls in a row, '
+                                 f'no new session for {DOWN_SECONDS} seconds')
+
+
+pvwa_router = PvwaRouter()
+
+
+# Chooses the node of a new session and leases one of its slots, the node hands out the share of its slots allowed by
+# the adaptive session limit. Returns the lease, None when the node has no free slot, and the parameters pinned to the node.
+# The wait for a slot stops with DeadlineExceeded when the deadline leaves no time to use it
+def acquire_node_slot(store_parameters_class, deadline=None):
+    node = pvwa_router.select(store_parameters_class.pvwa_urls)
+    node_slots = node.last_slot - node.first_slot + 1
+    allowed_slots = max(1, node_slots * pvwa_concurrency.get_limit() // session_slots.SLOT_COUNT)
+    slot_lease = session_slots.acquire_slot(first_slot=node.first_slot, last_slot=node.first_slot + allowed_slots - 1,
+                                            deadline=deadline)
+    return slot_lease, store_parameters_class.pinned_to(node.url)
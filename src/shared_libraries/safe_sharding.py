@@ -0,0 +1,124 @@
+import hashlib
+import threading
+import boto3
+import pvwa_api_calls
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+SHARDS_PARAM = 'AOB_Safe_Shards'  # Safes the accounts of a platform are spread over, 1 keeps every account in its safe
+SHARD_KEY_PARAM = 'AOB_Safe_Shard_Key'  # InstanceId or AccountId, the accounts of an AWS account then share a safe
+SHARD_BY_INSTANCE = 'InstanceId'
+SHARD_BY_ACCOUNT = 'AccountId'
+MAX_SHARDS = 100
+SAFE_NAME_LENGTH = 28  # Longest safe name the vault accepts
+DEFAULT_RETENTION_DAYS = 7
+logger = LogMechanism()
+
+
+# Sharding settings from parameter store, a missing or invalid parameter keeps its default
+def get_sharding_config():
+    config = {SHARDS_PARAM: 1, SHARD_KEY_PARAM: SHARD_BY_INSTANCE}
+    try:
+        ssm = boto3.client('ssm')
+        ssm_response = ssm.get_parameters(Names=[SHARDS_PARAM, SHARD_KEY_PARAM])
+        for parameter in ssm_response['Parameters']:
+            if parameter['Name'] == SHARDS_PARAM and parameter['Value'].isdigit() and \
+                    1 <= int(parameter['Value']) <= MAX_SHARDS:
+                config[SHARDS_PARAM] = int(parameter['Value'])
+            elif parameter['Name'] == SHARD_KEY_PARAM and parameter['Value'] in (SHARD_BY_INSTANCE, SHARD_BY_ACCOUNT):
+                config[SHARD_KEY_PARAM] = parameter['Value']
+            else:
+                logger.error(f"Invalid value of {parameter['Name']}, using {config[parameter['Name']]}")
+    except Exception as e:
+        logger.error(f'Failed to read the safe sharding parameters, using the defaults: {e}')
+    return config
+
+
+# Jump consistent hash of a key over shard_count shards: the shard of a key only changes when the number of shards
+# grows, and then only to one of the new shards
+def get_shard(key, shard_count):
+    key_value = int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], 'big')
+    shard = -1
+    next_shard = 0
+    while next_shard < shard_count:
+        shard = next_shard
+        key_value = (key_value * 2862933555777941757 + 1) % 2 ** 64
+        next_shard = int((shard + 1) * (float(1 << 31) / float((key_value >> 33) + 1)))
+    return shard
+
+
+# The first shard is the configured safe itself, so enabling sharding moves no existing account
+def get_shard_safe_name(base_safe_name, shard):
+    if not shard:
+        return base_safe_name
+    suffix = f'_{shard:02d}'
+    return base_safe_name[:SAFE_NAME_LENGTH - len(suffix)] + suffix
+
+
+# Spreads the accounts of a platform over the shard safes of its configured safe. The safe of an account is recorded on
+# its Instances row (SafeName), the searches and deletes of an onboarded instance go to that safe only. A shard safe is
+# created on first use with the CPM and retention of the configured safe, and the users and groups of the configured safe
+# are added to it with their permissions. The settings and the safes known to be ready are kept for the life of the
+# container
+class SafeSharding:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.config = None
+        self.known_safes = set()
+
+
+    def get_config(self):
+        if self.config is None:
+            self.config = get_sharding_config()
+            if self.config[SHARDS_PARAM] > 1:
+                logger.info(f'Spreading the accounts over {self.config[SHARDS_PARAM]} safes by {self.config[SHARD_KEY_PARAM]}')
+        return self.config
+
+
+    def get_safe_name(self, base_safe_name, instance_id, aws_account_id):
+        config = self.get_config()
+        if config[SHARDS_PARAM] == 1:
+            return base_safe_name
+        key = aws_account_id if config[SHARD_KEY_PARAM] == SHARD_BY_ACCOUNT and aws_account_id else instance_id
+        return get_shard_safe_name(base_safe_name, get_shard(key, config[SHARDS_PARAM]))
+
+
+    # Creates the shard safe when it does not exist yet and gives it the members of the configured safe, returns False
+    # when it could not be created or a member could not be added: its accounts would be hidden from that member
+    def ensure_safe(self, session, safe_name, base_safe_name, rest_url):
+        if safe_name == base_safe_name or safe_name in self.known_safes:
+            return True
+        # One creation per container, the other events wait for it instead of racing
+        with self.lock:
+            if safe_name in self.known_safes:
+                return True
+            logger.trace(safe_name, base_safe_name, caller_name='SafeSharding.ensure_safe')
+            if not pvwa_api_calls.get_safe(session, safe_name, rest_url):
+                base_safe = pvwa_api_calls.get_safe(session, base_safe_name, rest_url)
+                if not base_safe:
+                    logger.error(f'The Safe {base_safe_name} does not exist, its shard {safe_name} is not created')
+                    return False
+                logger.info(f'Creating the shard Safe {safe_name} of {base_safe_name}')
+                if not pvwa_api_calls.create_safe(session, safe_name, base_safe.get('ManagingCPM', ''), rest_url,
+                                                  base_safe.get('NumberOfDaysRetention', DEFAULT_RETENTION_DAYS)):
+                    return False
+            # Checked by every container, a container stopped after creating the safe may not have added them all
+            if not self.copy_members(session, base_safe_name, safe_name, rest_url):
+                return False
+            self.known_safes.add(safe_name)
+            return True
+
+
+    def copy_members(self, session, base_safe_name, safe_name, rest_url):
+        shard_members = {member['memberName'] for member in pvwa_api_calls.get_safe_members(session, safe_name, rest_url)}
+        for member in pvwa_api_calls.get_safe_members(session, base_safe_name, rest_url):
+            if member['memberName'] in shard_members:
+                continue
+            logger.info(f"Adding {member['memberName']} to the shard Safe {safe_name} with its {base_safe_name} permissions")
+            if not pvwa_api_calls.add_safe_member(session, safe_name, member, rest_url):
+                logger.error(f"The shard Safe {safe_name} is not used until {member['memberName']} is one of its members")
+                return False
+        return True
+
+
+safe_sharding = SafeSharding()
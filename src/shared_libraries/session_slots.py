@@ -0,0 +1,167 @@
+import time
+import uuid
+import random
+import threading
+from dynamo_access import dynamo_access
+from log_mechanism import LogMechanism
+from metrics_mechanism import metrics
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+SESSIONS_TABLE = 'Sessions'
+SLOT_COUNT = 100  # PVWA connection numbers shared by all the containers
+LEASE_SECONDS = 60  # A slot whose lease was not renewed for this long is free again
+HEARTBEAT_SECONDS = 20  # Renewal period of a held lease
+SLOT_ATTEMPTS = 20
+SLOT_RETRY_SECONDS = 5
+SLOT_SESSION_SECONDS = 10  # Time a caller with a deadline needs left to use a slot once it got it
+SLOT_STEP = 'session slot'
+logger = LogMechanism()
+
+
+def get_dynamo_client():
+    return dynamo_access.get_client()
+
+
+# Session slot held by this container. The lease is renewed by a heartbeat thread until it is released, a container
+# that stops without releasing it loses the slot once the lease expires. Release is safe to call more than once and
+# only removes the slot while this lease still holds it
+class SlotLease:
+    def __init__(self, slot, guid, lease_seconds=LEASE_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS, dynamo_client=None):
+        self.slot = slot
+        self.guid = guid
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.dynamo_client = dynamo_client or get_dynamo_client()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.released = False
+        self.lost = False
+        self.heartbeat = threading.Thread(target=self.renew_until_released, name=f'slot-{slot}-heartbeat', daemon=True)
+        self.heartbeat.start()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+    def renew_until_released(self):
+        while not self.stopped.wait(self.heartbeat_seconds):
+            if not self.renew():
+                return
+
+
+    def renew(self):
+        try:
+            self.dynamo_client.update_item(
+                TableName=SESSIONS_TABLE, Key={'name': {'S': self.slot}},
+                UpdateExpression='SET expiresOn = :expires_on', ConditionExpression='guid = :guid',
+                ExpressionAttributeValues={':expires_on': {'N': str(time.time() + self.lease_seconds)},
+                                           ':guid': {'S': self.guid}})
+            return True
+        except Exception as e:
+            if 'ConditionalCheckFailed' in str(e):
+                logger.error(f'Session slot {self.slot} was taken over, its lease had expired')
+                self.lost = True
+                return False
+            # A failed renewal is retried on the next heartbeat, the lease leaves room for it
+            logger.error(f'Failed to renew the lease of session slot {self.slot}: {e}')
+            return True
+
+
+    @metrics.timed('dynamo_slot_release')
+    def release(self):
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.stopped.set()
+        if self.heartbeat is not threading.current_thread():
+            self.heartbeat.join()
+        logger.info(f'Releasing session slot {self.slot}')
+        try:
+            self.dynamo_client.delete_item(TableName=SESSIONS_TABLE, Key={'name': {'S': self.slot}},
+                                           ConditionExpression='guid = :guid',
+                                           ExpressionAttributeValues={':guid': {'S': self.guid}})
+        except Exception as e:
+            if 'ConditionalCheckFailed' not in str(e):
+                logger.error(f'Failed to release session slot {self.slot}: {e}')
+
+
+# Takes a free session slot: a random slot between first_slot and last_slot is tried and taken when it has no lease or
+# its lease expired. Returns the lease, or None when no slot was found after SLOT_ATTEMPTS attempts. A caller passing
+# its deadline gets DeadlineExceeded instead of another wait when the wait and the session would not fit in the time left
+@metrics.timed('dynamo_slot_wait')
+def acquire_slot(lease_seconds=LEASE_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS, attempts=SLOT_ATTEMPTS,
+                 retry_seconds=SLOT_RETRY_SECONDS, first_slot=1, last_slot=SLOT_COUNT, deadline=None):
+    logger.info("Getting available Session from DynamoDB")
+    dynamo_client = get_dynamo_client()
+    for attempt in range(attempts):
+        if deadline:
+            deadline.require(SLOT_SESSION_SECONDS, SLOT_STEP)
+        slot = str(random.randint(first_slot, last_slot))
+        guid = str(uuid.uuid4())
+        now = time.time()
+        try:
+            dynamo_client.put_item(TableName=SESSIONS_TABLE,
+                                   Item={'name': {'S': slot}, 'guid': {'S': guid},
+                                         'expiresOn': {'N': str(now + lease_seconds)}},
+                                   ConditionExpression='attribute_not_exists(guid) OR expiresOn < :now',
+                                   ExpressionAttributeValues={':now': {'N': str(now)}})
+        except Exception as e:
+            if 'ConditionalCheckFailed' not in str(e):
+                raise Exception(f"Exception on acquire_slot: {str(e)}")
+            if attempt < attempts - 1:
+                if deadline:
+                    deadline.require(retry_seconds + SLOT_SESSION_SECONDS, SLOT_STEP)
+                time.sleep(retry_seconds)
+            continue
+        logger.info(f"Successfully retrieved session slot {slot} from DynamoDB")
+        return SlotLease(slot, guid, lease_seconds, heartbeat_seconds, dynamo_client)
+    logger.info("Connection limit has been reached")
+    return None
+
+
+def scan_slots(dynamo_client):
+    items = []
+    scan_arguments = {'TableName': SESSIONS_TABLE, 'ConsistentRead': True}
+    while True:
+        response = dynamo_client.scan(**scan_arguments)
+        items += [item for item in response.get('Items', []) if item['name']['S'].isdigit() and 'guid' in item]
+        if 'LastEvaluatedKey' not in response:
+            return items
+        scan_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# Leased, expired and free session slots
+def get_slot_occupancy():
+    now = time.time()
+    items = scan_slots(get_dynamo_client())
+    leased = sum(1 for item in items if float(item['expiresOn']['N']) >= now)
+    return {'leased': leased, 'expired': len(items) - leased, 'free': SLOT_COUNT - leased}
+
+
+# Removes the slots whose lease expired, those of containers that stopped without releasing them. A slot renewed or
+# taken over in the meantime is kept. Returns the number of slots reclaimed
+def sweep_expired_slots():
+    dynamo_client = get_dynamo_client()
+    now = time.time()
+    reclaimed = 0
+    for item in scan_slots(dynamo_client):
+        if float(item['expiresOn']['N']) >= now:
+            continue
+        try:
+            dynamo_client.delete_item(TableName=SESSIONS_TABLE, Key={'name': item['name']},
+                                      ConditionExpression='guid = :guid AND expiresOn < :now',
+                                      ExpressionAttributeValues={':guid': item['guid'], ':now': {'N': str(now)}})
+            reclaimed += 1
+        except Exception as e:
+            if 'ConditionalCheckFailed' not in str(e):
+                logger.error(f"Failed to reclaim session slot {item['name']['S']}: {e}")
+    if reclaimed:
+        logger.info(f'{reclaimed} expired session slots reclaimed')
+    return reclaimed
@@ -0,0 +1,94 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from deadline_mechanism import retry_with_jitter
+from log_mechanism import LogMechanism
+
+DEBUG_LEVEL_DEBUG = 'debug' # Outputs all information
+logger = LogMechanism()
+
+TaskResult = namedtuple('TaskResult', ['succeeded', 'value', 'error'])
+Task = namedtuple('Task', ['name', 'function', 'depends_on', 'attempts', 'on_abandoned'])
+
+
+# Runs small provisioning steps concurrently, each step starts as soon as the steps it depends on succeeded.
+# A step succeeds when its function returns a truthy value, failed steps are retried with jitter while the
+# deadline allows it, and steps depending on a failed step are skipped. A step abandoned at the deadline may still
+# complete later, its on_abandoned function is then called with the value it returned, to undo what it did
+class TaskGraph:
+    def __init__(self, deadline, max_workers=8):
+        self.deadline = deadline
+        self.max_workers = max_workers
+        self.tasks = []
+        self.results = dict()
+
+
+    def add_task(self, name, function, depends_on=(), attempts=3, on_abandoned=None):
+        self.tasks.append(Task(name, function, tuple(depends_on), attempts, on_abandoned))
+
+
+    def run_task(self, task):
+        logger.info(f'Starting step {task.name}', DEBUG_LEVEL_DEBUG)
+        return retry_with_jitter(task.function, self.deadline, task.attempts, logger=logger, name=task.name)
+
+
+    # Submits the waiting tasks whose dependencies are resolved, repeats as skipping a task may resolve others
+    def schedule(self, waiting, running, results, executor):
+        changed = True
+        while changed:
+            changed = False
+            for task in list(waiting):
+                failed_dependencies = [name for name in task.depends_on if name in results and not results[name].succeeded]
+                if failed_dependencies:
+                    waiting.remove(task)
+                    results[task.name] = TaskResult(False, None, f'Skipped, {failed_dependencies[0]} failed')
+                    changed = True
+                elif all(name in results for name in task.depends_on):
+                    waiting.remove(task)
+                    running[executor.submit(self.run_task, task)] = task.name
+
+
+    def get_task(self, name):
+        return next(task for task in self.tasks if task.name == name)
+
+
+    # Done callback of a step abandoned at the deadline, calls its on_abandoned function when it succeeded
+    def undo_abandoned(self, task):
+        def on_done(future):
+            if task.on_abandoned is None or future.exception() is not None or not future.result():
+                return
+            logger.info(f'Step {task.name} completed after it was abandoned, undoing it')
+            try:
+                task.on_abandoned(future.result())
+            except Exception as e:
+                logger.error(f'Failed to undo the abandoned step {task.name}: {e}')
+        return on_done
+
+
+    def run(self):
+        results = self.results
+        running = dict()
+        waiting = list(self.tasks)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            self.schedule(waiting, running, results, executor)
+            while running:
+                done, _ = wait(running, timeout=self.deadline.remaining_seconds(), return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        value = future.result()
+                        results[name] = TaskResult(bool(value), value, None if value else 'Step failed')
+                    except Exception as e:
+                        results[name] = TaskResult(False, None, str(e))
+                self.schedule(waiting, running, results, executor)
+        finally:
+            # Steps still running at the deadline are abandoned, the caller must answer before the Lambda is stopped
+            for future, name in running.items():
+                future.add_done_callback(self.undo_abandoned(self.get_task(name)))
+            executor.shutdown(wait=False)
+        for task in self.tasks:
+            if task.name not in results:
+                results[task.name] = TaskResult(False, None, 'Not completed before the Lambda timeout')
+        return results
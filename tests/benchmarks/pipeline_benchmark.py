@@ -0,0 +1,90 @@
+# Times every stage of the onboarding event pipeline (parse -> filter -> dedupe -> enrich -> vault) for the common
+# event scenarios, running the handler code against the local stand-ins of tests/stress. Shows where each scenario
+# leaves the pipeline and which calls it made on the way.
+#
+#   python3 pipeline_benchmark.py --iterations 50 --aws-latency-ms 5 --pvwa-latency-ms 20
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stress'))
+from local_stand_ins import LocalStandIns, SOLUTION_ACCOUNT_ID
+
+SCENARIOS = ('unhandled_state', 'running_new', 'running_on_boarded', 'terminated', 'terminated_legacy_row')
+
+
+def build_message(instance_id, state):
+    return {"account": SOLUTION_ACCOUNT_ID, "region": "eu-west-2", "time": "2021-03-01T10:00:00Z",
+            "detail": {"instance-id": instance_id, "state": state}}
+
+
+# Puts the Instances row the scenario expects before the event is processed
+def prepare(scenario, instance_id, stand_ins):
+    dynamo = stand_ins.dynamo
+    if scenario == 'running_on_boarded':
+        dynamo.instances[instance_id] = {'InstanceId': instance_id, 'Address': '10.0.0.1', 'Status': 'on boarded'}
+    elif scenario == 'terminated':
+        account_id = stand_ins.pvwa.add_account({'name': instance_id, 'safeName': 'AOB_Unix', 'address': '10.0.0.1',
+                                                 'userName': 'ec2-user'})
+        dynamo.instances[instance_id] = {'InstanceId': instance_id, 'Address': '10.0.0.1', 'Status': 'on boarded',
+                                         'VaultAccountId': account_id, 'Platform': 'UnixSSHKeys'}
+    elif scenario == 'terminated_legacy_row':
+        stand_ins.fleet.register(instance_id, platform=None)
+        address = stand_ins.fleet.instances[instance_id]['address']
+        stand_ins.pvwa.add_account({'name': instance_id, 'safeName': 'AOB_Unix', 'address': address, 'userName': 'ec2-user'})
+        dynamo.instances[instance_id] = {'InstanceId': instance_id, 'Address': address, 'Status': 'on boarded'}
+    state = {'unhandled_state': 'stopping', 'running_new': 'running', 'running_on_boarded': 'running'}.get(scenario,
+                                                                                                       'terminated')
+    return build_message(instance_id, state)
+
+
+def run_scenario(handler, stand_ins, scenario, iterations):
+    stage_times = {name: [] for name, _ in handler.EVENT_PIPELINE.stages}
+    ended_at = dict()
+    calls_before = dict(stand_ins.pvwa.calls)
+    for iteration in range(iterations):
+        instance_id = f'i-{scenario[:4]}{iteration:012d}'
+        data = prepare(scenario, instance_id, stand_ins)
+        event = handler.InstanceEvent(data, SOLUTION_ACCOUNT_ID, 'pipeline-benchmark')
+        for name, stage in handler.EVENT_PIPELINE.stages:
+            start = time.perf_counter()
+            result = stage(event)
+            stage_times[name].append((time.perf_counter() - start) * 1000)
+            if result != handler.CONTINUE:
+                ended_at[name] = ended_at.get(name, 0) + 1
+                break
+    pvwa_calls = {name: count - calls_before.get(name, 0) for name, count in stand_ins.pvwa.calls.items()
+                  if count - calls_before.get(name, 0)}
+    return stage_times, ended_at, pvwa_calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Onboarding event pipeline stage benchmark')
+    parser.add_argument('--iterations', type=int, default=20, help='events per scenario')
+    parser.add_argument('--aws-latency-ms', type=float, default=5)
+    parser.add_argument('--pvwa-latency-ms', type=float, default=20)
+    parser.add_argument('--conversion-latency-ms', type=float, default=30)
+    args = parser.parse_args()
+
+    stand_ins = LocalStandIns(pvwa_latency_ms=args.pvwa_latency_ms, aws_latency_ms=args.aws_latency_ms,
+                              conversion_latency_ms=args.conversion_latency_ms)
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            handler = stand_ins.install()
+            results = {scenario: run_scenario(handler, stand_ins, scenario, args.iterations) for scenario in SCENARIOS}
+        finally:
+            sys.stdout = stdout
+            stand_ins.uninstall()
+
+    for scenario, (stage_times, ended_at, pvwa_calls) in results.items():
+        print(f'{scenario}: ended at {ended_at}, PVWA calls {pvwa_calls}')
+        for name, values in stage_times.items():
+            if values:
+                print(f'  {name:<8} median={statistics.median(values):8.2f}ms  max={max(values):8.2f}ms  runs={len(values)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Measures the cold start cost of the onboarding Lambda: time to import the handler module and the number of
+# AWS and HTTP calls made before the first event is processed. Every run imports the handler in a new interpreter.
+#
+#   python3 startup_benchmark.py --runs 10
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src')
+
+# Runs in the child interpreter. Network calls are recorded and refused, so nothing leaves the machine
+CHILD_SCRIPT = """
+import sys
+import json
+import time
+sys.path.append(sys.argv[1])
+sys.path.append(sys.argv[2])
+import botocore.client
+import requests.sessions
+
+calls = []
+
+def refuse_api_call(client, operation_name, api_params):
+    calls.append(f'{client.meta.service_model.service_name}:{operation_name}')
+    raise Exception('Network calls are refused by the startup benchmark')
+
+def refuse_http_call(session, request, **kwargs):
+    calls.append(f'http:{request.url}')
+    raise Exception('Network calls are refused by the startup benchmark')
+
+botocore.client.BaseClient._make_api_call = refuse_api_call
+requests.sessions.Session.send = refuse_http_call
+start = time.perf_counter()
+error = None
+try:
+    import aws_ec2_auto_onboarding
+except Exception as e:
+    error = str(e)
+import_ms = (time.perf_counter() - start) * 1000
+print(json.dumps({'import_ms': import_ms, 'network_calls': calls, 'error': error,
+                  'deferred_modules': {name: name not in sys.modules for name in ('rsa',)}}))
+"""
+
+
+def run_once():
+    output = subprocess.check_output([sys.executable, '-c', CHILD_SCRIPT, os.path.join(SRC_DIRECTORY, 'shared_libraries'),
+                                      os.path.join(SRC_DIRECTORY, 'aws_ec2_auto_onboarding')])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Onboarding Lambda cold start benchmark')
+    parser.add_argument('--runs', type=int, default=5, help='number of cold imports to measure')
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    import_times = [run['import_ms'] for run in runs]
+    print(f"Import time ms: median={statistics.median(import_times):.1f} min={min(import_times):.1f} "
+          f"max={max(import_times):.1f}")
+    print(f"Network calls before the first event: {len(runs[0]['network_calls'])} {runs[0]['network_calls']}")
+    print(f"Not loaded on import: {[name for name, deferred in runs[0]['deferred_modules'].items() if deferred]}")
+    if runs[0]['error']:
+        print(f"Import failed: {runs[0]['error']}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
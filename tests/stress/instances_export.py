@@ -0,0 +1,273 @@
+# Exports the 'Instances' table for audits: a parallel scan of TotalSegments segments, one worker each, streamed as
+# gzip compressed JSON Lines or CSV to a local file or to S3. The scan is rate limited to a share of the read capacity
+# of the table, the onboarding keeps the rest. The pages read wait in a bounded queue, the memory used does not grow
+# with the table.
+#
+#   python3 instances_export.py eu-west-2 instances.jsonl.gz
+#   python3 instances_export.py eu-west-2 s3://audit-bucket/aob/instances.csv.gz --format csv --segments 8
+# Incremental export of the rows written since the last export recorded in the state file:
+#   python3 instances_export.py eu-west-2 instances-changes.jsonl.gz --state instances-export.json
+import os
+import io
+import sys
+import csv
+import json
+import gzip
+import time
+import queue
+import base64
+import decimal
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from boto3.dynamodb.types import TypeDeserializer, Binary
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src')
+sys.path.append(os.path.join(SRC_DIRECTORY, 'shared_libraries'))
+import dynamo_access
+from log_mechanism import LogMechanism
+
+TABLE_NAME = 'Instances'
+UPDATED_AT = 'UpdatedAt'  # Written with every row since this export exists, the older rows only go to full exports
+JSON_LINES = 'jsonl'
+CSV_FORMAT = 'csv'
+CSV_COLUMNS = ('InstanceId', 'Address', 'Status', 'Error', 'LogId', 'AccountId', 'Region', 'Platform', 'ImageId',
+               'SafeName', 'UserName', 'VaultAccountId', 'EventTime', 'ProcessingStartedAt', 'VaultCreatedAt',
+               'RotationQueue', 'RotationStatus', 'RotationDueAt', 'RotationDispatchedAt', 'RotationCompletedAt',
+               'RotationFailures', 'RotationError', 'Checkpoint', 'CheckpointAt', 'ResumeCount', UPDATED_AT)
+READ_SHARE = 0.5  # Part of the provisioned read capacity used by default
+QUEUED_PAGES = 2  # Pages read ahead by each segment worker
+S3_PART_SIZE = 8 * 1024 * 1024  # Part size of the S3 multipart upload, at least 5 MB
+SEGMENT_DONE = None
+deserializer = TypeDeserializer()
+
+
+def to_json_value(value):
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, Binary):
+        return base64.b64encode(value.value).decode()
+    if isinstance(value, (set, frozenset)):
+        return sorted(to_json_value(element) for element in value)
+    if isinstance(value, list):
+        return [to_json_value(element) for element in value]
+    if isinstance(value, dict):
+        return {key: to_json_value(element) for key, element in value.items()}
+    return value
+
+
+# Row in the attribute value format of the DynamoDB client to a JSON object
+def to_row(item):
+    return {name: to_json_value(deserializer.deserialize(value)) for name, value in item.items()}
+
+
+# Scans one segment page by page, the pages are put in the queue shared with the writer and wait there while it is full
+def scan_segment(dynamo_client, pages, segment, total_segments, page_size, since=None):
+    scan_arguments = {'TableName': TABLE_NAME, 'Segment': segment, 'TotalSegments': total_segments, 'Limit': page_size}
+    if since is not None:
+        scan_arguments.update(FilterExpression='#u >= :since', ExpressionAttributeNames={'#u': UPDATED_AT},
+                              ExpressionAttributeValues={':since': {'N': str(since)}})
+    try:
+        while True:
+            response = dynamo_client.scan(**scan_arguments)
+            pages.put(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return
+            scan_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    finally:
+        pages.put(SEGMENT_DONE)
+
+
+# Local file written under a temporary name, it only replaces the destination once complete
+class LocalDestination:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(f'{path}.part', 'wb')
+
+
+    def write(self, data):
+        return self.file.write(data)
+
+
+    def flush(self):
+        self.file.flush()
+
+
+    def commit(self):
+        self.file.close()
+        os.replace(f'{self.path}.part', self.path)
+
+
+    def abort(self):
+        self.file.close()
+        os.remove(f'{self.path}.part')
+
+
+# S3 object written with a multipart upload, only one part is kept in memory. The object appears once complete
+class S3Destination:
+    def __init__(self, s3_client, bucket, key, part_size=S3_PART_SIZE):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.buffer = bytearray()
+        self.parts = []
+
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.part_size:
+            self.upload_part()
+        return len(data)
+
+
+    def flush(self):
+        pass
+
+
+    def upload_part(self):
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              PartNumber=part_number, Body=bytes(self.buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+
+    def commit(self):
+        if self.buffer or not self.parts:
+            self.upload_part()
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                 MultipartUpload={'Parts': self.parts})
+
+
+    def abort(self):
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def open_destination(destination, s3_client=None):
+    if not destination.startswith('s3://'):
+        return LocalDestination(destination)
+    bucket, _, key = destination[len('s3://'):].partition('/')
+    return S3Destination(s3_client or boto3.client('s3'), bucket, key)
+
+
+class RowWriter:
+    def __init__(self, text_stream, file_format, columns=CSV_COLUMNS):
+        self.text_stream = text_stream
+        self.csv_writer = None
+        if file_format == CSV_FORMAT:
+            # The columns are fixed up front, the attributes outside of them are left out
+            self.csv_writer = csv.DictWriter(text_stream, fieldnames=columns, extrasaction='ignore')
+            self.csv_writer.writeheader()
+
+
+    def write(self, row):
+        if self.csv_writer:
+            self.csv_writer.writerow({name: json.dumps(value) if isinstance(value, (list, dict)) else value
+                                      for name, value in row.items()})
+        else:
+            self.text_stream.write(json.dumps(row, sort_keys=True) + '\n')
+
+
+# Scans the table with total_segments workers and writes its rows to the destination, the rows written at or after since
+# (epoch seconds) only when it is given. Returns the number of rows and pages exported
+def export(dynamo_client, destination, file_format=JSON_LINES, total_segments=4, page_size=100, since=None,
+           columns=CSV_COLUMNS):
+    pages = queue.Queue(maxsize=total_segments * QUEUED_PAGES)
+    statistics = {'rows': 0, 'pages': 0}
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        workers = [executor.submit(scan_segment, dynamo_client, pages, segment, total_segments, page_size, since)
+                   for segment in range(total_segments)]
+        try:
+            with gzip.GzipFile(fileobj=destination, mode='wb') as compressed, \
+                    io.TextIOWrapper(compressed, encoding='utf-8', newline='') as text_stream:
+                writer = RowWriter(text_stream, file_format, columns)
+                running = total_segments
+                while running:
+                    items = pages.get()
+                    if items is SEGMENT_DONE:
+                        running -= 1
+                        continue
+                    statistics['pages'] += 1
+                    for item in items:
+                        writer.write(to_row(item))
+                        statistics['rows'] += 1
+            # A failed segment ends with its error, the export is then not kept
+            for worker in workers:
+                worker.result()
+        except BaseException:
+            # The workers blocked on a full queue are let through
+            while any(not worker.done() for worker in workers):
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            destination.abort()
+            raise
+    destination.commit()
+    return statistics
+
+
+def load_state(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as state_file:
+        return json.load(state_file).get(UPDATED_AT)
+
+
+def save_state(path, exported_until):
+    with open(f'{path}.part', 'w') as state_file:
+        json.dump({UPDATED_AT: exported_until}, state_file)
+    os.replace(f'{path}.part', path)
+
+
+# Read units per second of the export: the given rate, or READ_SHARE of the provisioned capacity. None (no limit) for an
+# on-demand table
+def get_read_units(access, read_units):
+    if read_units:
+        return read_units
+    capacity = dynamo_access.get_table_capacity(access.get_dynamo_client(), TABLE_NAME)[dynamo_access.READ]
+    return capacity * READ_SHARE if capacity else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export of the Instances table for audits')
+    parser.add_argument('main_region', help='AOB main region')
+    parser.add_argument('destination', help='local file or s3://bucket/key, gzip compressed')
+    parser.add_argument('--format', choices=(JSON_LINES, CSV_FORMAT),
+                        help='JSON Lines or CSV, by default from the destination name')
+    parser.add_argument('--segments', type=int, default=4, help='scan segments, each read by its own worker')
+    parser.add_argument('--page-size', type=int, default=100, help='rows read by each scan request')
+    parser.add_argument('--read-units', type=float, default=0,
+                        help=f'read units per second of the export, 0 for {READ_SHARE:.0%} of the provisioned capacity')
+    parser.add_argument('--since', type=int, help=f'only the rows written since this epoch time ({UPDATED_AT})')
+    parser.add_argument('--state', help='incremental export: exports the rows written since the last export recorded '
+                                        'in this file, and records this one')
+    parser.add_argument('--s3-endpoint-url', help='endpoint of an S3 compatible store')
+    parser.add_argument('--debug-level', default='Info', help='None, Info or Trace')
+    args = parser.parse_args()
+
+    LogMechanism.shared_debug_level = args.debug_level
+    os.environ.setdefault('AWS_DEFAULT_REGION', args.main_region)
+    file_format = args.format or (CSV_FORMAT if '.csv' in os.path.basename(args.destination) else JSON_LINES)
+    since = args.since if args.since is not None else load_state(args.state)
+    access = dynamo_access.DynamoAccess()
+    read_units = get_read_units(access, args.read_units)
+    access.limit_table(TABLE_NAME, read_units=read_units)
+    # Rows written while the export runs may be missed by it, the next incremental export starts before them
+    started = int(time.time())
+    destination = open_destination(args.destination, boto3.client('s3', endpoint_url=args.s3_endpoint_url))
+    statistics = export(access.get_client(), destination, file_format, args.segments, args.page_size, since)
+    if args.state:
+        save_state(args.state, started)
+    duration = time.time() - started
+    usage = access.get_usage().get(TABLE_NAME, {})
+    print(f"Exported {statistics['rows']} rows ({statistics['pages']} pages) to {args.destination} in {duration:.1f}s, "
+          f"{usage.get('read_units', 0):.1f} read units at up to {read_units or 'unlimited'} per second, "
+          f"{usage.get('throttled_requests', 0)} requests throttled"
+          + (f', rows written since {since}' if since is not None else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+# Replays synthetic or captured EC2 state-change SNS events against the onboarding Lambda handler
+# running on local stand-ins, and reports throughput and latency.
+#
+# 1000 instances scale-out at 20 events/sec over 50 threads:
+#   python3 load_generator.py --count 1000 --rate 20 --concurrency 50
+# Replay captured events (one SNS event or EC2 state-change message per line) over 4 worker processes:
+#   python3 load_generator.py --replay events.jsonl --processes 4
+# Queue-backed mode, the burst is queued and drained by 50 batch consumers of 10 events:
+#   python3 load_generator.py --count 2000 --concurrency 50 --batch-size 10
+# Three PVWA nodes, each with a third of the session slots:
+#   python3 load_generator.py --count 1000 --concurrency 50 --pvwa-nodes 3
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import zlib
+import random
+import argparse
+import contextlib
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from local_stand_ins import LocalStandIns, InMemoryEventQueue, drain_queue, SOLUTION_ACCOUNT_ID
+from onboarding_latency_report import build_report as build_latency_report, format_summary
+
+SNS_TOPIC_ARN = f'arn:aws:sns:eu-west-2:{SOLUTION_ACCOUNT_ID}:AOB-EC2-State-Change'
+
+
+def build_state_change_message(instance_id, state, account_id, region, event_time):
+    return {
+        "version": "0",
+        "id": str(uuid.uuid4()),
+        "detail-type": "EC2 Instance State-change Notification",
+        "source": "aws.ec2",
+        "account": account_id,
+        "time": event_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        "region": region,
+        "resources": [f"arn:aws:ec2:{region}:{account_id}:instance/{instance_id}"],
+        "detail": {
+            "instance-id": instance_id,
+            "state": state
+        }
+    }
+
+
+def wrap_in_sns_event(message):
+    return {
+        "Records": [{
+            "EventSource": "aws:sns",
+            "EventVersion": "1.0",
+            "Sns": {
+                "Type": "Notification",
+                "MessageId": str(uuid.uuid4()),
+                "TopicArn": SNS_TOPIC_ARN,
+                "Message": json.dumps(message),
+                "Timestamp": message["time"]
+            }
+        }]
+    }
+
+
+def generate_events(count, terminate_ratio, cross_account_ratio, accounts, regions, seed):
+    randomizer = random.Random(seed)
+    event_time = datetime.utcnow()
+    instances = []
+    for index in range(count):
+        instance_id = f'i-{randomizer.getrandbits(68):017x}'
+        account_id = randomizer.choice(accounts) if randomizer.random() < cross_account_ratio else SOLUTION_ACCOUNT_ID
+        instances.append((instance_id, account_id, randomizer.choice(regions)))
+    # Scale-out first, then scale-in of part of the fleet
+    events = [wrap_in_sns_event(build_state_change_message(instance_id, 'running', account_id, region,
+                                                           event_time + timedelta(milliseconds=index)))
+              for index, (instance_id, account_id, region) in enumerate(instances)]
+    terminated = randomizer.sample(instances, int(count * terminate_ratio))
+    events += [wrap_in_sns_event(build_state_change_message(instance_id, 'terminated', account_id, region,
+                                                            event_time + timedelta(seconds=60, milliseconds=index)))
+               for index, (instance_id, account_id, region) in enumerate(terminated)]
+    return events
+
+
+# Captured lines can be full SNS events or the bare EC2 state-change message
+def load_events(path):
+    events = []
+    with open(path) as events_file:
+        for line in events_file:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            events.append(event if 'Records' in event else wrap_in_sns_event(event))
+    return events
+
+
+def parse_message(event):
+    return json.loads(event["Records"][0]["Sns"]["Message"])
+
+
+class FakeContext:
+    def __init__(self, region):
+        self.invoked_function_arn = f'arn:aws:lambda:{region}:{SOLUTION_ACCOUNT_ID}:function:AOB-ElasticityLambda'
+        self.log_stream_name = f'load-generator/{uuid.uuid4().hex}'
+        self.aws_request_id = str(uuid.uuid4())
+
+    def get_remaining_time_in_millis(self):
+        return 360000
+
+
+def invoke(handler, event, scheduled_time):
+    message = parse_message(event)
+    start = time.perf_counter()
+    error = None
+    try:
+        handler.lambda_handler(event, FakeContext(message['region']))
+    except Exception as e:
+        error = str(e)
+    end = time.perf_counter()
+    return {'state': message['detail']['state'],
+            'latency_ms': (end - scheduled_time) * 1000,
+            'service_ms': (end - start) * 1000,
+            'error': error}
+
+
+# Queue-backed mode: the events are queued at once, as SNS would deliver a burst to SQS, and every thread is a batch
+# consumer draining the queue. The scale-in is queued once the scale-out was drained, the generated terminations
+# happen a minute after the launches. The latency of an event is the time until its batch completed
+def consume_queue(handler, events, concurrency, batch_size):
+    start = time.perf_counter()
+    results = []
+
+    def timed_batch_handler(event, context):
+        batch_start = time.perf_counter()
+        response = handler.batch_handler(event, context)
+        end = time.perf_counter()
+        failed_ids = set(item['itemIdentifier'] for item in response['batchItemFailures'])
+        for record in event['Records']:
+            results.append({'state': json.loads(json.loads(record['body'])['Message'])['detail']['state'],
+                            'latency_ms': (end - start) * 1000,
+                            'service_ms': (end - batch_start) * 1000,
+                            'error': 'Returned to the queue' if record['messageId'] in failed_ids else None})
+        return response
+
+    for state in ('running', 'terminated'):
+        queue = InMemoryEventQueue()
+        for event in events:
+            message = event['Records'][0]['Sns']['Message']
+            if json.loads(message)['detail']['state'] == state:
+                queue.send(json.dumps({'Type': 'Notification', 'Message': message}))
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            consumers = [executor.submit(drain_queue, queue, timed_batch_handler, FakeContext('eu-west-2'), batch_size)
+                         for _ in range(concurrency)]
+            for consumer in consumers:
+                consumer.result()
+    return results
+
+
+# Runs a set of events on one process: installs the stand-ins and paces the events over a thread pool
+def run_partition(events, rate, concurrency, options, batch_size=0):
+    stand_ins = LocalStandIns(**options)
+    verbose = options['debug_level'].lower() in ('info', 'debug', 'trace')
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+        handler = stand_ins.install()
+        start = time.perf_counter()
+        if batch_size:
+            results = consume_queue(handler, events, concurrency, batch_size)
+        else:
+            futures = []
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for index, event in enumerate(events):
+                    scheduled_time = start + (index / rate if rate else 0)
+                    delay = scheduled_time - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    futures.append(executor.submit(invoke, handler, event, scheduled_time))
+                results = [future.result() for future in futures]
+        duration = time.perf_counter() - start
+    stand_ins.uninstall()
+    return {'results': results, 'duration': duration, 'pvwa_calls': stand_ins.pvwa.calls,
+            'node_logons': stand_ins.pvwa.node_logons, 'safe_accounts': stand_ins.pvwa.safe_accounts(),
+            'safes_without_operators': stand_ins.pvwa.safes_without_operators(),
+            'conversions': stand_ins.conversions,
+            'profiles': len(stand_ins.s3.objects) // 2, 'profile_bytes': sum(map(len, stand_ins.s3.objects.values())),
+            'instances_status': stand_ins.dynamo.status_counts(), 'instances_rows': stand_ins.dynamo.rows(),
+            'leaked_slots': stand_ins.dynamo.leased_slots()}
+
+
+def run_partition_star(arguments):
+    return run_partition(*arguments)
+
+
+def run(events, rate, concurrency, processes, options, batch_size=0):
+    if processes <= 1:
+        return [run_partition(events, rate, concurrency, options, batch_size)]
+    # Events of an instance always go to the same process, as every process owns its own stand-ins
+    partitions = [[] for _ in range(processes)]
+    for event in events:
+        instance_id = parse_message(event)['detail']['instance-id']
+        partitions[zlib.crc32(instance_id.encode()) % processes].append(event)
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(run_partition_star, [(partition, rate / processes, concurrency, options, batch_size)
+                                             for partition in partitions])
+
+
+# Nearest-rank percentile: the smallest value with at least percent of the values at or below it
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(percent * len(ordered) / 100.0) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def summarize(values):
+    return {'p50': round(percentile(values, 50), 1), 'p90': round(percentile(values, 90), 1),
+            'p99': round(percentile(values, 99), 1), 'max': round(max(values) if values else 0.0, 1)}
+
+
+def merge_counts(dictionaries):
+    merged = dict()
+    for dictionary in dictionaries:
+        for key, value in dictionary.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def build_report(partitions):
+    results = [result for partition in partitions for result in partition['results']]
+    duration = max(partition['duration'] for partition in partitions)
+    report = {
+        'events': len(results),
+        'errors': len([result for result in results if result['error']]),
+        'duration_seconds': round(duration, 2),
+        'throughput_per_second': round(len(results) / duration, 1) if duration else 0.0,
+        'latency_ms': summarize([result['latency_ms'] for result in results]),
+        'service_time_ms': summarize([result['service_ms'] for result in results]),
+        'by_state': dict(),
+        'pvwa_calls': merge_counts(partition['pvwa_calls'] for partition in partitions),
+        'node_logons': merge_counts(partition['node_logons'] for partition in partitions),
+        'safe_accounts': merge_counts(partition['safe_accounts'] for partition in partitions),
+        'safes_without_operators': sorted({safe_name for partition in partitions
+                                           for safe_name in partition['safes_without_operators']}),
+        'conversions': sum(partition['conversions'] for partition in partitions),
+        'profiles': sum(partition['profiles'] for partition in partitions),
+        'profile_bytes': sum(partition['profile_bytes'] for partition in partitions),
+        'instances_status': merge_counts(partition['instances_status'] for partition in partitions),
+        'ledger_seconds': build_latency_report(row for partition in partitions
+                                               for row in partition['instances_rows'])['stages_seconds'],
+        'leaked_slots': sum(partition['leaked_slots'] for partition in partitions)
+    }
+    for state in sorted(set(result['state'] for result in results)):
+        state_results = [result for result in results if result['state'] == state]
+        report['by_state'][state] = {'events': len(state_results),
+                                     'latency_ms': summarize([result['latency_ms'] for result in state_results])}
+    return report
+
+
+def print_report(report):
+    print(f"Events: {report['events']}, errors: {report['errors']}")
+    print(f"Duration: {report['duration_seconds']}s, throughput: {report['throughput_per_second']} events/s")
+    for name in ('latency_ms', 'service_time_ms'):
+        values = report[name]
+        print(f"{name}: p50={values['p50']} p90={values['p90']} p99={values['p99']} max={values['max']}")
+    for state, state_report in report['by_state'].items():
+        values = state_report['latency_ms']
+        print(f"  {state} ({state_report['events']}): p50={values['p50']} p90={values['p90']} p99={values['p99']}")
+    print(f"PVWA calls: {report['pvwa_calls']}")
+    print(f"PVWA logons by node: {report['node_logons']}")
+    print(f"Vault accounts by safe: {dict(sorted(report['safe_accounts'].items()))}")
+    if report['safes_without_operators']:
+        print(f"Safes without the operators of the configured safes: {report['safes_without_operators']}")
+    print(f"Key conversions: {report['conversions']}")
+    if report['profiles']:
+        print(f"Profiled invocations: {report['profiles']}, {report['profile_bytes'] // 1024} KB of compressed stats")
+    print(f"Instances table: {report['instances_status']}")
+    for stage in ('queue', 'processing', 'vaulted'):
+        print(f"  ledger {stage:<10} (s): {format_summary(report['ledger_seconds'][stage])}")
+    print(f"Session slots still leased: {report['leaked_slots']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic EC2 state-change event load generator')
+    parser.add_argument('--count', type=int, default=1000, help='number of instances to launch')
+    parser.add_argument('--replay', help='file with captured events, one JSON event per line')
+    parser.add_argument('--rate', type=float, default=0, help='events per second, 0 for as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=50, help='concurrent invocations per process')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes, 1 to run in-process')
+    parser.add_argument('--batch-size', type=int, default=0, help='queue-backed mode with batches of this size, 0 for direct')
+    parser.add_argument('--bulk', action='store_true', help='create the accounts with bulk upload jobs, with --batch-size')
+    parser.add_argument('--terminate-ratio', type=float, default=0.0, help='part of the fleet terminated after launch')
+    parser.add_argument('--windows-ratio', type=float, default=0.2, help='part of the fleet running Windows')
+    parser.add_argument('--profile-rate', type=float, default=0.0, help='part of the invocations profiled')
+    parser.add_argument('--excluded-ratio', type=float, default=0.0, help='part of the fleet excluded by the onboarding rules')
+    parser.add_argument('--safe-shards', type=int, default=1, help='safes the accounts of a platform are spread over')
+    parser.add_argument('--cross-account-ratio', type=float, default=0.0, help='part of the fleet in other accounts')
+    parser.add_argument('--accounts', default='210987654321,310987654321', help='comma separated cross accounts')
+    parser.add_argument('--regions', default='eu-west-2', help='comma separated event regions')
+    parser.add_argument('--pvwa-latency-ms', type=float, default=20)
+    parser.add_argument('--aws-latency-ms', type=float, default=5)
+    parser.add_argument('--conversion-latency-ms', type=float, default=30)
+    parser.add_argument('--session-slots', type=int, default=100)
+    parser.add_argument('--pvwa-nodes', type=int, default=1, help='PVWA nodes sharing the session slots')
+    parser.add_argument('--debug-level', default='None', help='AOB_Debug_Level of the handler, Info/Debug/Trace print logs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    if args.replay:
+        events = load_events(args.replay)
+    else:
+        events = generate_events(args.count, args.terminate_ratio, args.cross_account_ratio, args.accounts.split(','),
+                                 args.regions.split(','), args.seed)
+    options = {'pvwa_latency_ms': args.pvwa_latency_ms, 'aws_latency_ms': args.aws_latency_ms,
+               'session_slots': args.session_slots, 'windows_ratio': args.windows_ratio,
+               'conversion_latency_ms': args.conversion_latency_ms, 'debug_level': args.debug_level,
+               'bulk_onboarding': args.bulk, 'pvwa_nodes': args.pvwa_nodes, 'excluded_ratio': args.excluded_ratio,
+               'profile_rate': args.profile_rate, 'safe_shards': args.safe_shards}
+    report = build_report(run(events, args.rate, args.concurrency, args.processes, options, args.batch_size))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# Reports the onboarding latency ledger of the 'Instances' table: percentiles of the time from the instance state change
+# until its account is vaulted and its credentials are rotated, by stage, broken down by account, region and platform.
+# The table is scanned page by page, the rows written before the ledger was recorded only count in the statuses.
+#
+#   python3 onboarding_latency_report.py eu-west-2
+#   python3 onboarding_latency_report.py eu-west-2 --since 3600 --output latency.json
+# Number of 'on boarded' rows, as used by tf_deployer.sh:
+#   python3 onboarding_latency_report.py eu-west-2 --count
+import json
+import math
+import time
+import argparse
+import boto3
+
+TABLE_NAME = 'Instances'
+ON_BOARDED = 'on boarded'
+WINDOWS_PLATFORM = 'WinServerLocal'
+LEDGER_ATTRIBUTES = ('InstanceId', 'Status', 'Platform', 'AccountId', 'Region', 'EventTime', 'ProcessingStartedAt',
+                     'VaultCreatedAt', 'RotationDispatchedAt', 'RotationCompletedAt')
+# Stage name, ledger attribute it starts at and ledger attribute it ends at
+STAGES = (('queue', 'EventTime', 'ProcessingStartedAt'),
+          ('processing', 'ProcessingStartedAt', 'VaultCreatedAt'),
+          ('vaulted', 'EventTime', 'VaultCreatedAt'),
+          ('rotation_wait', 'VaultCreatedAt', 'RotationDispatchedAt'),
+          ('rotation', 'RotationDispatchedAt', 'RotationCompletedAt'),
+          ('end_to_end', 'EventTime', 'RotationCompletedAt'))
+BREAKDOWN_STAGES = ('vaulted', 'end_to_end')
+DIMENSIONS = ('account', 'region', 'platform')
+UNKNOWN = 'unknown'
+
+
+# Scans the table page by page, yields the rows in the attribute value format of the DynamoDB client
+def scan_pages(client, page_size, **scan_arguments):
+    if page_size:
+        scan_arguments['Limit'] = page_size
+    while True:
+        response = client.scan(TableName=TABLE_NAME, **scan_arguments)
+        yield response
+        if 'LastEvaluatedKey' not in response:
+            return
+        scan_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def count_on_boarded(client, page_size):
+    return sum(page['Count'] for page in scan_pages(client, page_size, Select='COUNT', FilterExpression='#s = :s',
+                                                      ExpressionAttributeNames={'#s': 'Status'},
+                                                      ExpressionAttributeValues={':s': {'S': ON_BOARDED}}))
+
+
+def read_rows(client, page_size):
+    names = {f'#a{index}': name for index, name in enumerate(LEDGER_ATTRIBUTES)}
+    for page in scan_pages(client, page_size, ProjectionExpression=', '.join(names), ExpressionAttributeNames=names):
+        for item in page.get('Items', []):
+            yield {name: int(value['N']) if 'N' in value else value.get('S') for name, value in item.items()}
+
+
+# Nearest-rank percentile: the smallest value with at least percent of the values at or below it
+def percentile(values, percent):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = max(0, math.ceil(percent * len(ordered) / 100.0) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def summarize(values):
+    return {'count': len(values), 'p50': percentile(values, 50), 'p90': percentile(values, 90),
+            'p99': percentile(values, 99), 'max': max(values) if values else 0}
+
+
+def get_dimensions(row):
+    platform = row.get('Platform')
+    return {'account': row.get('AccountId') or UNKNOWN,
+            'region': row.get('Region') or UNKNOWN,
+            'platform': UNKNOWN if not platform else 'Windows' if platform == WINDOWS_PLATFORM else 'Linux'}
+
+
+# Latencies in seconds of the stages of the rows whose event happened after since (epoch seconds)
+def build_report(rows, since=0):
+    statuses = dict()
+    stages = {name: [] for name, _, _ in STAGES}
+    breakdowns = {dimension: dict() for dimension in DIMENSIONS}
+    without_ledger = 0
+    for row in rows:
+        statuses[row.get('Status')] = statuses.get(row.get('Status'), 0) + 1
+        if 'EventTime' not in row:
+            without_ledger += 1
+            continue
+        if row['EventTime'] < since:
+            continue
+        dimensions = get_dimensions(row)
+        for name, start, end in STAGES:
+            if start not in row or end not in row:
+                continue
+            latency = max(0, row[end] - row[start])
+            stages[name].append(latency)
+            if name not in BREAKDOWN_STAGES:
+                continue
+            for dimension, value in dimensions.items():
+                breakdowns[dimension].setdefault(value, {stage: [] for stage in BREAKDOWN_STAGES})[name].append(latency)
+    return {'statuses': statuses,
+            'without_ledger': without_ledger,
+            'stages_seconds': {name: summarize(latencies) for name, latencies in stages.items()},
+            'breakdowns_seconds': {dimension: {value: {stage: summarize(latencies) for stage, latencies in groups.items()}
+                                               for value, groups in sorted(values.items())}
+                                   for dimension, values in breakdowns.items()}}
+
+
+def format_summary(summary):
+    return f"n={summary['count']:<6} p50={summary['p50']:<5} p90={summary['p90']:<5} p99={summary['p99']:<5} " \
+           f"max={summary['max']}"
+
+
+def print_report(report):
+    print(f"Instances table: {report['statuses']}, rows without ledger: {report['without_ledger']}")
+    print('Latency by stage (seconds):')
+    for name, summary in report['stages_seconds'].items():
+        print(f'  {name:<14} {format_summary(summary)}')
+    for dimension, values in report['breakdowns_seconds'].items():
+        print(f'By {dimension}:')
+        for value, stages in values.items():
+            for index, (stage, summary) in enumerate(stages.items()):
+                print(f"  {value if not index else '':<14} {stage:<10} {format_summary(summary)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Onboarding latency report of the Instances table')
+    parser.add_argument('main_region', help='AOB main region')
+    parser.add_argument('--count', action='store_true', help="only print the number of 'on boarded' rows")
+    parser.add_argument('--since', type=int, default=0, help='only the events of the last SINCE seconds, 0 for all')
+    parser.add_argument('--page-size', type=int, default=0, help='rows read by each scan request, 0 for 1MB pages')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    client = boto3.client('dynamodb', region_name=args.main_region)
+    if args.count:
+        print(count_on_boarded(client, args.page_size))
+        return
+    report = build_report(read_rows(client, args.page_size), time.time() - args.since if args.since else 0)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 #!/bin/sh
 
 success=true
-BTF=$(python3 dynamo_on_boarded.py $1)
+BTF=$(python3 onboarding_latency_report.py $1 --count)
 echo "[INFO] There are $BTF successful records in dynamo table"
 terraform init
 terraform apply -auto-approve -parallelism=500 -var="region_main=$1" -var="region_sec=$2" -var="subnet_id_main=$3" -var="subnet_id_sec=$4" -var="key_pair_main=$5" -var="key_pair_sec=$6"
@@ -9,7 +9,7 @@ echo "[INFO] Finish deploy terraform"
 ATF=$(terraform state list | grep aws_instance | wc -l)
 echo "[INFO] terraform deployed $ATF instances"
 DS=$(($BTF + $ATF))
-CS=$(python3 dynamo_on_boarded.py $1)
+CS=$(python3 onboarding_latency_report.py $1 --count)
 echo "[INFO] Check if AOB succeed to on board all $ATF instances"
 i=0
 while [ $DS -gt $CS ]
@@ -22,10 +22,11 @@ do
 		break
 	fi
 	sleep 10
-	CS=$(python3 dynamo_on_boarded.py $1)
+	CS=$(python3 onboarding_latency_report.py $1 --count)
 done
+python3 onboarding_latency_report.py $1
 terraform destroy -auto-approve -parallelism=500 -var="region_main=$1" -var="region_sec=$2" -var="subnet_id_main=$3" -var="subnet_id_sec=$4" -var="key_pair_main=$5" -var="key_pair_sec=$6"
-CS=$(python3 dynamo_on_boarded.py $1)
+CS=$(python3 onboarding_latency_report.py $1 --count)
 i=0
 while [ $CS -gt $BTF ]
 do
@@ -36,7 +37,7 @@ do
 		break
 	fi
 	sleep 10
-	CS=$(python3 dynamo_on_boarded.py $1)
+	CS=$(python3 onboarding_latency_report.py $1 --count)
 done
 if [ $success != true ]; then
 	echo "[ERR] AOB stress test failed check for errors"
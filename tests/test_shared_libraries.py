@@ -2,17 +2,53 @@ import unittest
 from unittest.mock import Mock
 from unittest.mock import MagicMock
 from unittest.mock import patch
+from unittest.mock import call
 import sys
 import boto3
 import requests
 import json
-from moto import mock_ec2, mock_iam, mock_dynamodb2, mock_sts, mock_ssm
+import time
+import gzip
+import pickle
+import marshal
+import tracemalloc
+import os
+import csv
+import zlib
+import tempfile
+import threading
+from moto import mock_ec2, mock_iam, mock_dynamodb2, mock_sts, mock_ssm, mock_s3
 sys.path.append('../src/shared_libraries')
+sys.path.append('../src/aws_environment_setup')
+sys.path.append('stress')
 import aws_services
 import kp_processing
 import instance_processing
 import pvwa_api_calls as pvwa_api
+import metrics_mechanism
+import deadline_mechanism
+from task_graph import TaskGraph
+import event_queue
+import event_coalescing
+import event_pipeline
+import credential_rotation
+import bulk_onboarding
+import circuit_breaker
+import session_slots
+import pvwa_routing
+import adaptive_concurrency
+import fair_scheduling
+import onboarding_rules
+import profiling_mechanism
+import safe_sharding
+import dynamo_access
+import aws_environment_setup
+import onboarding_latency_report
+import instances_export
+from local_stand_ins import InMemoryEventQueue, drain_queue
+from botocore.exceptions import ClientError
 from pvwa_integration import PvwaIntegration
+from log_mechanism import LogMechanism
 
 MOTO_ACCOUNT = '123456789012'
 UNIX_PLATFORM = "UnixSSHKeys"
@@ -78,13 +114,6 @@ class AwsServicesTest(unittest.TestCase):
         self.assertTrue(delete_failed)
         table.delete()
 
-    def test_release_session_on_dynamo(self):
-        print('test_release_session_on_dynamo')
-        sessions_table_lock_client = Mock()
-        self.assertTrue(aws_services.release_session_on_dynamo('123', '222332', sessions_table_lock_client))
-        sessions_table_lock_client = MagicMock(Exception('AssertError'))
-        self.assertFalse(aws_services.release_session_on_dynamo('123', '222332', sessions_table_lock_client))
-
     def test_remove_instance_from_dynamo_table(self):
         print('test_remove_instance_from_dynamo_table')
         ec2_resource = boto3.resource('ec2')
@@ -98,24 +127,39 @@ class AwsServicesTest(unittest.TestCase):
         self.assertTrue(remove_windows)
         table.delete()
 
-    def test_get_session_from_dynamo(self):
-        print('test_get_session_from_dynamo')
-        sessions_table_lock_client = Mock()
-        def fake_acquire(a, b):
-            return 'ab-1232'
-        @patch.object(sessions_table_lock_client, 'acquire', fake_acquire)
-        def invoke():
-            session_number, guid = aws_services.get_session_from_dynamo(sessions_table_lock_client)
-            return session_number, guid
-        session_number, guid = invoke()
-        self.assertIn('mock.guid', str(guid))
-        self.assertEqual(type('1'), type(session_number))
-        @patch.object(sessions_table_lock_client, 'acquire', fake_exc)
-        def invoke2():
-            with self.assertRaises(Exception) as context:
-                aws_services.get_session_from_dynamo(sessions_table_lock_client)
-            self.assertTrue('fake_exc' in str(context.exception))
-        invoke2()
+    def test_batch_get_and_remove_instances(self):
+        print('test_batch_get_and_remove_instances')
+        dynamodb = boto3.resource('dynamodb')
+        table = dynamo_create_instances_table(dynamodb)
+        instance_ids = [f'i-{index:08x}' for index in range(130)]
+        for instance_id in instance_ids[:120]:
+            aws_services.put_instance_to_dynamo_table(instance_id, '1.1.1.1', 'on boarded')
+        rows = aws_services.get_instances_data_from_dynamo_table(instance_ids)
+        self.assertEqual(set(instance_ids[:120]), set(rows))
+        self.assertEqual('on boarded', rows[instance_ids[0]]['Status']['S'])
+        self.assertTrue(aws_services.remove_instances_from_dynamo_table(instance_ids[:60]))
+        self.assertEqual(set(instance_ids[60:120]), set(aws_services.get_instances_data_from_dynamo_table(instance_ids)))
+        table.delete()
+
+    def test_rotation_queue(self):
+        print('test_rotation_queue')
+        dynamodb = boto3.resource('dynamodb')
+        table = dynamo_create_instances_table(dynamodb)
+        for index in range(5):
+            aws_services.put_instance_to_dynamo_table(f'i-{index}', '1.1.1.1', 'on boarded', vault_details={
+                'VaultAccountId': f'{index}_1', **credential_rotation.get_pending_rotation(1000 + index)})
+        aws_services.put_instance_to_dynamo_table('i-legacy', '1.1.1.1', 'on boarded')
+        due = aws_services.get_rotation_queue('pending', due_before=1003)
+        self.assertEqual(['i-0', 'i-1', 'i-2', 'i-3'], [item['InstanceId'] for item in due])
+        self.assertEqual(2, len(aws_services.get_rotation_queue('pending', limit=2)))
+        self.assertTrue(aws_services.update_instance_rotation('i-0', {'RotationStatus': 'rotated'}, ('RotationQueue',)))
+        self.assertEqual(['i-1', 'i-2', 'i-3', 'i-4'],
+                         [item['InstanceId'] for item in aws_services.get_rotation_queue('pending')])
+        self.assertEqual('rotated', table.get_item(Key={'InstanceId': 'i-0'})['Item']['RotationStatus'])
+        self.assertIn(aws_services.UPDATED_AT, table.get_item(Key={'InstanceId': 'i-0'})['Item'])
+        self.assertFalse(aws_services.update_instance_rotation('i-removed', {'RotationStatus': 'rotated'}))
+        self.assertNotIn('Item', table.get_item(Key={'InstanceId': 'i-removed'}))
+        table.delete()
 
     def test_update_instances_table_status(self):
         print('test_update_instances_table_status')
@@ -190,6 +234,48 @@ class InstanceProcessingTest(unittest.TestCase):
         self.assertTrue(return_linux)
         table.delete()
 
+    @patch('aws_services.remove_instance_from_dynamo_table', return_value=True)
+    @patch('pvwa_api_calls.retrieve_account_id_from_account_name')
+    @patch('pvwa_api_calls.delete_account_from_vault', return_value=True)
+    def test_delete_instance_by_vault_account_id(self, delete_account, retrieve_account, remove_instance):
+        print('test_delete_instance_by_vault_account_id')
+        ec2_class = EC2Details()
+        instance_data = {'Address': {'S': '1.1.1.1'}, 'VaultAccountId': {'S': '12_3'},
+                         'Platform': {'S': UNIX_PLATFORM}}
+        deleted_instance = instance_processing.delete_instance(INSTANCE_ID, 1, ec2_class.sp_class, instance_data, None)
+        self.assertTrue(deleted_instance)
+        delete_account.assert_called_once_with(1, '12_3', INSTANCE_ID, ec2_class.sp_class.pvwa_url)
+        retrieve_account.assert_not_called()
+        remove_instance.assert_called_once_with(INSTANCE_ID)
+
+    @patch('aws_services.update_instances_table_status', return_value=True)
+    @patch('aws_services.remove_instances_from_dynamo_table', return_value=True)
+    @patch('aws_services.get_instances_data_from_dynamo_table')
+    @patch('pvwa_api_calls.retrieve_account_id_from_account_name')
+    @patch('pvwa_api_calls.delete_account_from_vault')
+    def test_offboard_instances(self, delete_account, retrieve_account, get_rows, remove_rows, update_status):
+        print('test_offboard_instances')
+        ec2_class = EC2Details()
+        get_rows.return_value = {
+            'i-rich': {'Status': {'S': 'on boarded'}, 'Address': {'S': '10.0.0.1'}, 'VaultAccountId': {'S': '1_1'}},
+            'i-legacy': {'Status': {'S': 'on boarded'}, 'Address': {'S': '10.0.0.2'}},
+            'i-failed': {'Status': {'S': 'on board failed'}, 'Address': {'S': '10.0.0.3'}},
+            'i-broken': {'Status': {'S': 'on boarded'}, 'Address': {'S': '10.0.0.4'}, 'VaultAccountId': {'S': '4_1'}}}
+        retrieve_account.side_effect = [False, '2_1']
+        delete_account.side_effect = lambda session, account_id, instance_id, url: fake_exc_no_args() \
+            if account_id == '4_1' else True
+        results = instance_processing.offboard_instances(['i-rich', 'i-legacy', 'i-failed', 'i-broken', 'i-unknown'], 1,
+                                                         ec2_class.sp_class, max_workers=2)
+        offboard_result = instance_processing.OffBoardResult
+        self.assertEqual((offboard_result.deleted, None), results['i-rich'])
+        self.assertEqual((offboard_result.deleted, None), results['i-legacy'])
+        self.assertEqual((offboard_result.failed_onboarding_removed, None), results['i-failed'])
+        self.assertEqual((offboard_result.failed, 'fake_exc'), results['i-broken'])
+        self.assertEqual((offboard_result.not_in_table, None), results['i-unknown'])
+        self.assertEqual(2, retrieve_account.call_count)
+        self.assertEqual({'i-rich', 'i-legacy', 'i-failed'}, set(remove_rows.call_args[0][0]))
+        update_status.assert_called_once_with('i-broken', 'delete failed', 'fake_exc')
+
     def test_get_instance_password_data(self):
         print('test_get_instance_password_data')
         ec2_resource = boto3.resource('ec2')
@@ -216,6 +302,29 @@ class InstanceProcessingTest(unittest.TestCase):
         response = func_create_instance(ec2_class, windows)
         self.assertTrue(response)
 
+    def test_create_instance_defers_rotation(self):
+        print('test_create_instance_defers_rotation')
+        ec2_class = EC2Details()
+        ec2_class.set_platform('linix')
+        ec2_class.set_image_description('ubuntu')
+        put_instance = Mock(return_value=True)
+        rotate = Mock(return_value=True)
+        @patch('kp_processing.convert_pem_to_ppk', return_value='VeryValue')
+        @patch('pvwa_api_calls.retrieve_account_id_from_account_name', side_effect=[False, '12_3'])
+        @patch('pvwa_api_calls.create_account_on_vault', return_value=[True, ''])
+        @patch('pvwa_api_calls.rotate_credentials_immediately', rotate)
+        @patch('aws_services.put_instance_to_dynamo_table', put_instance)
+        def invoke(*args):
+            return instance_processing.create_instance(INSTANCE_ID, ec2_class.details, ec2_class.sp_class, 'log',
+                                                       MOTO_ACCOUNT, 'eu-west-2', MOTO_ACCOUNT, 'pem', session_token='token')
+        self.assertTrue(invoke())
+        rotate.assert_not_called()
+        vault_details = put_instance.call_args[0][5]
+        self.assertEqual('12_3', vault_details['VaultAccountId'])
+        self.assertEqual('pending', vault_details['RotationQueue'])
+        self.assertEqual('pending', vault_details['RotationStatus'])
+        self.assertIn('RotationDueAt', vault_details)
+
     def test_get_os_distribution_user(self):
         user = instance_processing.get_os_distribution_user('centos')
         self.assertEqual(user, 'centos')
@@ -277,6 +386,15 @@ class PvwaApiCallsTest(unittest.TestCase):
         response = mock_pvwa_integration(method, parameters, 400)
         self.assertFalse(response)
 
+    def test_get_account_secret_management_removed_account(self):
+        method = 'get_account_secret_management'
+        parameters = ['1', '12_3', INSTANCE_ID, 'https://pvwa']
+        # A 404 response is falsy, it is a removed account and not a failed read
+        self.assertIsNone(mock_pvwa_integration(method, parameters, 404))
+        self.assertFalse(mock_pvwa_integration(method, parameters, 500))
+        with patch('pvwa_integration.PvwaIntegration.call_rest_api_get', return_value=None):
+            self.assertFalse(pvwa_api.get_account_secret_management(*parameters))
+
     def test_delete_account_from_vault(self):
         method = "delete_account_from_vault"
         parameters = ['1', MOTO_ACCOUNT, INSTANCE_ID, 'https://pvwa']
@@ -354,7 +472,1134 @@ class PvwaApiCallsTest(unittest.TestCase):
         response = pvwa_api.filter_get_accounts_result(parsed_json_response, INSTANCE_ID)
         self.assertFalse(response)
 
+class MetricsMechanismTest(unittest.TestCase):
+    def test_span_and_flush(self):
+        metrics = metrics_mechanism.MetricsMechanism()
+        metrics.enabled = True
+        metrics.set_dimension(metrics_mechanism.DIMENSION_PLATFORM, 'Linux')
+        metrics.set_dimension(metrics_mechanism.DIMENSION_STATE, 'running')
+        metrics.set_dimension(metrics_mechanism.DIMENSION_ACCOUNT, MOTO_ACCOUNT)
+        with metrics.span('pvwa_logon'):
+            pass
+        with metrics.span('vault_search_account'):
+            pass
+        with metrics.span('vault_search_account'):
+            pass
+        document = metrics.flush()
+        emf_metadata = document['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual('CyberArk/AOB', emf_metadata['Namespace'])
+        self.assertEqual([['Platform', 'State', 'Account']], emf_metadata['Dimensions'])
+        self.assertIn({'Name': 'pvwa_logon', 'Unit': 'Milliseconds'}, emf_metadata['Metrics'])
+        self.assertEqual('Linux', document['Platform'])
+        self.assertEqual(MOTO_ACCOUNT, document['Account'])
+        self.assertEqual(2, len(document['vault_search_account']))
+        self.assertEqual({}, metrics.timings)
+
+    def test_timed(self):
+        metrics = metrics_mechanism.MetricsMechanism()
+        metrics.enabled = True
+        @metrics.timed('conversion')
+        def convert(value):
+            return value * 2
+        self.assertEqual(4, convert(2))
+        self.assertEqual(1, len(metrics.timings['conversion']))
+
+    def test_disabled(self):
+        metrics = metrics_mechanism.MetricsMechanism()
+        metrics.enabled = False
+        with metrics.span('pvwa_logon'):
+            pass
+        self.assertEqual({}, metrics.timings)
+        self.assertIsNone(metrics.flush())
+
+    @patch('metrics_mechanism.get_metrics_enabled', return_value=False)
+    def test_switch_resolved_on_flush(self, *args):
+        metrics = metrics_mechanism.MetricsMechanism()
+        with metrics.span('pvwa_logon'):
+            pass
+        self.assertIsNone(metrics.flush())
+        self.assertFalse(metrics.enabled)
+
+class ColdStartTest(unittest.TestCase):
+    def test_log_mechanism_reads_debug_level_on_first_use(self):
+        with patch('log_mechanism.get_debug_level', return_value='Info') as get_debug_level:
+            LogMechanism.shared_debug_level = None
+            logger = LogMechanism()
+            get_debug_level.assert_not_called()
+            logger.info('message')
+            LogMechanism().info('message')
+            self.assertEqual(1, get_debug_level.call_count)
+
+    def test_pvwa_integration_reads_environment_on_first_use(self):
+        store_parameters_class = aws_services.StoreParameters('unix', 'windows', 'user', 'password', '1.1.1.1', 'kp', 'cert',
+                                                              'Production', 'trace')
+        with patch('aws_services.get_params_from_param_store', return_value=store_parameters_class) as get_params:
+            PvwaIntegration.shared_environment = None
+            pvwa_integration_class = PvwaIntegration()
+            get_params.assert_not_called()
+            self.assertEqual('/tmp/server.crt', pvwa_integration_class.certificate)
+            self.assertEqual('/tmp/server.crt', PvwaIntegration().certificate)
+            self.assertEqual(1, get_params.call_count)
+        PvwaIntegration.set_environment('POC')
+        self.assertFalse(pvwa_integration_class.certificate)
+        self.assertEqual('Production', PvwaIntegration(True, 'Production').get_environment())
+
+class TaskGraphTest(unittest.TestCase):
+    def test_run_dependencies(self):
+        order = []
+        graph = TaskGraph(deadline_mechanism.Deadline(30000))
+        graph.add_task('logon', lambda: order.append('logon') or 'token')
+        graph.add_task('safe', lambda: order.append(graph.results['logon'].value) or True, depends_on=['logon'])
+        graph.add_task('table', lambda: True)
+        results = graph.run()
+        self.assertEqual(['logon', 'token'], order)
+        self.assertTrue(results['safe'].succeeded)
+        self.assertTrue(results['table'].succeeded)
+
+    @patch('time.sleep')
+    def test_run_retry_and_skip(self, *args):
+        attempts = []
+        graph = TaskGraph(deadline_mechanism.Deadline(30000))
+        graph.add_task('flaky', lambda: attempts.append(1) or len(attempts) == 2)
+        graph.add_task('broken', fake_exc_no_args)
+        graph.add_task('after_broken', lambda: True, depends_on=['broken'])
+        graph.add_task('after_after_broken', lambda: True, depends_on=['after_broken'])
+        results = graph.run()
+        self.assertTrue(results['flaky'].succeeded)
+        self.assertEqual(2, len(attempts))
+        self.assertFalse(results['broken'].succeeded)
+        self.assertIn('fake_exc', results['broken'].error)
+        self.assertIn('Skipped', results['after_broken'].error)
+        self.assertIn('Skipped', results['after_after_broken'].error)
+
+    def test_run_undoes_step_completed_after_deadline(self):
+        logon_released = threading.Event()
+        logged_off = []
+        logoff_called = threading.Event()
+        graph = TaskGraph(deadline_mechanism.Deadline(300, safety_margin_ms=0))
+        graph.add_task('logon', lambda: logon_released.wait(5) and 'token', attempts=1,
+                       on_abandoned=lambda token: logged_off.append(token) or logoff_called.set())
+        graph.add_task('table', lambda: True, on_abandoned=logged_off.append)
+        results = graph.run()
+        self.assertEqual('Not completed before the Lambda timeout', results['logon'].error)
+        self.assertTrue(results['table'].succeeded)
+        logon_released.set()
+        self.assertTrue(logoff_called.wait(5))
+        self.assertEqual(['token'], logged_off)
+
+    def test_retry_with_jitter_deadline(self):
+        attempts = []
+        deadline = deadline_mechanism.Deadline(0)
+        value = deadline_mechanism.retry_with_jitter(lambda: attempts.append(1), deadline, attempts=3)
+        self.assertFalse(value)
+        self.assertEqual(1, len(attempts))
+
+class KeyPairImportTest(unittest.TestCase):
+    BUCKET = 'aob-key-pairs'
+
+    def setUp(self):
+        s3_mock = mock_s3()
+        s3_mock.start()
+        self.addCleanup(s3_mock.stop)
+        # moto does not decode the aws-chunked bodies sent with the checksums of the recent botocore versions
+        environment = patch.dict('os.environ', {'AWS_REQUEST_CHECKSUM_CALCULATION': 'when_required'})
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.s3_client = boto3.client('s3', region_name='eu-west-2')
+        self.s3_client.create_bucket(Bucket=self.BUCKET, CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+        self.key_pairs = {'eu-west-2': ['kp-a', 'kp-b', 'kp-c'], 'us-east-1': Exception('Rate exceeded')}
+        self.vaulted = ['AWS.199183736223.eu-west-2.kp-a', 'other-account']
+        self.pvwa = Mock()
+        self.pvwa.logon_pvwa.return_value = 'token'
+        self.pvwa.call_rest_api_get.side_effect = self.accounts_page
+        self.pvwa.call_rest_api_post.return_value = Mock(status_code=requests.codes.created)
+        self.put_key_material('eu-west-2', 'kp-b')
+
+    def put_key_material(self, region, key_pair_name):
+        self.s3_client.put_object(Bucket=self.BUCKET, Key=f'imports/199183736223/{region}/{key_pair_name}.pem', Body='pem')
+
+    def list_key_pairs(self, solution_account_id, account_id, region):
+        if isinstance(self.key_pairs[region], Exception):
+            raise self.key_pairs[region]
+        return self.key_pairs[region]
+
+    # One account by page, the safe is read with the offset of each page
+    def accounts_page(self, url, header):
+        offset = int(url.rsplit('offset=', 1)[1])
+        return Mock(status_code=requests.codes.ok,
+                    json=Mock(return_value={'value': [{'userName': name} for name in self.vaulted[offset:offset + 1]],
+                                            'count': len(self.vaulted)}))
+
+    def import_key_pairs(self, resume=False):
+        event = {'RequestType': 'ImportKeyPairs', 'Regions': ['eu-west-2', 'us-east-1'], 'Accounts': ['199183736223'],
+                 'S3BucketName': self.BUCKET, 'S3Prefix': 'imports/', 'Resume': resume}
+        context = Mock(invoked_function_arn=f'arn:aws:lambda:eu-west-2:{MOTO_ACCOUNT}:function:AOB-Setup',
+                       get_remaining_time_in_millis=Mock(return_value=300000))
+        parameters = {'AOB_PVWA_IP': '1.1.1.1', 'AOB_KeyPair_Safe': 'AOB_KeyPairs', 'AOB_mode': 'POC',
+                      'AOB_Vault_User': 'user', 'AOB_Vault_Pass': 'pass'}
+        with patch('aws_environment_setup.get_vault_parameters', return_value=parameters), \
+                patch('aws_environment_setup.PvwaIntegration', return_value=self.pvwa), \
+                patch('aws_environment_setup.list_key_pairs', side_effect=self.list_key_pairs) as list_key_pairs:
+            try:
+                return aws_environment_setup.import_key_pairs(event, context)
+            finally:
+                self.listed_regions = sorted(call_args[0][2] for call_args in list_key_pairs.call_args_list)
+
+    def saved_report(self):
+        s3_object = self.s3_client.get_object(Bucket=self.BUCKET, Key='imports/key_pair_import_report.json')
+        return json.loads(s3_object['Body'].read())
+
+    def test_import_and_resume(self):
+        report = self.import_key_pairs()
+        self.assertEqual(['eu-west-2', 'us-east-1'], self.listed_regions)
+        self.assertEqual((3, 1), (report['listed'], report['already_vaulted']))
+        self.assertEqual([['199183736223', 'eu-west-2', 'kp-b']], report['vaulted'])
+        self.assertEqual([['199183736223', 'eu-west-2', 'kp-c']], report['missing_key_material'])
+        self.assertEqual([['199183736223', 'us-east-1', 'Rate exceeded']], report['list_errors'])
+        self.assertFalse(report['complete'])
+        self.assertEqual(report, self.saved_report())
+        self.pvwa.logoff_pvwa.assert_called_once_with('https://1.1.1.1/PasswordVault', 'token')
+        # The resumed run retries the key pair without key material and lists the region that failed
+        self.key_pairs['us-east-1'] = ['kp-d']
+        self.vaulted.append('AWS.199183736223.eu-west-2.kp-b')
+        self.put_key_material('eu-west-2', 'kp-c')
+        self.put_key_material('us-east-1', 'kp-d')
+        report = self.import_key_pairs(resume=True)
+        self.assertEqual(['us-east-1'], self.listed_regions)
+        self.assertEqual([['199183736223', 'eu-west-2', 'kp-c'], ['199183736223', 'us-east-1', 'kp-d']],
+                         sorted(report['vaulted']))
+        self.assertEqual([], report['list_errors'])
+        self.assertTrue(report['complete'])
+        self.assertEqual(report, self.saved_report())
+
+    def test_pvwa_errors_are_reported(self):
+        self.key_pairs['us-east-1'] = ['kp-d']
+        self.put_key_material('eu-west-2', 'kp-c')
+        self.put_key_material('us-east-1', 'kp-d')
+        # No response for kp-c, the other key pairs are still vaulted
+        self.pvwa.call_rest_api_post.side_effect = lambda url, data, header: \
+            None if 'kp-c' in data else Mock(status_code=requests.codes.created)
+        report = self.import_key_pairs()
+        self.assertEqual([['199183736223', 'eu-west-2', 'kp-c']], report['failed'])
+        self.assertEqual(2, len(report['vaulted']))
+        self.assertEqual(report, self.saved_report())
+        # The safe cannot be read, the listed key pairs are saved as pending for a resumed run
+        self.pvwa.call_rest_api_get.side_effect = None
+        self.pvwa.call_rest_api_get.return_value = None
+        with self.assertRaises(Exception):
+            self.import_key_pairs()
+        report = self.saved_report()
+        self.assertEqual(4, len(report['pending']))
+        self.assertFalse(report['complete'])
+        self.assertEqual(2, self.pvwa.logoff_pvwa.call_count)
+
+class EventQueueTest(unittest.TestCase):
+    def test_parse_state_change_message(self):
+        message = {'detail': {'instance-id': INSTANCE_ID, 'state': 'running'}, 'account': MOTO_ACCOUNT}
+        sns_record = {'Sns': {'Message': json.dumps(message)}}
+        sqs_sns_record = {'body': json.dumps({'Type': 'Notification', 'Message': json.dumps(message)})}
+        sqs_raw_record = {'body': json.dumps(message)}
+        for record in (sns_record, sqs_sns_record, sqs_raw_record):
+            self.assertEqual(message, event_queue.parse_state_change_message(record))
+        redriven_record = circuit_breaker.build_redrive_event('event-1', json.dumps(message))['Records'][0]
+        self.assertEqual(message, event_queue.parse_state_change_message(redriven_record))
+        self.assertEqual('event-1', event_queue.get_message_id(redriven_record))
+
+    def test_drain_queue_partial_batch_failure(self):
+        queue = InMemoryEventQueue(max_receive_count=2)
+        for index in range(25):
+            queue.send(json.dumps({'index': index}))
+        batch_sizes = []
+        def batch_handler(event, context):
+            batch_sizes.append(len(event['Records']))
+            failures = [{'itemIdentifier': record['messageId']} for record in event['Records']
+                        if json.loads(record['body'])['index'] == 3]
+            return {'batchItemFailures': failures}
+        failed = drain_queue(queue, batch_handler, None, batch_size=10)
+        self.assertEqual([10, 10, 6], batch_sizes)
+        self.assertEqual(2, failed)
+        self.assertEqual(0, len(queue))
+        self.assertEqual(1, len(queue.dead_letters))
+
+class EventCoalescingTest(unittest.TestCase):
+    @patch('aws_services.get_instances_data_from_dynamo_table', return_value={})
+    def test_coalesce_events(self, get_rows):
+        events = [('3', state_change_message('i-1', 'terminated', '2021-03-01T10:02:00Z')),
+                  ('1', state_change_message('i-1', 'running', '2021-03-01T10:00:00Z')),
+                  ('4', state_change_message('i-2', 'terminated', '2021-03-01T10:03:00Z')),
+                  ('2', state_change_message('i-3', 'running', '2021-03-01T10:01:00Z')),
+                  ('5', state_change_message('i-3', 'running', '2021-03-01T10:01:30Z'))]
+        to_process, cancelled = event_coalescing.coalesce_events(events)
+        self.assertEqual(['2', '4'], [key for key, data in to_process])
+        self.assertEqual(['5', '1', '3'], cancelled)
+        get_rows.assert_called_once_with({'i-1'})
+
+    @patch('aws_services.get_instances_data_from_dynamo_table')
+    def test_coalesce_events_onboarded_instance(self, get_rows):
+        # A redelivered running event of an onboarded instance, the terminated event still offboards it
+        get_rows.return_value = {'i-1': {'InstanceId': {'S': 'i-1'}}}
+        events = [('1', state_change_message('i-1', 'running', '2021-03-01T10:00:00Z')),
+                  ('2', state_change_message('i-1', 'terminated', '2021-03-01T10:02:00Z'))]
+        to_process, cancelled = event_coalescing.coalesce_events(events)
+        self.assertEqual(['2'], [key for key, data in to_process])
+        self.assertEqual(['1'], cancelled)
+        get_rows.side_effect = Exception('throttled')
+        to_process, cancelled = event_coalescing.coalesce_events(events)
+        self.assertEqual(['2'], [key for key, data in to_process])
+
+    def test_get_event_time_and_is_ended(self):
+        self.assertEqual(60, event_coalescing.get_event_time({'time': '1970-01-01T00:01:00Z'}))
+        self.assertIsNone(event_coalescing.get_event_time({}))
+        self.assertTrue(event_coalescing.is_ended({'state': 'shutting-down'}))
+        self.assertFalse(event_coalescing.is_ended({'state': 'running'}))
+
+class EventPipelineTest(unittest.TestCase):
+    def test_run_stops_at_first_final_result(self):
+        calls = []
+        pipeline = event_pipeline.EventPipeline([('first', lambda event: calls.append('first') or event_pipeline.CONTINUE),
+                                                 ('second', lambda event: calls.append('second')),
+                                                 ('third', lambda event: calls.append('third') or event_pipeline.CONTINUE)])
+        self.assertIsNone(pipeline.run(None))
+        self.assertEqual(['first', 'second'], calls)
+        self.assertTrue(event_pipeline.EventPipeline([]).run(None))
+
+    def test_lazy_property(self):
+        class Event:
+            fetches = 0
+            @event_pipeline.lazy_property
+            def details(self):
+                Event.fetches += 1
+                return {'platform': 'windows'}
+        event = Event()
+        self.assertFalse(event_pipeline.is_loaded(event, 'details'))
+        self.assertEqual('windows', event.details['platform'])
+        self.assertEqual('windows', event.details['platform'])
+        self.assertEqual(1, Event.fetches)
+        self.assertTrue(event_pipeline.is_loaded(event, 'details'))
+
+class CredentialRotationTest(unittest.TestCase):
+    def test_token_bucket_paces_requests(self):
+        clock = FakeClock()
+        bucket = credential_rotation.TokenBucket(2, clock=clock.time, sleep=clock.sleep)
+        deadline = deadline_mechanism.Deadline(60000, 0)
+        self.assertTrue(all(bucket.acquire(deadline) for _ in range(5)))
+        self.assertEqual([0.5] * 4, clock.sleeps)
+        slow_bucket = credential_rotation.TokenBucket(0.01, clock=clock.time, sleep=clock.sleep)
+        self.assertTrue(slow_bucket.acquire(deadline))
+        self.assertFalse(slow_bucket.acquire(deadline))
+
+    def test_scheduler_respects_safe_concurrency(self):
+        config = dict(credential_rotation.DEFAULT_ROTATION_CONFIG, AOB_Rotation_Rate=600, AOB_Rotation_Safe_Concurrency=2)
+        in_progress = [rotation_item('i-a0', 'unix', dispatched_at=990)]
+        due = [rotation_item(f'i-a{index}', 'unix') for index in range(1, 4)] + [rotation_item('i-b1', 'windows')]
+        dispatched, updates = run_rotation_scheduler(config, in_progress, due, secret_management={'i-a0': {'status': ''}})
+        self.assertEqual(['i-a1', 'i-b1'], dispatched)
+        self.assertEqual({'rotated': 0, 'failed': 0, 'given_up': 0, 'dispatched': 2, 'deferred': 2},
+                         updates['summary'])
+        self.assertEqual('dispatched', updates['i-a1'][0]['RotationQueue'])
+
+    def test_scheduler_follows_up_changes(self):
+        config = dict(credential_rotation.DEFAULT_ROTATION_CONFIG)
+        in_progress = [rotation_item('i-done', 'unix', dispatched_at=900),
+                       rotation_item('i-cpm-failed', 'unix', dispatched_at=500),
+                       rotation_item('i-last-attempt', 'unix', dispatched_at=500, failures=4),
+                       rotation_item('i-removed', 'unix', dispatched_at=900)]
+        secret_management = {'i-done': {'status': 'success', 'lastModifiedTime': 950},
+                             'i-cpm-failed': {'status': 'failure', 'lastModifiedTime': 100},
+                             'i-last-attempt': {'status': 'failure'},
+                             'i-removed': None}
+        dispatched, updates = run_rotation_scheduler(config, in_progress, [], secret_management=secret_management)
+        self.assertEqual([], dispatched)
+        self.assertEqual(({'RotationStatus': 'rotated', 'RotationCompletedAt': 1000}, ('RotationQueue', 'RotationError')),
+                         updates['i-done'])
+        retry = updates['i-cpm-failed'][0]
+        self.assertEqual(('pending', 1), (retry['RotationQueue'], retry['RotationFailures']))
+        self.assertEqual(1000 + credential_rotation.ROTATION_RETRY_SECONDS,
+                         retry['RotationDueAt'] + config['AOB_Rotation_Min_Age'])
+        self.assertEqual(('failed', 5), (updates['i-last-attempt'][0]['RotationStatus'],
+                                         updates['i-last-attempt'][0]['RotationFailures']))
+        self.assertEqual(('RotationQueue', 'RotationStatus'), updates['i-removed'][1])
+
+    def test_scheduler_skips_logon_without_work(self):
+        vault_session = Mock()
+        with patch('aws_services.get_rotation_queue', return_value=[]):
+            scheduler = credential_rotation.RotationScheduler(vault_session, credential_rotation.DEFAULT_ROTATION_CONFIG,
+                                                              deadline_mechanism.Deadline(60000, 0))
+            scheduler.run()
+        vault_session.get_token.assert_not_called()
+
+
+class BulkOnboardingTest(unittest.TestCase):
+    def test_submit_creates_one_job_per_safe_and_platform(self):
+        collector = bulk_onboarding.BulkOnboarding(bulk_vault_session(), deadline_mechanism.Deadline(60000, 0), 'log')
+        for index in range(3):
+            collector.add(f'i-unix{index}', bulk_instance_details(index), bulk_instance_account(f'i-unix{index}', 'unix'))
+        collector.add('i-win0', bulk_instance_details(9), bulk_instance_account('i-win0', 'windows'))
+        jobs = []
+        def create_job(session, accounts, pvwa_url):
+            jobs.append(accounts)
+            return len(jobs)
+        job_results = {1: [{'Status': 'inProgress'},
+                           {'Status': 'completedWithErrors',
+                            'Result': {'succeeded': [{'itemIndex': 0, 'id': '12_1'}, {'itemIndex': 2}],
+                                       'failed': [{'itemIndex': 1, 'error': 'Account already exists'}]}}],
+                       2: [{'Status': 'completed', 'Result': {'succeeded': [], 'failed': [{'itemIndex': 0,
+                                                                                          'error': 'Invalid platform'}]}}]}
+        rows = dict()
+        def put_instance(instance_id, address, status, error="None", log_name="None", vault_details=None):
+            rows[instance_id] = (status, error, vault_details or dict())
+        with patch('pvwa_api_calls.create_bulk_accounts_job', create_job), \
+                patch('pvwa_api_calls.get_bulk_accounts_job', lambda session, job_id, url: job_results[job_id].pop(0)), \
+                patch('pvwa_api_calls.retrieve_account_id_from_account_name', side_effect=lambda *args: f'{args[3]}_id'), \
+                patch('aws_services.put_instance_to_dynamo_table', put_instance), patch('time.sleep'):
+            results = collector.submit()
+        self.assertEqual(['UnixSSHKeys', 'WinServerLocal'], [accounts[0]['platformId'] for accounts in jobs])
+        self.assertEqual(('key', 'password'), (jobs[0][0]['secretType'], jobs[1][0]['secretType']))
+        self.assertEqual({'i-unix0': True, 'i-unix1': True, 'i-unix2': True, 'i-win0': True}, results)
+        self.assertEqual('12_1', rows['i-unix0'][2]['VaultAccountId'])
+        self.assertEqual('pending', rows['i-unix0'][2]['RotationQueue'])
+        self.assertEqual('i-unix1_id', rows['i-unix1'][2]['VaultAccountId'])
+        self.assertNotIn('RotationQueue', rows['i-unix1'][2])
+        self.assertEqual('i-unix2_id', rows['i-unix2'][2]['VaultAccountId'])
+        self.assertEqual(('on board failed', 'Invalid platform'), rows['i-win0'][:2])
+        self.assertEqual(0, len(collector))
+
+    def test_unfinished_job_is_retried(self):
+        collector = bulk_onboarding.BulkOnboarding(bulk_vault_session(), deadline_mechanism.Deadline(0, 0), 'log')
+        collector.add('i-unix0', bulk_instance_details(0), bulk_instance_account('i-unix0', 'unix'))
+        put_instance = Mock()
+        with patch('pvwa_api_calls.create_bulk_accounts_job', return_value=7), \
+                patch('pvwa_api_calls.get_bulk_accounts_job', return_value={'Status': 'inProgress'}), \
+                patch('aws_services.put_instance_to_dynamo_table', put_instance):
+            self.assertEqual({'i-unix0': False}, collector.submit())
+        put_instance.assert_not_called()
+
+
+@mock_dynamodb2
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_fails_fast_and_closes_with_a_single_probe(self):
+        dynamodb = boto3.resource('dynamodb')
+        sessions_table = dynamo_create_sessions_table(dynamodb)
+        clock = FakeClock()
+        breakers = [circuit_breaker.CircuitBreaker(failure_threshold=3, open_seconds=60, clock=clock.time) for _ in range(2)]
+        for breaker in breakers:
+            self.assertTrue(breaker.allow_request())
+            breaker.record_failure()
+        self.assertTrue(breakers[0].allow_request())
+        breakers[0].record_failure()
+        self.assertFalse(breakers[1].allow_request())
+        clock.sleep(61)
+        self.assertTrue(breakers[0].allow_request())
+        self.assertFalse(breakers[1].allow_request())
+        breakers[0].record_failure()
+        self.assertFalse(breakers[1].allow_request())
+        clock.sleep(61)
+        self.assertTrue(breakers[1].allow_request())
+        breakers[1].record_success()
+        self.assertTrue(breakers[0].allow_request())
+        self.assertEqual(0, breakers[0].item['failures'])
+        sessions_table.delete()
+
+    def test_parked_events_are_redriven_once_closed(self):
+        dynamodb = boto3.resource('dynamodb')
+        sessions_table = dynamo_create_sessions_table(dynamodb)
+        parked_table = dynamodb.create_table(TableName='ParkedEvents',
+                                             KeySchema=[{"AttributeName": "EventId", "KeyType": "HASH"}],
+                                             AttributeDefinitions=[{"AttributeName": "EventId", "AttributeType": "S"}])
+        clock = FakeClock()
+        breaker = circuit_breaker.CircuitBreaker(failure_threshold=1, open_seconds=60, clock=clock.time)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow_request())
+        messages = [state_change_message(f'i-{index}', 'running', '2021-03-01T10:00:00Z') for index in range(3)]
+        for message in messages:
+            self.assertTrue(breaker.park(circuit_breaker.get_event_id(message), message))
+        self.assertFalse(breaker.claim_redrive())
+        clock.sleep(61)
+        self.assertTrue(breaker.allow_request())
+        breaker.record_success()
+        breaker.read()
+        self.assertTrue(breaker.claim_redrive())
+        self.assertFalse(circuit_breaker.CircuitBreaker(clock=clock.time).claim_redrive())
+        breaker.lambda_client = Mock()
+        self.assertEqual(3, breaker.redrive('arn:function', deadline_mechanism.Deadline(60000, 0)))
+        payloads = [json.loads(call[1]['Payload']) for call in breaker.lambda_client.invoke.call_args_list]
+        self.assertEqual(sorted(messages, key=lambda message: message['detail']['instance-id']),
+                         sorted([json.loads(payload['Records'][0]['Sns']['Message']) for payload in payloads],
+                                key=lambda message: message['detail']['instance-id']))
+        self.assertEqual(0, parked_table.scan()['Count'])
+        self.assertEqual(0, breaker.read()['parked'])
+        parked_table.delete()
+        sessions_table.delete()
+
+
+@mock_dynamodb2
+class SessionSlotsTest(unittest.TestCase):
+    def test_lease_is_renewed_and_released_once(self):
+        dynamodb = boto3.resource('dynamodb')
+        sessions_table = dynamo_create_sessions_table(dynamodb)
+        with patch('random.randint', return_value=7):
+            lease = session_slots.acquire_slot(lease_seconds=0.5, heartbeat_seconds=0.1, attempts=1)
+            time.sleep(1)
+            self.assertIsNone(session_slots.acquire_slot(attempts=1))
+        self.assertEqual({'leased': 1, 'expired': 0, 'free': 99}, session_slots.get_slot_occupancy())
+        with lease:
+            self.assertEqual('7', lease.slot)
+        lease.release()
+        self.assertFalse(lease.heartbeat.is_alive())
+        self.assertEqual(0, sessions_table.scan()['Count'])
+        sessions_table.delete()
+
+    def test_expired_slots_are_taken_over_and_swept(self):
+        dynamodb = boto3.resource('dynamodb')
+        sessions_table = dynamo_create_sessions_table(dynamodb)
+        sessions_table.put_item(Item={'name': 'pvwa_circuit', 'failures': 0})
+        sessions_table.put_item(Item={'name': '3', 'guid': 'stopped', 'expiresOn': int(time.time()) - 10})
+        sessions_table.put_item(Item={'name': '7', 'guid': 'stopped', 'expiresOn': int(time.time()) - 10})
+        self.assertEqual({'leased': 0, 'expired': 2, 'free': 100}, session_slots.get_slot_occupancy())
+        with patch('random.randint', return_value=7):
+            lease = session_slots.acquire_slot(heartbeat_seconds=60, attempts=1)
+        self.assertIsNotNone(lease)
+        stale_lease = session_slots.SlotLease('7', 'stopped', heartbeat_seconds=60)
+        self.assertFalse(stale_lease.renew())
+        self.assertTrue(stale_lease.lost)
+        stale_lease.release()
+        self.assertEqual(lease.guid, sessions_table.get_item(Key={'name': '7'})['Item']['guid'])
+        self.assertEqual(1, session_slots.sweep_expired_slots())
+        self.assertEqual({'leased': 1, 'expired': 0, 'free': 99}, session_slots.get_slot_occupancy())
+        lease.release()
+        self.assertEqual(['pvwa_circuit'], [item['name'] for item in sessions_table.scan()['Items']])
+        sessions_table.delete()
+
+
+class PvwaRoutingTest(unittest.TestCase):
+    def routing_config(self, strategy):
+        return patch('pvwa_routing.get_routing_config', return_value={pvwa_routing.ROUTING_PARAM: strategy,
+                                                                      pvwa_routing.NODE_SLOTS_PARAM: 30})
+
+    def test_sessions_are_pinned_to_a_node_slot_range(self):
+        store_parameters_class = aws_services.StoreParameters('unix', 'windows', 'user', 'password', '10.0.0.1, 10.0.0.2',
+                                                              'kp', 'cert', 'POC', 'trace')
+        self.assertEqual(['https://10.0.0.1/PasswordVault', 'https://10.0.0.2/PasswordVault'], store_parameters_class.pvwa_urls)
+        router = pvwa_routing.PvwaRouter()
+        lease = Mock()
+        with self.routing_config(pvwa_routing.LEAST_OUTSTANDING), \
+                patch('pvwa_routing.pvwa_router', router), \
+                patch('session_slots.acquire_slot', return_value=lease) as acquire_slot, \
+                patch('random.choice', side_effect=lambda nodes: nodes[-1]), \
+                patch('pvwa_routing.pvwa_concurrency.get_limit', side_effect=[100, 50]):
+            slot_lease, pinned_parameters = pvwa_routing.acquire_node_slot(store_parameters_class)
+            pvwa_routing.acquire_node_slot(store_parameters_class)
+        self.assertEqual(lease, slot_lease)
+        self.assertEqual([call(first_slot=31, last_slot=60, deadline=None),
+                          call(first_slot=31, last_slot=45, deadline=None)], acquire_slot.call_args_list)
+        self.assertEqual('https://10.0.0.2/PasswordVault', pinned_parameters.pvwa_url)
+        self.assertEqual('https://10.0.0.1/PasswordVault', store_parameters_class.pvwa_url)
+
+    def test_least_outstanding_routing_skips_failing_nodes(self):
+        clock = FakeClock()
+        router = pvwa_routing.PvwaRouter(clock=clock.time)
+        urls = ['https://a/PasswordVault', 'https://b/PasswordVault']
+        with self.routing_config(pvwa_routing.LEAST_OUTSTANDING):
+            router.select(urls)
+        call = router.start('https://a/PasswordVault/api/Accounts')
+        self.assertEqual(urls[1], router.select(urls).url)
+        router.finish(call, Mock(status_code=200))
+        for _ in range(pvwa_routing.FAILURE_THRESHOLD):
+            router.finish(router.start('https://b/PasswordVault/api/Accounts'), Mock(status_code=503))
+        self.assertEqual({urls[0]}, set(router.select(urls).url for _ in range(10)))
+        clock.sleep(pvwa_routing.DOWN_SECONDS)
+        router.finish(router.start('https://b/PasswordVault/api/Accounts'), None)
+        self.assertEqual({urls[0]}, set(router.select(urls).url for _ in range(10)))
+        clock.sleep(pvwa_routing.DOWN_SECONDS)
+        router.finish(router.start('https://b/PasswordVault/api/Accounts'), Mock(status_code=404))
+        self.assertEqual(0, router.get_node(urls[1]).failures)
+        self.assertIsNone(router.start('https://other/PasswordVault'))
+
+    def test_latency_weighted_routing_favours_the_fastest_node(self):
+        clock = FakeClock()
+        router = pvwa_routing.PvwaRouter(clock=clock.time)
+        urls = ['https://a/PasswordVault', 'https://b/PasswordVault']
+        with self.routing_config(pvwa_routing.LATENCY_WEIGHTED):
+            router.select(urls)
+        call = router.start('https://a/PasswordVault/api/Accounts')
+        clock.sleep(2)
+        router.finish(call, Mock(status_code=200))
+        with patch('random.choices', side_effect=lambda nodes, weights: [nodes[weights.index(max(weights))]]):
+            self.assertEqual(urls[1], router.select(urls).url)
+
+
+@mock_dynamodb2
+@patch('adaptive_concurrency.get_target_latency_seconds', return_value=1.0)
+class AdaptiveConcurrencyTest(unittest.TestCase):
+    def observe(self, controller, seconds, failed=False):
+        for _ in range(adaptive_concurrency.WINDOW_MIN_CALLS):
+            controller.observe(seconds, failed)
+
+    def test_limit_backs_off_once_and_increases_additively(self, *args):
+        dynamodb = boto3.resource('dynamodb')
+        sessions_table = dynamo_create_sessions_table(dynamodb)
+        clock = FakeClock()
+        controllers = [adaptive_concurrency.AdaptiveConcurrency(clock=clock.time) for _ in range(2)]
+        self.observe(controllers[0], 0.2)
+        clock.sleep(adaptive_concurrency.WINDOW_SECONDS)
+        self.assertEqual(100, controllers[0].get_limit())
+        for controller in controllers:
+            self.observe(controller, 3)
+        clock.sleep(adaptive_concurrency.WINDOW_SECONDS)
+        self.assertEqual([50, 50], [controller.get_limit() for controller in controllers])
+        self.observe(controllers[0], 0.2, failed=True)
+        clock.sleep(adaptive_concurrency.DECREASE_SECONDS + 1)
+        self.assertEqual(25, controllers[0].get_limit())
+        for controller in controllers:
+            self.observe(controller, 0.2)
+        clock.sleep(adaptive_concurrency.WINDOW_SECONDS)
+        self.assertEqual([26, 26], [controller.get_limit() for controller in controllers])
+        self.assertEqual('26', sessions_table.get_item(Key={'name': 'pvwa_concurrency'})['Item']['limit'].to_eng_string())
+        sessions_table.delete()
+
+    def test_limit_is_kept_between_min_and_max(self, *args):
+        dynamodb = boto3.resource('dynamodb')
+        sessions_table = dynamo_create_sessions_table(dynamodb)
+        clock = FakeClock()
+        controller = adaptive_concurrency.AdaptiveConcurrency(min_limit=10, max_limit=20, clock=clock.time)
+        for _ in range(3):
+            self.observe(controller, 0.2, failed=True)
+            clock.sleep(adaptive_concurrency.DECREASE_SECONDS + 1)
+            controller.get_limit()
+        self.assertEqual(10, controller.limit)
+        for _ in range(12):
+            self.observe(controller, 0.2)
+            clock.sleep(adaptive_concurrency.WINDOW_SECONDS)
+            controller.get_limit()
+        self.assertEqual(20, controller.limit)
+        sessions_table.delete()
+
+
+class ConversionCacheTest(unittest.TestCase):
+    @patch('kp_processing.ppk_cache', kp_processing.ConversionCache())
+    @patch('kp_processing.run_puttygen', side_effect=lambda pem_key: f'ppk of {pem_key.strip()}')
+    def test_key_pair_is_converted_once(self, run_puttygen):
+        keys = ['-----KEY1-----', '-----KEY2-----\n']
+        results = [kp_processing.convert_pem_to_ppk(keys[index % 2]) for index in range(10)]
+        self.assertEqual(['ppk of -----KEY1-----', 'ppk of -----KEY2-----'] * 5, results)
+        self.assertEqual([call(keys[0]), call(keys[1])], run_puttygen.call_args_list)
+        self.assertEqual('ppk of -----KEY2-----', kp_processing.convert_pem_to_ppk('-----KEY2-----'))
+        self.assertEqual(2, run_puttygen.call_count)
+
+    def test_evicted_values_are_zeroed(self):
+        cache = kp_processing.ConversionCache(max_size=2)
+        for name in ('a', 'b'):
+            cache.put(name, f'secret {name}')
+        values = dict(cache.values)
+        self.assertEqual('secret a', cache.get('a'))
+        cache.put('c', 'secret c')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(bytearray(8), values['b'])
+        self.assertEqual('secret a', cache.get('a'))
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(bytearray(8), values['a'])
+
+
+@mock_dynamodb2
+class DeadlineCheckpointTest(unittest.TestCase):
+    def test_slot_wait_stops_at_the_deadline(self):
+        dynamodb = boto3.resource('dynamodb')
+        sessions_table = dynamo_create_sessions_table(dynamodb)
+        lease = session_slots.acquire_slot(heartbeat_seconds=60, first_slot=1, last_slot=1)
+        with patch('time.sleep') as sleep:
+            with self.assertRaises(deadline_mechanism.DeadlineExceeded) as context:
+                session_slots.acquire_slot(first_slot=1, last_slot=1, deadline=deadline_mechanism.Deadline(12000, 0))
+            self.assertEqual('session slot', context.exception.step)
+            with self.assertRaises(deadline_mechanism.DeadlineExceeded):
+                session_slots.acquire_slot(deadline=deadline_mechanism.Deadline(5000, 0))
+        sleep.assert_not_called()
+        lease.release()
+        sessions_table.delete()
+
+    def test_password_wait_is_bounded_by_the_deadline(self):
+        ec2_client = Mock()
+        waiter = ec2_client.get_waiter.return_value
+        waiter.wait.side_effect = Exception('Waiter PasswordDataAvailable failed: Max attempts exceeded')
+        with patch('boto3.client', return_value=ec2_client):
+            with self.assertRaises(deadline_mechanism.DeadlineExceeded) as context:
+                instance_processing.get_instance_password_data(INSTANCE_ID, MOTO_ACCOUNT, 'eu-west-2', MOTO_ACCOUNT,
+                                                               deadline_mechanism.Deadline(100000, 0))
+            self.assertEqual('windows password', context.exception.step)
+            waiter.wait.assert_called_once_with(InstanceId=INSTANCE_ID, WaiterConfig={'Delay': 15, 'MaxAttempts': 5})
+            with self.assertRaises(deadline_mechanism.DeadlineExceeded):
+                instance_processing.get_instance_password_data(INSTANCE_ID, MOTO_ACCOUNT, 'eu-west-2', MOTO_ACCOUNT,
+                                                               deadline_mechanism.Deadline(20000, 0))
+            self.assertEqual(1, waiter.wait.call_count)
+
+    def test_checkpoint_is_saved_and_read_back(self):
+        dynamodb = boto3.resource('dynamodb')
+        instances_table = dynamo_create_instances_table(dynamodb)
+        self.assertTrue(instance_processing.save_checkpoint(INSTANCE_ID, {'address': '10.0.0.1', 'processing_started_at': 990},
+                                                            'windows password', 'log', 2, '33_4'))
+        instance_data = aws_services.get_instance_data_from_dynamo_table(INSTANCE_ID)
+        self.assertEqual('on board pending', instance_data['Status']['S'])
+        self.assertEqual({'step': 'windows password', 'resume_count': 2, 'key_pair_account_id': '33_4',
+                          'processing_started_at': 990}, instance_processing.get_checkpoint(instance_data))
+        self.assertIsNone(instance_processing.get_checkpoint({'Status': {'S': 'on boarded'}}))
+        instances_table.delete()
+
+
+class LatencyLedgerTest(unittest.TestCase):
+    def test_vaulted_row_records_the_ledger(self):
+        ec2_class = EC2Details()
+        ec2_class.set_platform('linix')
+        ec2_class.set_image_description('ubuntu')
+        ec2_class.details.update(event_time=900, processing_started_at=960, region='eu-west-2')
+        put_instance = Mock(return_value=True)
+        @patch('kp_processing.convert_pem_to_ppk', return_value='VeryValue')
+        @patch('pvwa_api_calls.retrieve_account_id_from_account_name', side_effect=[False, '12_3'])
+        @patch('pvwa_api_calls.create_account_on_vault', return_value=[True, ''])
+        @patch('aws_services.put_instance_to_dynamo_table', put_instance)
+        @patch('time.time', return_value=1000)
+        def invoke(*args):
+            return instance_processing.create_instance(INSTANCE_ID, ec2_class.details, ec2_class.sp_class, 'log',
+                                                       MOTO_ACCOUNT, 'eu-west-2', MOTO_ACCOUNT, 'pem', session_token='token')
+        self.assertTrue(invoke())
+        vault_details = put_instance.call_args[0][5]
+        self.assertEqual({'EventTime': 900, 'ProcessingStartedAt': 960, 'VaultCreatedAt': 1000, 'RotationDueAt': 1000,
+                          'AccountId': '199183736223', 'Region': 'eu-west-2'},
+                         {key: vault_details[key] for key in ('EventTime', 'ProcessingStartedAt', 'VaultCreatedAt',
+                                                              'RotationDueAt', 'AccountId', 'Region')})
+
+    def test_report_nearest_rank_percentiles(self):
+        percentile = onboarding_latency_report.percentile
+        self.assertEqual([5, 9, 10, 10], [percentile(range(1, 11), percent) for percent in (50, 90, 99, 100)])
+        self.assertEqual([50, 90, 99], [percentile(range(100, 0, -1), percent) for percent in (50, 90, 99)])
+        self.assertEqual((7, 0), (percentile([7], 1), percentile([], 50)))
+        rows = [{'InstanceId': f'i-{index}', 'Status': 'on boarded', 'Platform': WINDOWS_PLATFORM if index % 2 else 'Linux',
+                 'AccountId': MOTO_ACCOUNT, 'Region': 'eu-west-2', 'EventTime': 1000, 'ProcessingStartedAt': 1000 + index,
+                 'VaultCreatedAt': 1010 + index} for index in range(1, 11)]
+        rows += [{'InstanceId': 'i-old', 'Status': 'on boarded'}, dict(rows[0], InstanceId='i-early', EventTime=10)]
+        report = onboarding_latency_report.build_report(rows, since=500)
+        self.assertEqual({'on boarded': 12}, report['statuses'])
+        self.assertEqual(1, report['without_ledger'])
+        self.assertEqual({'count': 10, 'p50': 5, 'p90': 9, 'p99': 10, 'max': 10}, report['stages_seconds']['queue'])
+        self.assertEqual({'count': 10, 'p50': 15, 'p90': 19, 'p99': 20, 'max': 20}, report['stages_seconds']['vaulted'])
+        self.assertEqual(0, report['stages_seconds']['rotation']['count'])
+        self.assertEqual({'count': 5, 'p50': 16, 'p90': 20, 'p99': 20, 'max': 20},
+                         report['breakdowns_seconds']['platform']['Linux']['vaulted'])
+
+
+class ProfilingMechanismTest(unittest.TestCase):
+    def test_handler_is_called_directly_when_off(self):
+        profiler = profiling_mechanism.ProfilingMechanism()
+        handler = profiler.profiled('handler')(lambda event, context: event['value'])
+        config = {'AOB_Profiling_Rate': 0.0, 'AOB_Profiling_Bucket': None}
+        with patch('profiling_mechanism.get_profiling_config', return_value=config) as get_config, \
+                patch('cProfile.Profile') as profile:
+            self.assertEqual([1, 2], [handler({'value': value}, None) for value in (1, 2)])
+        get_config.assert_called_once_with()
+        profile.assert_not_called()
+
+    def test_sampled_invocation_saves_compressed_stats(self):
+        profiler = profiling_mechanism.ProfilingMechanism(clock=lambda: 1000)
+        profiler.rate, profiler.bucket = 1.0, 'profiles-bucket'
+        handler = profiler.profiled('handler')(lambda event, context: [bytearray(1024) for _ in range(event)])
+        with patch('profiling_mechanism.upload_profile') as upload:
+            self.assertEqual(10, len(handler(10, Mock(aws_request_id='request'))))
+        self.assertEqual(['aob-profiles/handler/1000-request.prof.gz', 'aob-profiles/handler/1000-request.tracemalloc.gz'],
+                         [upload_call[0][1] for upload_call in upload.call_args_list])
+        stats = marshal.loads(gzip.decompress(upload.call_args_list[0][0][2]))
+        self.assertTrue(any(function[2] == '<lambda>' for function in stats))
+        snapshot = pickle.loads(gzip.decompress(upload.call_args_list[1][0][2]))
+        self.assertTrue(snapshot.statistics('lineno'))
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+class SafeShardingTest(unittest.TestCase):
+    def sharding(self, shards, shard_key='InstanceId'):
+        sharding = safe_sharding.SafeSharding()
+        sharding.config = {safe_sharding.SHARDS_PARAM: shards, safe_sharding.SHARD_KEY_PARAM: shard_key}
+        return sharding
+
+    def test_accounts_spread_over_stable_shards(self):
+        instance_ids = [f'i-{index:08x}' for index in range(4000)]
+        self.assertEqual({'AOB_Unix'}, {self.sharding(1).get_safe_name('AOB_Unix', instance_id, MOTO_ACCOUNT)
+                                        for instance_id in instance_ids})
+        shards = [safe_sharding.get_shard(instance_id, 4) for instance_id in instance_ids]
+        self.assertEqual(shards, [safe_sharding.get_shard(instance_id, 4) for instance_id in instance_ids])
+        for shard in range(4):
+            self.assertAlmostEqual(1000, shards.count(shard), delta=150)
+        # Adding a shard only moves the accounts it takes over, about a fifth of them
+        moved = [(before, safe_sharding.get_shard(instance_id, 5)) for instance_id, before in zip(instance_ids, shards)
+                 if safe_sharding.get_shard(instance_id, 5) != before]
+        self.assertAlmostEqual(800, len(moved), delta=150)
+        self.assertEqual({4}, {after for before, after in moved})
+        self.assertEqual('AOB_Unix', safe_sharding.get_shard_safe_name('AOB_Unix', 0))
+        self.assertEqual('AOB_Unix_03', safe_sharding.get_shard_safe_name('AOB_Unix', 3))
+        self.assertEqual('A' * 25 + '_03', safe_sharding.get_shard_safe_name('A' * 30, 3))
+        by_account = self.sharding(4, 'AccountId')
+        self.assertEqual(1, len({by_account.get_safe_name('AOB_Unix', instance_id, MOTO_ACCOUNT)
+                                 for instance_id in instance_ids[:50]}))
+
+    @patch('pvwa_api_calls.get_safe_members', return_value=[])
+    @patch('pvwa_api_calls.create_safe', return_value=True)
+    @patch('pvwa_api_calls.get_safe')
+    def test_shard_safe_created_once_from_the_base_safe(self, get_safe, create_safe, *args):
+        get_safe.side_effect = lambda session, safe_name, rest_url: \
+            {'ManagingCPM': 'CPM2', 'NumberOfDaysRetention': 30} if safe_name == 'AOB_Unix' else False
+        sharding = self.sharding(4)
+        self.assertTrue(sharding.ensure_safe('token', 'AOB_Unix', 'AOB_Unix', 'https://pvwa'))
+        get_safe.assert_not_called()
+        for _ in range(3):
+            self.assertTrue(sharding.ensure_safe('token', 'AOB_Unix_02', 'AOB_Unix', 'https://pvwa'))
+        create_safe.assert_called_once_with('token', 'AOB_Unix_02', 'CPM2', 'https://pvwa', 30)
+        self.assertEqual(2, get_safe.call_count)
+        create_safe.return_value = False
+        self.assertFalse(sharding.ensure_safe('token', 'AOB_Unix_03', 'AOB_Unix', 'https://pvwa'))
+        self.assertNotIn('AOB_Unix_03', sharding.known_safes)
+
+    @patch('pvwa_api_calls.add_safe_member')
+    @patch('pvwa_api_calls.get_safe_members')
+    @patch('pvwa_api_calls.get_safe', return_value={'SafeName': 'AOB_Unix_02'})
+    def test_shard_safe_gets_the_members_of_the_base_safe(self, get_safe, get_safe_members, add_safe_member):
+        operators = {'memberName': 'AOB_Operators', 'memberType': 'Group', 'permissions': {'useAccounts': True}}
+        auditor = {'memberName': 'auditor', 'memberType': 'User', 'permissions': {'listAccounts': True}}
+        vault_user = {'memberName': 'aob_user', 'memberType': 'User', 'permissions': {'addAccounts': True}}
+        members = {'AOB_Unix': [operators, auditor, vault_user], 'AOB_Unix_02': [vault_user]}
+        get_safe_members.side_effect = lambda session, safe_name, rest_url: members[safe_name]
+        add_safe_member.side_effect = lambda session, safe_name, member, rest_url: member['memberName'] != 'auditor'
+        sharding = self.sharding(4)
+        # A member that could not be added keeps the safe from being used, the next event adds it
+        self.assertFalse(sharding.ensure_safe('token', 'AOB_Unix_02', 'AOB_Unix', 'https://pvwa'))
+        self.assertNotIn('AOB_Unix_02', sharding.known_safes)
+        members['AOB_Unix_02'].append(operators)
+        add_safe_member.reset_mock(side_effect=True)
+        add_safe_member.return_value = True
+        self.assertTrue(sharding.ensure_safe('token', 'AOB_Unix_02', 'AOB_Unix', 'https://pvwa'))
+        add_safe_member.assert_called_once_with('token', 'AOB_Unix_02', auditor, 'https://pvwa')
+        self.assertTrue(sharding.ensure_safe('token', 'AOB_Unix_02', 'AOB_Unix', 'https://pvwa'))
+        self.assertEqual(4, get_safe_members.call_count)
+
+    @patch('pvwa_api_calls.delete_account_from_vault')
+    @patch('pvwa_api_calls.retrieve_account_id_from_account_name', return_value='12_3')
+    def test_offboarding_searches_the_safe_of_the_row(self, retrieve_account_id, delete_account):
+        row = {'Status': {'S': 'on boarded'}, 'Address': {'S': '10.0.0.1'}, 'SafeName': {'S': 'AOB_Unix_02'}}
+        result = instance_processing.delete_vault_account(INSTANCE_ID, row, 1, EC2Details().sp_class)
+        self.assertEqual((instance_processing.OffBoardResult.deleted, None), result)
+        retrieve_account_id.assert_called_once()
+        self.assertEqual('AOB_Unix_02', retrieve_account_id.call_args[0][2])
+        delete_account.assert_called_once_with(1, '12_3', INSTANCE_ID, EC2Details().sp_class.pvwa_url)
+
+
+class DynamoAccessTest(unittest.TestCase):
+    def access(self, read_units, write_units):
+        clock = FakeClock()
+        access = dynamo_access.DynamoAccess(clock=clock.time, sleep=clock.sleep)
+        access.throttles['Instances'] = dynamo_access.TableThrottle('Instances', {'read': read_units, 'write': write_units},
+                                                                    clock.time())
+        return access, clock
+
+    def test_requests_are_rate_limited_to_the_table_capacity(self):
+        access, clock = self.access(5, 5)
+        put_item = Mock(return_value={'ConsumedCapacity': {'TableName': 'Instances', 'CapacityUnits': 1.0}})
+        for index in range(5 * dynamo_access.BURST_SECONDS):
+            access.call('put_item', put_item, 'Instances', Item={'InstanceId': str(index)})
+        self.assertEqual([], clock.sleeps)
+        for index in range(10):
+            access.call('put_item', put_item, 'Instances', Item={'InstanceId': str(index)})
+        self.assertAlmostEqual(2.0, sum(clock.sleeps))
+        # A scan using more than expected is settled, the next request waits for it
+        access.call('scan', Mock(return_value={'ConsumedCapacity': {'CapacityUnits': 29.0}}), 'Instances')
+        access.call('get_item', Mock(return_value={}), 'Instances', Key={'InstanceId': '1'})
+        self.assertAlmostEqual(1.0, clock.sleeps[-1])
+        self.assertEqual({'Instances': {'read_units': 30.0, 'write_units': 35.0, 'throttled_requests': 0}},
+                         access.get_usage())
+
+    def test_throttled_requests_are_retried_and_slow_the_container(self):
+        access, clock = self.access(5, 10)
+        throttled = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'PutItem')
+        put_item = Mock(side_effect=[throttled, throttled, {'ConsumedCapacity': {'CapacityUnits': 1.0}}])
+        metrics = metrics_mechanism.MetricsMechanism()
+        metrics.enabled = True
+        with patch('dynamo_access.metrics', metrics):
+            access.call('put_item', put_item, 'Instances', Item={'InstanceId': 'i-1'})
+        self.assertEqual(3, put_item.call_count)
+        self.assertEqual({'ReturnConsumedCapacity': 'TOTAL', 'Item': {'InstanceId': 'i-1'}}, put_item.call_args[1])
+        bucket = access.throttles['Instances'].buckets['write']
+        self.assertEqual(2.5 + 10 / dynamo_access.RECOVERY_REQUESTS, bucket.rate)
+        document = metrics.build_emf_document()
+        self.assertEqual([2, 1.0], [sum(document['dynamo_throttled']), document['dynamo_instances_write_units']])
+        self.assertIn({'Name': 'dynamo_throttled', 'Unit': 'Count'}, document['_aws']['CloudWatchMetrics'][0]['Metrics'])
+        for _ in range(dynamo_access.RECOVERY_REQUESTS):
+            access.call('update_item', Mock(return_value={}), 'Instances', Key={'InstanceId': 'i-1'})
+        self.assertEqual(10, bucket.rate)
+        conditional = ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        put_item = Mock(side_effect=conditional)
+        with self.assertRaises(ClientError):
+            access.call('put_item', put_item, 'Instances', Item={'InstanceId': 'i-1'})
+        put_item.assert_called_once()
+        put_item = Mock(side_effect=throttled)
+        with self.assertRaises(ClientError):
+            access.call('put_item', put_item, 'Instances', Item={'InstanceId': 'i-1'})
+        self.assertEqual(dynamo_access.ATTEMPTS, put_item.call_count)
+        self.assertEqual(10 * dynamo_access.MIN_RATE, bucket.rate)
+
+    @mock_dynamodb2
+    @mock_ssm
+    def test_on_demand_table_is_not_rate_limited(self):
+        dynamo_client = boto3.client('dynamodb')
+        with patch.object(dynamo_client, 'describe_table',
+                          return_value={'Table': {'BillingModeSummary': {'BillingMode': 'PAY_PER_REQUEST'},
+                                                  'ProvisionedThroughput': {'ReadCapacityUnits': 0,
+                                                                            'WriteCapacityUnits': 0}}}):
+            self.assertEqual({'read': None, 'write': None}, dynamo_access.get_table_capacity(dynamo_client, 'Instances'))
+        access, clock = self.access(None, None)
+        batch_write_item = Mock(return_value={'UnprocessedItems': {},
+                                              'ConsumedCapacity': [{'TableName': 'Instances', 'CapacityUnits': 25.0}]})
+        for _ in range(20):
+            access.call('batch_write_item', batch_write_item, None,
+                        RequestItems={'Instances': [{'DeleteRequest': {'Key': {'InstanceId': {'S': str(index)}}}}
+                                                    for index in range(25)]})
+        self.assertEqual([], clock.sleeps)
+        self.assertEqual(500.0, access.get_usage()['Instances']['write_units'])
+
+
+# moto returns the whole table to every segment of a parallel scan, the rows are split between the segments here
+class SegmentedScanClient:
+    def __init__(self, dynamo_client, failing_segment=None):
+        self.dynamo_client = dynamo_client
+        self.failing_segment = failing_segment
+
+    def scan(self, Segment, TotalSegments, **arguments):
+        if Segment == self.failing_segment and 'ExclusiveStartKey' in arguments:
+            raise ClientError({'Error': {'Code': 'InternalServerError'}}, 'Scan')
+        response = self.dynamo_client.scan(**arguments)
+        response['Items'] = [item for item in response['Items']
+                             if zlib.crc32(item['InstanceId']['S'].encode()) % TotalSegments == Segment]
+        return response
+
+
+class InstancesExportTest(unittest.TestCase):
+    def setUp(self):
+        dynamodb_mock = mock_dynamodb2()
+        dynamodb_mock.start()
+        self.addCleanup(dynamodb_mock.stop)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'instances.jsonl.gz')
+
+    def create_rows(self, count):
+        table = dynamo_create_instances_table(boto3.resource('dynamodb'))
+        with table.batch_writer() as batch:
+            for index in range(count):
+                batch.put_item(Item={'InstanceId': f'i-{index:08x}', 'Status': 'on boarded', 'Address': '10.0.0.1',
+                                     'UpdatedAt': 1000 + index, 'SafeName': 'AOB_Unix', 'ResumeCount': index % 3})
+        return SegmentedScanClient(boto3.client('dynamodb'))
+
+    def test_parallel_scan_export(self):
+        client = self.create_rows(120)
+        statistics = instances_export.export(client, instances_export.LocalDestination(self.path), total_segments=4,
+                                             page_size=5)
+        with gzip.open(self.path, 'rt') as exported:
+            rows = [json.loads(line) for line in exported]
+        self.assertEqual(120, statistics['rows'])
+        self.assertEqual(120, len({row['InstanceId'] for row in rows}))
+        self.assertEqual({'InstanceId': 'i-00000004', 'Status': 'on boarded', 'Address': '10.0.0.1', 'UpdatedAt': 1004,
+                          'SafeName': 'AOB_Unix', 'ResumeCount': 1}, next(row for row in rows if row['UpdatedAt'] == 1004))
+        self.assertEqual(['instances.jsonl.gz'], os.listdir(self.directory.name))
+        # Incremental export of the rows written since the given time, as CSV
+        csv_path = os.path.join(self.directory.name, 'changes.csv.gz')
+        statistics = instances_export.export(client, instances_export.LocalDestination(csv_path), instances_export.CSV_FORMAT,
+                                             total_segments=3, page_size=7, since=1100)
+        with gzip.open(csv_path, 'rt', newline='') as exported:
+            rows = list(csv.DictReader(exported))
+        self.assertEqual(20, statistics['rows'])
+        self.assertEqual(list(instances_export.CSV_COLUMNS), list(rows[0]))
+        self.assertEqual(set(range(1100, 1120)), {int(row['UpdatedAt']) for row in rows})
+
+    def test_failed_segment_leaves_no_file(self):
+        client = self.create_rows(200)
+        client.failing_segment = 2
+        with self.assertRaises(ClientError):
+            instances_export.export(client, instances_export.LocalDestination(self.path), total_segments=4, page_size=2)
+        self.assertEqual([], os.listdir(self.directory.name))
+
+    @mock_s3
+    def test_s3_export_is_committed_or_aborted(self):
+        # moto does not decode the aws-chunked bodies sent with the checksums of the recent botocore versions
+        with patch.dict('os.environ', {'AWS_REQUEST_CHECKSUM_CALCULATION': 'when_required'}):
+            s3_client = boto3.client('s3', region_name='eu-west-2')
+            s3_client.create_bucket(Bucket='audit', CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+            client = self.create_rows(30)
+            instances_export.export(client, instances_export.open_destination('s3://audit/instances.jsonl.gz', s3_client))
+            exported = s3_client.get_object(Bucket='audit', Key='instances.jsonl.gz')['Body'].read()
+            self.assertEqual(30, len(gzip.decompress(exported).splitlines()))
+            client.failing_segment = 0
+            with self.assertRaises(ClientError):
+                instances_export.export(client, instances_export.open_destination('s3://audit/failed.jsonl.gz', s3_client),
+                                        page_size=2)
+            self.assertEqual(['instances.jsonl.gz'],
+                             [s3_object['Key'] for s3_object in s3_client.list_objects_v2(Bucket='audit')['Contents']])
+            self.assertNotIn('Uploads', s3_client.list_multipart_uploads(Bucket='audit'))
+
+
+class OnboardingRulesTest(unittest.TestCase):
+    def evaluate(self, rules, instance_details, event_region='eu-west-2'):
+        engine = onboarding_rules.RuleEngine()
+        with patch('onboarding_rules.get_rules_definition', return_value=json.dumps(rules)):
+            return engine.evaluate(instance_details, event_region)
+
+    def test_first_matching_rule_decides(self):
+        details = {'key_name': 'build-kp', 'image_id': 'ami-0123', 'vpc_id': 'vpc-prod', 'subnet_id': 'subnet-a',
+                   'aws_account_id': MOTO_ACCOUNT, 'tags': {'Environment': 'ci-runner', 'Owner': 'team'}}
+        rules = [{'name': 'keep-owned', 'action': 'include', 'tags': {'Owner': 'team'}, 'vpc': 'vpc-prod'},
+                 {'name': 'no-ci', 'tags': {'Environment': ['ci-*', 'test']}}]
+        self.assertEqual(('include', 'keep-owned'), self.evaluate(rules, details))
+        self.assertEqual(('exclude', 'no-ci'), self.evaluate(rules, dict(details, tags={'Environment': 'ci-runner'})))
+        self.assertEqual(('include', None), self.evaluate(rules, dict(details, tags=dict())))
+        self.assertEqual(('exclude', '#1'), self.evaluate([{'ami': 'ami-01*', 'key_name': 'build-*'}], details))
+        self.assertEqual(('exclude', '#2'), self.evaluate([{'subnet': 'subnet-b'}, {'account': MOTO_ACCOUNT,
+                                                                                    'region': 'eu-*'}], details))
+        self.assertEqual(('include', None), self.evaluate([{'region': 'us-*'}], details))
+
+    def test_invalid_rules_onboard_every_instance(self):
+        details = {'key_name': 'build-kp', 'tags': {'Environment': 'ci'}}
+        for definition in ('not json', json.dumps([{'tag': {'Environment': 'ci'}}]), json.dumps([{'action': 'skip'}]),
+                           json.dumps([{'ami': 5}])):
+            engine = onboarding_rules.RuleEngine()
+            with patch('onboarding_rules.get_rules_definition', return_value=definition):
+                self.assertEqual(('include', None), engine.evaluate(details, 'eu-west-2'))
+            self.assertEqual([], engine.rules)
+
+    @patch('aws_services.remove_instances_from_dynamo_table', return_value=True)
+    @patch('aws_services.get_instances_data_from_dynamo_table')
+    @patch('pvwa_api_calls.delete_account_from_vault')
+    def test_skipped_instances_are_offboarded_without_the_vault(self, delete_account, get_rows, remove_rows):
+        get_rows.return_value = {'i-skipped': {'Status': {'S': 'skipped'}, 'Address': {'S': '10.0.0.1'}},
+                                 'i-pending': {'Status': {'S': 'on board pending'}, 'Address': {'S': '10.0.0.2'}}}
+        results = instance_processing.offboard_instances(['i-skipped', 'i-pending'], 1, EC2Details().sp_class)
+        not_onboarded = (instance_processing.OffBoardResult.not_onboarded_removed, None)
+        self.assertEqual({'i-skipped': not_onboarded, 'i-pending': not_onboarded}, results)
+        delete_account.assert_not_called()
+        self.assertEqual({'i-skipped', 'i-pending'}, set(remove_rows.call_args[0][0]))
+
+
+@mock_dynamodb2
+@mock_ssm
+class FairSchedulingTest(unittest.TestCase):
+    def test_noisy_account_is_deferred_and_flows_interleave(self):
+        noisy = [(f'a{index}', account_event('111111111111', index)) for index in range(30)]
+        quiet = [(f'b{index}', account_event('222222222222', index)) for index in range(4)]
+        flows = dict()
+        weights = {'222222222222:eu-west-2': 2.0}
+        admitted, deferred, virtual_time = fair_scheduling.assign_tags(noisy + quiet, flows, 0.0, weights, 1000.0)
+        self.assertEqual(['a0', 'b0', 'b1', 'a1', 'b2', 'b3', 'a2', 'a3'], [key for key, data in admitted[:8]])
+        self.assertEqual(25, len(admitted))
+        self.assertEqual([f'a{index}' for index in range(21, 30)], [key for key, data in deferred])
+        # The quiet account is the slowest active flow, the noisy one gets at most a quantum ahead of it
+        admitted, deferred, virtual_time = fair_scheduling.assign_tags(noisy[21:], flows, virtual_time, weights, 1010.0)
+        self.assertEqual(2.0, virtual_time)
+        self.assertEqual(['a21', 'a22'], [key for key, data in admitted])
+        # Once the quiet account is idle the noisy one runs alone and is not held back
+        admitted, deferred, virtual_time = fair_scheduling.assign_tags(noisy[23:], flows, virtual_time, weights, 1040.0)
+        self.assertEqual(7, len(admitted))
+        self.assertEqual([], deferred)
+        self.assertEqual(['111111111111:eu-west-2'], list(flows))
+
+    def test_scheduler_shares_the_flows_and_reads_the_weights(self):
+        boto3.client('ssm').put_parameter(Name='AOB_Account_Weights', Value='111111111111=3, bad, 222222222222:eu-west-2=0',
+                                          Type='String')
+        self.assertEqual({'111111111111': 3.0}, fair_scheduling.get_account_weights())
+        dynamodb = boto3.resource('dynamodb')
+        sessions_table = dynamo_create_sessions_table(dynamodb)
+        clock = FakeClock()
+        schedulers = [fair_scheduling.FairScheduler(quantum=2, clock=clock.time) for _ in range(2)]
+        events = [(f'a{index}', account_event('333333333333', index)) for index in range(3)]
+        schedulers[0].schedule([('b0', account_event('444444444444', 0))])
+        self.assertEqual((events, []), schedulers[1].schedule(events))
+        self.assertEqual(([], events), schedulers[0].schedule(events))
+        item = sessions_table.get_item(Key={'name': 'fair_queue'})['Item']
+        self.assertEqual(3, item['version'])
+        self.assertEqual(['333333333333:eu-west-2', '444444444444:eu-west-2'], sorted(item['flows']))
+        sessions_table.delete()
+
+    def test_scheduler_fails_open(self):
+        scheduler = fair_scheduling.FairScheduler()
+        scheduler.weights = dict()
+        events = [('a0', account_event('111111111111', 0))]
+        self.assertEqual((events, []), scheduler.schedule(events))
+
+
 ##General Functions##
+def state_change_message(instance_id, state, event_time):
+    return {'time': event_time, 'account': MOTO_ACCOUNT, 'region': 'eu-west-2',
+            'detail': {'instance-id': instance_id, 'state': state}}
+
+def account_event(account_id, index):
+    return {'time': f'2020-01-01T00:00:{index:02d}Z', 'account': account_id, 'region': 'eu-west-2',
+            'detail': {'instance-id': f'i-{account_id}{index}', 'state': 'running'}}
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def rotation_item(instance_id, safe_name, dispatched_at=None, failures=0):
+    item = {'InstanceId': instance_id, 'VaultAccountId': f'{instance_id}_id', 'SafeName': safe_name,
+            'RotationFailures': failures}
+    if dispatched_at:
+        item['RotationDispatchedAt'] = dispatched_at
+    return item
+
+# Runs the rotation scheduler at time 1000 over the given queues, returns the dispatched instances and the row updates
+def run_rotation_scheduler(config, in_progress, due, secret_management):
+    clock = FakeClock()
+    dispatched = []
+    updates = dict()
+    def get_rotation_queue(queue, due_before=None, limit=None):
+        return in_progress if queue == 'dispatched' else due
+    def get_secret_management(session, account_id, instance_id, pvwa_url):
+        return secret_management[instance_id]
+    def rotate(session, pvwa_url, account_id, instance_id):
+        dispatched.append(instance_id)
+        return True
+    def update_rotation(instance_id, attributes, removed_attributes=()):
+        updates[instance_id] = (attributes, removed_attributes)
+        return True
+    vault_session = Mock()
+    vault_session.get_token.return_value = 'token'
+    with patch('aws_services.get_rotation_queue', get_rotation_queue), \
+            patch('aws_services.update_instance_rotation', update_rotation), \
+            patch('pvwa_api_calls.get_account_secret_management', get_secret_management), \
+            patch('pvwa_api_calls.rotate_credentials_immediately', rotate):
+        scheduler = credential_rotation.RotationScheduler(vault_session, config, deadline_mechanism.Deadline(60000, 0),
+                                                          clock=clock.time, sleep=clock.sleep)
+        updates['summary'] = scheduler.run()
+    return dispatched, updates
+
+def bulk_vault_session():
+    vault_session = Mock()
+    vault_session.get_token.return_value = 'token'
+    vault_session.store_parameters_class.pvwa_url = 'https://pvwa'
+    return vault_session
+
+def bulk_instance_details(index):
+    return {'address': f'10.0.0.{index}', 'image_id': 'ami-1'}
+
+def bulk_instance_account(instance_id, platform):
+    if platform == 'unix':
+        return {'name': f'AWS.{instance_id}.Unix', 'secret': 'ppk', 'platform': UNIX_PLATFORM, 'username': 'ec2-user',
+                'safe_name': 'unix', 'base_safe_name': 'unix'}
+    return {'name': f'AWS.{instance_id}.Windows', 'secret': 'password', 'platform': WINDOWS_PLATFORM,
+            'username': 'Administrator', 'safe_name': 'windows', 'base_safe_name': 'windows'}
+
+def fake_exc_no_args():
+    raise Exception('fake_exc')
+
 def fake_exc(a, b):
     raise Exception('fake_exc')
 
@@ -369,9 +1614,21 @@ def dynamo_create_instances_table(dynamo_resource):
     table = dynamo_resource.Table('Instances')
     table = dynamo_resource.create_table(TableName='Instances',
                                          KeySchema=[{"AttributeName": "InstanceId", "KeyType": "HASH"}],
-                                         AttributeDefinitions=[{"AttributeName": "InstanceId", "AttributeType": "S"}])
+                                         AttributeDefinitions=[{"AttributeName": "InstanceId", "AttributeType": "S"},
+                                                               {"AttributeName": "RotationQueue", "AttributeType": "S"},
+                                                               {"AttributeName": "RotationDueAt", "AttributeType": "N"}],
+                                         GlobalSecondaryIndexes=[{
+                                             "IndexName": aws_services.ROTATION_QUEUE_INDEX,
+                                             "KeySchema": [{"AttributeName": "RotationQueue", "KeyType": "HASH"},
+                                                           {"AttributeName": "RotationDueAt", "KeyType": "RANGE"}],
+                                             "Projection": {"ProjectionType": "ALL"}}])
     return table
 
+def dynamo_create_sessions_table(dynamo_resource):
+    return dynamo_resource.create_table(TableName='Sessions',
+                                        KeySchema=[{"AttributeName": "name", "KeyType": "HASH"}],
+                                        AttributeDefinitions=[{"AttributeName": "name", "AttributeType": "S"}])
+
 def dynamo_put_ec2_object(dynamo_resource, ec2_object):
     table = dynamo_resource.Table('Instances')
     table.put_item(Item={'InstanceId': ec2_object})
@@ -384,14 +1641,13 @@ def func_create_instance(ec2_class, ec2_object):
     @patch('instance_processing.get_instance_password_data', return_value='StrongPassword')
     @patch('kp_processing.convert_pem_to_ppk', return_value='VeryValue')
     @patch('kp_processing.decrypt_password', mocky)
-    @patch('aws_services.get_session_from_dynamo', return_value=['3', '4'])
+    @patch('session_slots.acquire_slot', return_value=MagicMock(slot='3'))
     @patch('pvwa_integration.PvwaIntegration.logon_pvwa', return_value='asbhdsyadbasASDUASDUHB2312312')
     @patch('pvwa_api_calls.retrieve_account_id_from_account_name', return_value=False)
     @patch('pvwa_api_calls.create_account_on_vault', return_value=['a','a'])
     @patch('pvwa_api_calls.rotate_credentials_immediately', return_value='a')
     @patch('aws_services.put_instance_to_dynamo_table', return_value='a')
     @patch('pvwa_integration.PvwaIntegration.logoff_pvwa', return_value='a')
-    @patch('aws_services.release_session_on_dynamo',return_value='a')
     def invoke(*args):
         status = instance_processing.create_instance(ec2_object, ec2_class.details, ec2_class.sp_class, 'yea', MOTO_ACCOUNT,
                                             'eu-west-2', MOTO_ACCOUNT, '123123132h')
@@ -407,7 +1663,8 @@ def mock_pvwa_integration(method, parameters, return_code=int, json_response=Non
            "check_if_kp_exists": pvwa_api.check_if_kp_exists,
            "delete_account_from_vault": pvwa_api.delete_account_from_vault,
            "filter_get_accounts_result": pvwa_api.filter_get_accounts_result,
-           "get_account_value": pvwa_api.get_account_value}
+           "get_account_value": pvwa_api.get_account_value,
+           "get_account_secret_management": pvwa_api.get_account_secret_management}
     if json_response:
         response, json_response = mock_requests_response(return_code, json_response)
     else: